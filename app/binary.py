@@ -0,0 +1,126 @@
+"""
+Binary event files. All values are little-endian. The file starts with a
+16 byte header: the magic 'PSRBEVT1', the size of the floating point values
+(4 or 8) as uint32 and a reserved uint32. Each event is a header record
+
+    int64 count, float x, y, z, int64 num_photons, float critical_energy
+
+followed by count records of float px, py, pz. A missing number of photons
+is stored as -1 and a missing critical energy as NaN.
+"""
+import numpy as np
+from app.stream import compression, read_stream
+
+MAGIC = b"PSRBEVT1"
+FILE_HEADER = np.dtype([('magic', 'S8'), ('float_size', '<u4'),
+                        ('reserved', '<u4')])
+
+
+def event_dtypes(float_size):
+    """Return the dtypes of the event header and the momentum records"""
+    float_type = '<f%i'%float_size
+    header = np.dtype([('count', '<i8'), ('x', float_type), ('y', float_type),
+                       ('z', float_type), ('num_photons', '<i8'),
+                       ('critical_energy', float_type)])
+    momentum = np.dtype([('px', float_type), ('py', float_type),
+                         ('pz', float_type)])
+    return header, momentum
+
+
+class BinaryEventEncoder(object):
+    """
+    Encodes batches of events into the bytes of the binary event format
+    """
+    def __init__(self, precision='float64'):
+        self._float_size = np.dtype(precision).itemsize
+        self._header, self._momentum = event_dtypes(self._float_size)
+
+
+    def file_header(self):
+        header = np.zeros(1, dtype=FILE_HEADER)
+        header['magic'] = MAGIC
+        header['float_size'] = self._float_size
+        return header.tobytes()
+
+
+    def encode(self, vertices, momenta, offsets, num_photons=None,
+               critical_e=None):
+        """
+        Encode the events, the photons of event i are the rows offsets[i]
+        to offsets[i+1] of the momenta
+        """
+        vertices = np.asarray(vertices).reshape(-1, 3)
+        momenta = np.asarray(momenta).reshape(-1, 3)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        events = len(vertices)
+        counts = np.diff(offsets)
+
+        header = np.zeros(events, dtype=self._header)
+        header['count'] = counts
+        header['x'] = vertices[:, 0]
+        header['y'] = vertices[:, 1]
+        header['z'] = vertices[:, 2]
+        header['num_photons'] = -1 if num_photons is None else num_photons
+        header['critical_energy'] = np.nan if critical_e is None else critical_e
+
+        photons = momenta[offsets[0]:offsets[-1]]
+        body = np.zeros(len(photons), dtype=self._momentum)
+        body['px'] = photons[:, 0]
+        body['py'] = photons[:, 1]
+        body['pz'] = photons[:, 2]
+
+        # events with one photon each, the usual case without full events,
+        # are written as one array of header and momentum records
+        if np.all(counts == 1):
+            records = np.empty(events, dtype=[('header', self._header),
+                                              ('momentum', self._momentum)])
+            records['header'] = header
+            records['momentum'] = body
+            return records.tobytes()
+
+        parts = []
+        for i in range(events):
+            parts.append(header[i:i+1].tobytes())
+            parts.append(body[offsets[i]-offsets[0]:
+                              offsets[i+1]-offsets[0]].tobytes())
+        return b"".join(parts)
+
+
+def read_events(filename, compression_name=None):
+    """
+    Iterate over the events of a binary event file and yield the vertex,
+    the momenta, the number of photons and the critical energy of each
+    event. Uncompressed files are memory-mapped.
+    """
+    if compression(filename, compression_name) == 'none':
+        data = np.memmap(filename, dtype=np.uint8, mode='r')
+    else:
+        data = np.frombuffer(read_stream(filename, compression_name),
+                             dtype=np.uint8)
+
+    file_header = data[:FILE_HEADER.itemsize].view(FILE_HEADER)[0]
+    if file_header['magic'] != MAGIC:
+        raise ValueError("%s is not a binary event file"%filename)
+    return decode_events(data[FILE_HEADER.itemsize:],
+                         int(file_header['float_size']))
+
+
+def decode_events(data, float_size):
+    """
+    Iterate over the events in a byte array of complete event records
+    """
+    header_type, momentum_type = event_dtypes(float_size)
+    position = 0
+    while position < len(data):
+        header = data[position:position+header_type.itemsize].view(
+                     header_type)[0]
+        position += header_type.itemsize
+        size = int(header['count']) * momentum_type.itemsize
+        body = data[position:position+size].view(momentum_type)
+        position += size
+        num_photons = int(header['num_photons'])
+        critical_e = float(header['critical_energy'])
+        yield ((float(header['x']), float(header['y']), float(header['z'])),
+               np.column_stack((body['px'], body['py'], body['pz'])),
+               None if num_photons < 0 else num_photons,
+               None if np.isnan(critical_e) else critical_e)
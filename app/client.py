@@ -0,0 +1,97 @@
+"""
+Thin client of the pysynrad daemon. It only sends the path of the
+configuration to the daemon and prints the result, such that a run pays
+neither the imports of the generator nor the loading of the lattice and
+the spectrum.
+
+usage: pysynrad submit <config_file> [-t template] [-r] [-s socket]
+       pysynrad submit --status [-s socket]
+       pysynrad submit --shutdown [-s socket]
+"""
+import os
+import sys
+import json
+import socket
+import argparse
+import tempfile
+
+
+def default_socket():
+    return os.path.join(tempfile.gettempdir(), "pysynrad-%i.sock"%os.getuid())
+
+
+def request(path, message):
+    """
+    Send a request to the daemon listening on the socket and return
+    its response
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(path)
+        connection.sendall((json.dumps(message) + "\n").encode())
+        with connection.makefile('rb') as stream:
+            line = stream.readline()
+    if len(line) == 0:
+        raise RuntimeError("The daemon on %s closed the connection"%path)
+    return json.loads(line)
+
+
+def submit_command(argv):
+    parser = argparse.ArgumentParser(prog='pysynrad submit',
+                                     description='Run a configuration on the ' \
+                                                 'pysynrad daemon')
+    parser.add_argument('<config_file>', nargs='?',
+                        help='Path to configuration file')
+    parser.add_argument('-t', '--template', action='store',
+                        help='A JSON string with template arguments for the conf')
+    parser.add_argument('-r', '--resume', action='store_true',
+                        help='Resume the run from its last checkpoint')
+    parser.add_argument('-s', '--socket', default=default_socket(),
+                        help='Path of the socket of the daemon')
+    parser.add_argument('--status', action='store_true',
+                        help='Show the status of the daemon')
+    parser.add_argument('--shutdown', action='store_true',
+                        help='Stop the daemon')
+    args = vars(parser.parse_args(argv))
+
+    if args['status']:
+        print_status(request(args['socket'], {'command': 'status'}))
+        return
+    if args['shutdown']:
+        request(args['socket'], {'command': 'shutdown'})
+        return
+    if args['<config_file>'] == None:
+        parser.error("the configuration file is required")
+
+    response = request(args['socket'],
+                       {'command': 'run',
+                        'config': os.path.abspath(args['<config_file>']),
+                        'template': args['template'],
+                        'resume': args['resume'],
+                        'cwd': os.getcwd()})
+    if response['status'] != 'ok':
+        sys.stderr.write(response.get('traceback', response['error']))
+        sys.exit(1)
+    print_result(response)
+
+
+def print_result(response):
+    statistics = response['statistics']
+    print("Run finished in %.2f s by worker %i"%(response['time'],
+                                               response['worker']))
+    for name, filename in sorted(response['outputs'].items()):
+        print("  %-26s: %s"%(name, filename))
+    print("  %-26s: %i steps, %i radiation calls, %i photons, %i events"%(
+          "statistics", statistics['steps'], statistics['radiation_calls'],
+          statistics['photons'], statistics['events']))
+    for name, cache in sorted(response['cache'].items()):
+        print("  %-26s: %i hits, %i misses, %i entries"%(
+              "worker cache " + name, cache['hits'], cache['misses'],
+              cache['entries']))
+
+
+def print_status(response):
+    print("Daemon with %i workers, up for %.0f s"%(response['workers'],
+                                                 response['uptime']))
+    print("  %-26s: %i"%("jobs running", response['running']))
+    print("  %-26s: %i"%("jobs finished", response['finished']))
+    print("  %-26s: %i"%("jobs failed", response['failed']))
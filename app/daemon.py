@@ -0,0 +1,203 @@
+"""
+Resident worker daemon. The daemon listens on a Unix socket for jobs, each
+job being a configuration that is run by one of a pool of worker processes.
+The workers import the generator and the spectrum once and keep the loaded
+lattices and spectra in an LRU cache (see core.cache), such that a job only
+pays for its own run. A job returns the paths of its outputs and the run
+statistics. The requests and responses are JSON objects, one per line.
+
+usage: pysynrad daemon [-s socket] [-w workers] [--lattices n] [--spectra n]
+"""
+import os
+import json
+import time
+import argparse
+import threading
+import traceback
+import socketserver
+import multiprocessing
+import logging.config
+from app import settings
+from app.client import default_socket, request
+
+logger = logging.getLogger(__name__)
+
+# the cache of a worker process
+_cache = None
+
+
+def initialize_worker(lattices, spectra):
+    """
+    Create the cache of a worker process and import the generator and
+    the spectrum with NumPy and SciPy
+    """
+    global _cache
+    import core.generator
+    import core.spectrum
+    from core.cache import Cache
+    _cache = Cache(lattices, spectra)
+
+
+def run_job(job):
+    """
+    Run a job in a worker process. The relative paths of the configuration
+    are resolved against the working directory of the client.
+    """
+    from core.generator import Generator
+    start = time.perf_counter()
+    try:
+        os.chdir(job['cwd'])
+        settings.read(job['config'], job['template'])
+        application = settings.Settings()['application']
+        logging.config.dictConfig(application['logging'])
+
+        # the progress of a job is not shown by the daemon
+        if 'progress' in application:
+            application['progress']['enabled'] = False
+        elif 'progress_bar' in application:
+            application['progress_bar'] = False
+
+        # the daemonic pool workers cannot start the processes
+        # of the photon pipeline
+        if 'pipeline' in application:
+            application['pipeline']['enabled'] = False
+
+        gen = Generator(_cache)
+        gen.initialize(resume=job['resume'])
+        gen.run()
+        gen.terminate()
+    except Exception as error:
+        return {'status': 'error',
+                'error': "%s: %s\n"%(type(error).__name__, error),
+                'traceback': traceback.format_exc()}
+
+    return {'status': 'ok',
+            'worker': os.getpid(),
+            'time': time.perf_counter() - start,
+            'outputs': dict([(name, os.path.abspath(filename)) for name, filename
+                             in gen.output_files().items()]),
+            'statistics': gen.statistics(),
+            'cache': _cache.statistics()}
+
+
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if len(line) == 0:
+            return
+        response = self.server.dispatch(json.loads(line))
+        self.wfile.write((json.dumps(response) + "\n").encode())
+
+
+
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    The socket server of the daemon. Each connection is handled by its own
+    thread, which waits for the worker pool to run its job.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, workers, lattices, spectra):
+        self._workers = workers
+        self._pool = multiprocessing.Pool(workers, initialize_worker,
+                                          (lattices, spectra))
+        self._lock = threading.Lock()
+        self._running = 0
+        self._finished = 0
+        self._failed = 0
+        self._start_time = time.time()
+        socketserver.UnixStreamServer.__init__(self, path, Handler)
+
+
+    def dispatch(self, message):
+        command = message.get('command')
+        if command == 'run':
+            return self._run(message)
+        if command == 'status':
+            with self._lock:
+                return {'status': 'ok',
+                        'workers': self._workers,
+                        'uptime': time.time() - self._start_time,
+                        'running': self._running,
+                        'finished': self._finished,
+                        'failed': self._failed}
+        if command == 'shutdown':
+            # shutdown() waits for serve_forever() to return,
+            # which is why it cannot be called by the handler itself
+            threading.Thread(target=self.shutdown).start()
+            return {'status': 'ok'}
+        return {'status': 'error', 'error': "Unknown command '%s'\n"%command}
+
+
+    def _run(self, job):
+        logger.info("Running %s"%job['config'])
+        with self._lock:
+            self._running += 1
+        try:
+            response = self._pool.apply(run_job, (job,))
+        finally:
+            with self._lock:
+                self._running -= 1
+        with self._lock:
+            if response['status'] == 'ok':
+                self._finished += 1
+            else:
+                self._failed += 1
+        logger.info("Finished %s: %s"%(job['config'], response['status']))
+        return response
+
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        self._pool.terminate()
+        self._pool.join()
+
+
+
+def serve(path, workers, lattices, spectra):
+    """
+    Run the daemon on the socket until it is shut down
+    """
+    if os.path.exists(path):
+        try:
+            request(path, {'command': 'status'})
+        except OSError:
+            # a socket left behind by a daemon that was killed
+            os.remove(path)
+        else:
+            raise RuntimeError("A daemon is already listening on %s"%path)
+
+    server = Daemon(path, workers, lattices, spectra)
+    logger.info("Listening on %s with %i workers"%(path, workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+    logger.info("Daemon stopped")
+
+
+def daemon_command(argv):
+    parser = argparse.ArgumentParser(prog='pysynrad daemon',
+                                     description='Run jobs submitted over a ' \
+                                                 'Unix socket with resident ' \
+                                                 'lattices and spectra')
+    parser.add_argument('-s', '--socket', default=default_socket(),
+                        help='Path of the socket')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(),
+                        help='Number of worker processes')
+    parser.add_argument('--lattices', type=int, default=4,
+                        help='Number of lattices cached by each worker')
+    parser.add_argument('--spectra', type=int, default=4,
+                        help='Number of spectra cached by each worker')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s - %(name)s - %(levelname)s: " \
+                               "%(message)s")
+    serve(args.socket, args.workers, args.lattices, args.spectra)
@@ -0,0 +1,269 @@
+"""
+Seekable event files. The event writer keeps a sidecar index next to the
+event file, named like the event file with the extension '.idx' appended.
+The index starts with a 16 byte header: the magic 'PSREIDX1' and a reserved
+uint64. It then holds one little-endian record per radiation call
+
+    float64 s, int64 call, int64 event, int64 offset
+
+with the s position and the number of the radiation call, the number of the
+first event of the call and the offset of that event in the uncompressed
+event stream. Closing the event file appends an end record with the call
+number -1, which holds the total number of events and the total length.
+The events of a call are the events between its offset and the offset of
+the next record.
+
+The EventReader selects events by s range, radiation call or magnet. The
+events of uncompressed files are read directly from their offsets, while
+compressed files are decompressed once as a whole.
+"""
+import numpy as np
+from app.stream import Stream, compression, read_stream
+from app.binary import MAGIC, FILE_HEADER, decode_events
+
+INDEX_MAGIC = b"PSREIDX1"
+INDEX_HEADER = np.dtype([('magic', 'S8'), ('reserved', '<u8')])
+INDEX_RECORD = np.dtype([('s', '<f8'), ('call', '<i8'), ('event', '<i8'),
+                         ('offset', '<i8')])
+END_CALL = -1
+
+
+def index_filename(filename):
+    return filename + ".idx"
+
+
+def read_index(filename):
+    """
+    Return the records of an index file as a structured array
+    """
+    data = np.fromfile(filename, dtype=np.uint8)
+    header = data[:INDEX_HEADER.itemsize].view(INDEX_HEADER)
+    if (len(header) == 0) or (header[0]['magic'] != INDEX_MAGIC):
+        raise ValueError("%s is not an event index"%filename)
+    records = data[INDEX_HEADER.itemsize:]
+    records = records[:len(records) - len(records) % INDEX_RECORD.itemsize]
+    return records.view(INDEX_RECORD)
+
+
+def merge_index(sources, target, binary=False):
+    """
+    Merge the indices of consecutive event files into the index of their
+    concatenation. The file header of a binary event file is only kept
+    from the first file.
+    """
+    parts = []
+    events = 0
+    length = 0
+    for i in range(len(sources)):
+        records = read_index(sources[i])
+        if (len(records) == 0) or (records[-1]['call'] != END_CALL):
+            raise RuntimeError("The event index %s is incomplete"%sources[i])
+        skip = FILE_HEADER.itemsize if (binary and i > 0) else 0
+        shifted = records[:-1].copy()
+        shifted['event'] += events
+        shifted['offset'] += length - skip
+        parts.append(shifted)
+        events += int(records[-1]['event'])
+        length += int(records[-1]['offset']) - skip
+
+    header = np.zeros(1, dtype=INDEX_HEADER)
+    header['magic'] = INDEX_MAGIC
+    end = np.zeros(1, dtype=INDEX_RECORD)
+    end[0] = (np.nan, END_CALL, events, length)
+    with open(target, "wb") as index_file:
+        index_file.write(header.tobytes())
+        for part in parts:
+            index_file.write(part.tobytes())
+        index_file.write(end.tobytes())
+
+
+def magnet_range(filenames, name):
+    """
+    Return the s range covered by the slices of the magnet with the given
+    name in the lattice files
+    """
+    left = None
+    right = None
+    for filename in filenames:
+        with open(filename, "r") as lattice_file:
+            for line in lattice_file:
+                tokens = line.split()
+                if (len(tokens) < 3) or (tokens[0] != name):
+                    continue
+                s = float(tokens[1])
+                l = float(tokens[2])
+                left = s if left == None else min(left, s)
+                right = s + l if right == None else max(right, s + l)
+    if left == None:
+        raise ValueError("The magnet '%s' is not part of the lattice %s"%(
+                         name, ", ".join(filenames)))
+    return left, right
+
+
+
+class EventIndex(object):
+    """
+    Writes the index of an event file. The index is written uncompressed,
+    such that it can be read without scanning the event file.
+    """
+    def __init__(self, filename):
+        self._filename = filename
+        self._stream = None
+
+
+    def open(self, offset=None):
+        self._stream = Stream(self._filename, offset=offset, binary=True)
+        if offset == None:
+            header = np.zeros(1, dtype=INDEX_HEADER)
+            header['magic'] = INDEX_MAGIC
+            self._stream.write(header.tobytes())
+
+
+    def mark(self, s, call, event, offset):
+        record = np.zeros(1, dtype=INDEX_RECORD)
+        record[0] = (s, call, event, offset)
+        self._stream.write(record.tobytes())
+
+
+    def state(self):
+        return self._stream.checkpoint()
+
+
+    def close(self, events, length):
+        if self._stream == None:
+            return
+        self.mark(np.nan, END_CALL, events, length)
+        self._stream.close()
+        self._stream = None
+
+
+
+class EventReader(object):
+    """
+    Reads selected events of an indexed event file in the text or the
+    binary format. The events are returned in the form of
+    app.binary.read_events: the vertex, an array of momenta, the number of
+    photons and the critical energy, the last two being None if they were
+    not written.
+    """
+    def __init__(self, filename, compression_name=None, index=None):
+        self._filename = filename
+        self._compression = compression(filename, compression_name)
+        self._records = read_index(index_filename(filename)
+                                   if index == None else index)
+        self._data = None
+        self._float_size = None
+
+        # the end record is missing in the index of a file that is
+        # still written, the end is then the end of the file
+        if (len(self._records) > 0) and \
+           (self._records[-1]['call'] == END_CALL):
+            self._end = int(self._records[-1]['offset'])
+            self._records = self._records[:-1]
+        else:
+            self._end = len(self._read_data())
+
+        if self._compression == 'none':
+            with open(filename, "rb") as event_file:
+                magic = event_file.read(len(MAGIC))
+        else:
+            magic = self._read_data()[:len(MAGIC)].tobytes()
+        self._binary = magic == MAGIC
+
+
+    def records(self):
+        """
+        Return the index records without the end record
+        """
+        return self._records
+
+
+    def select(self, smin, smax):
+        """
+        Return the events of the radiation calls at smin <= s <= smax
+        """
+        s = self._records['s']
+        return self._events(np.flatnonzero((s >= min(smin, smax)) &
+                                           (s <= max(smin, smax))))
+
+
+    def calls(self, first, last):
+        """
+        Return the events of the radiation calls first to last inclusive
+        """
+        call = self._records['call']
+        return self._events(np.flatnonzero((call >= first) & (call <= last)))
+
+
+    def magnet(self, name, lattice_filenames):
+        """
+        Return the events of the radiation calls within the magnet with the
+        given name in the lattice files
+        """
+        return self.select(*magnet_range(lattice_filenames, name))
+
+
+    def _events(self, indices):
+        """
+        Read the events of the records, contiguous records are read at once
+        """
+        if len(indices) == 0:
+            return
+        splits = np.flatnonzero(np.diff(indices) != 1) + 1
+        for group in np.split(indices, splits):
+            start = int(self._records[group[0]]['offset'])
+            if group[-1] + 1 < len(self._records):
+                stop = int(self._records[group[-1] + 1]['offset'])
+            else:
+                stop = self._end
+            if stop <= start:
+                continue
+            if self._binary:
+                for event in self._binary_events(start, stop):
+                    yield event
+            else:
+                for event in self._text_events(start, stop):
+                    yield event
+
+
+    def _read_data(self):
+        if self._data is None:
+            if self._compression == 'none':
+                self._data = np.memmap(self._filename, dtype=np.uint8,
+                                       mode='r')
+            else:
+                self._data = np.frombuffer(read_stream(self._filename,
+                                                       self._compression),
+                                           dtype=np.uint8)
+        return self._data
+
+
+    def _binary_events(self, start, stop):
+        data = self._read_data()
+        if self._float_size == None:
+            file_header = data[:FILE_HEADER.itemsize].view(FILE_HEADER)[0]
+            self._float_size = int(file_header['float_size'])
+        return decode_events(data[start:stop], self._float_size)
+
+
+    def _text_events(self, start, stop):
+        if self._compression == 'none':
+            with open(self._filename, "rb") as event_file:
+                event_file.seek(start)
+                text = event_file.read(stop - start).decode()
+        else:
+            text = self._read_data()[start:stop].tobytes().decode()
+
+        lines = text.splitlines()
+        position = 0
+        while position < len(lines):
+            tokens = lines[position].split()
+            count = int(tokens[0])
+            momenta = np.array([line.split() for line in
+                                lines[position+1:position+1+count]],
+                               dtype=np.float64).reshape(-1, 3)
+            position += count + 1
+            yield ((float(tokens[1]), float(tokens[2]), float(tokens[3])),
+                   momenta,
+                   int(tokens[4]) if len(tokens) > 4 else None,
+                   float(tokens[5]) if len(tokens) > 5 else None)
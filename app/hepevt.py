@@ -1,5 +1,7 @@
 import math
+import itertools
 from app.settings import Settings
+from app.stream import open_stream, member_filename
 
 
 class Photon():
@@ -51,18 +53,86 @@ class Event():
 
 
 class Hepevt():
+    """
+    The HEPEVT event file. Events are either built from Event and Photon
+    objects or written directly from arrays of momenta with write_event()
+    and write_events(). The array methods format the photons in chunks of
+    CHUNK_SIZE lines, which bounds the memory of the text for events with
+    a very large number of photons. With the 'binary' format the events are
+    written as binary records (see app.binary) in the precision of the
+    photon stage. With 'index' enabled, each radiation call is marked in a
+    sidecar index (see app.events), for which the length of the uncompressed
+    event stream is counted.
+    """
+    CHUNK_SIZE = 4096
 
-    def __init__(self):
+    def __init__(self, suffix=""):
         settings = Settings()['application']['output']['events']
+        self._settings = settings
         self._enabled = settings['enabled']
         self._filename = settings['filename']
+        self._suffix = suffix
+        self._binary = settings.get('format', 'text') == 'binary'
+        if settings.get('format', 'text') not in ['text', 'binary']:
+            raise ValueError("Unknown event format '%s'"%settings['format'])
         self._file = None
+        self._encoder = None
+        self._index = None
+        self._evt_count = 0
+        self._position = 0
 
 
-    def open(self):
+    def open(self, state=None):
         if self._enabled:
-            self._file = open(self._filename, "w")
+            self._create_encoder()
+            # a state without offset starts a new file with an event count,
+            # as at the start of a shard
+            offset = None
+            index_offset = None
             self._evt_count = 0
+            self._position = 0
+            if state != None:
+                offset = state['offset']
+                index_offset = state.get('index')
+                self._evt_count = state['evt_count']
+                self._position = state.get('position', 0)
+            self._file = open_stream(self._settings, offset, self._suffix,
+                                     self._binary)
+            if self._settings.get('index', False):
+                from app.events import EventIndex, index_filename
+                self._index = EventIndex(index_filename(self.filename()))
+                self._index.open(index_offset)
+            if self._binary and (offset == None):
+                self._write(self._encoder.file_header())
+
+
+    def capture(self, stream):
+        """
+        Write the events into a stream object instead of the file, without
+        the file header and the index. The captured text or bytes are
+        written to the file with write_encoded().
+        """
+        if self._enabled:
+            self._create_encoder()
+            self._file = stream
+
+
+    def write_encoded(self, data, count):
+        """
+        Write count events captured by a Hepevt with the same settings
+        """
+        if self._file == None:
+            return
+        self._write(data)
+        self._evt_count += count
+
+
+    def mark(self, s, call):
+        """
+        Mark the start of the events of a radiation call at s in the index
+        """
+        if self._index != None:
+            self._index.mark(s, call, self._evt_count, self._position)
 
 
     def event(self, x, y, z, num_photons=None, critical_e=None):
@@ -72,24 +142,154 @@ class Hepevt():
     def write(self, event):
         if self._file == None:
             return
+        if self._binary:
+            self.write_event(event.position()[0], event.position()[1],
+                             event.position()[2],
+                             [particle.momentum()
+                              for particle in event.particles()],
+                             event.number_photons(), event.critical_energy())
+            return
 
-        # header
-        extra = ""
-        if event.number_photons() != None:
-            extra += " %i"%event.number_photons()
-        if event.critical_energy() != None:
-            extra += " %.6e"%event.critical_energy()
-        self._file.write("%i"%event.count() +\
-                         " %.6e %.6e %.6e"%(event.position()) +\
-                         "%s\n"%extra)
-
-        # body
+        self._write_header(event.count(), event.position(),
+                           event.number_photons(), event.critical_energy())
         for particle in event.particles():
-            self._file.write("%.6e %.6e %.6e\n"%(particle.momentum()))
+            self._write("%.6e %.6e %.6e\n"%(particle.momentum()))
+
+        self._evt_count += 1
+
+
+    def write_event(self, x, y, z, momenta, num_photons=None, critical_e=None):
+        """
+        Write an event with the vertex x,y,z in metres. The momenta are an
+        array of shape (n, 3) or any sequence of (px, py, pz) triples.
+        """
+        if self._file == None:
+            return
+        if self._binary:
+            self.write_events([(x, y, z)], momenta, [0, len(momenta)],
+                              None if num_photons == None else [num_photons],
+                              None if critical_e == None else [critical_e])
+            return
 
+        self._write_header(len(momenta), (x, y, z), num_photons, critical_e)
+        self._write_momenta(momenta)
         self._evt_count += 1
 
 
+    def write_events(self, vertices, momenta, offsets,
+                     num_photons=None, critical_e=None):
+        """
+        Write a batch of events. The photons of event i are the rows
+        offsets[i] to offsets[i+1] of the momenta, such that offsets has one
+        entry more than there are vertices. The number of photons and the
+        critical energies are optional sequences with one entry per event.
+        """
+        if self._file == None:
+            return
+        if self._binary:
+            self._write(self._encoder.encode(vertices, momenta, offsets,
+                                                  num_photons, critical_e))
+            self._evt_count += len(vertices)
+            return
+
+        # events with a single photon and a complete header are
+        # formatted together
+        if (num_photons is not None) and (critical_e is not None) and \
+           (self._list(offsets) == list(range(len(vertices) + 1))):
+            self._write_single_photon_events(vertices, momenta,
+                                             num_photons, critical_e)
+            return
+
+        for i in range(len(vertices)):
+            self.write_event(vertices[i][0], vertices[i][1], vertices[i][2],
+                             momenta[offsets[i]:offsets[i+1]],
+                             None if num_photons is None else num_photons[i],
+                             None if critical_e is None else critical_e[i])
+
+
+    def count(self):
+        return self._evt_count
+
+
+    def filename(self):
+        if not self._enabled:
+            return None
+        return member_filename(self._filename, self._suffix)
+
+
+    def state(self):
+        if self._file == None:
+            return None
+        state = {'offset': self._file.checkpoint(),
+                 'evt_count': self._evt_count,
+                 'position': self._position}
+        if self._index != None:
+            state['index'] = self._index.state()
+        return state
+
+
+    def _create_encoder(self):
+        if self._binary:
+            from app.binary import BinaryEventEncoder
+            self._encoder = BinaryEventEncoder(
+                Settings()['generator']['photons'].get('precision', 'float64'))
+
+
+    def _write(self, data):
+        # the formatted text is ASCII, one character is one byte
+        self._position += len(data)
+        self._file.write(data)
+
+
+    def _write_header(self, count, position, num_photons, critical_e):
+        extra = ""
+        if num_photons != None:
+            extra += " %i"%num_photons
+        if critical_e != None:
+            extra += " %.6e"%critical_e
+        self._write("%i"%count +\
+                    " %.6e %.6e %.6e"%(tuple(position)) +\
+                    "%s\n"%extra)
+
+
+    def _write_single_photon_events(self, vertices, momenta,
+                                    num_photons, critical_e):
+        for start in range(0, len(vertices), self.CHUNK_SIZE):
+            stop = start + self.CHUNK_SIZE
+            columns = [self._list(vertices[start:stop]),
+                       self._list(num_photons[start:stop]),
+                       self._list(critical_e[start:stop]),
+                       self._list(momenta[start:stop])]
+            values = []
+            for vertex, number, energy, momentum in zip(*columns):
+                values.extend(vertex)
+                values.append(number)
+                values.append(energy)
+                values.extend(momentum)
+            self._write(("1 %.6e %.6e %.6e %i %.6e\n" \
+                         "%.6e %.6e %.6e\n"*len(columns[0]))% \
+                        tuple(values))
+            self._evt_count += len(columns[0])
+
+
+    def _list(self, values):
+        if hasattr(values, 'tolist'):
+            return values.tolist()
+        return values
+
+
+    def _write_momenta(self, momenta):
+        for start in range(0, len(momenta), self.CHUNK_SIZE):
+            chunk = momenta[start:start+self.CHUNK_SIZE]
+            if hasattr(chunk, 'tolist'):
+                chunk = chunk.tolist()
+            self._write(("%.6e %.6e %.6e\n"*len(chunk))% \
+                        tuple(itertools.chain.from_iterable(chunk)))
+
+
     def close(self):
+        if self._index != None:
+            self._index.close(self._evt_count, self._position)
+            self._index = None
         if self._file != None:
             self._file.close()
@@ -1,24 +1,49 @@
 
 from app.settings import Settings
+from app.stream import open_stream, member_filename
 
 class Output(object):
     """
-    The text file output class
+    The text file output class. The file is written through a buffered
+    stream, which is optionally compressed and written by a background thread.
+    With the format 'binary' the records are written as fixed-width binary
+    records instead of lines of text (see app.records).
     """
-    def __init__(self, name):
+    def __init__(self, name, suffix=""):
         settings = Settings()['application']['output'][name]
+        self._settings = settings
         self._enabled = settings['enabled']
         if 'nth_step' in settings:
             self._nth_step = int(settings['nth_step'])
         else:
             self._nth_step = 1
         self._filename = settings['filename']
+        self._suffix = suffix
         self._file = None
         self._calls = 0
+        self._name = name
+        self._record = None
+        if self._enabled and (settings.get('format', 'text') == 'binary'):
+            from app.records import record_struct
+            self._record = record_struct(name)
 
-    def open(self):
+    def open(self, state=None):
+        """
+        Open the output file. If a state is given, the file is continued
+        from the state stored in a checkpoint.
+        """
         if self._enabled:
-            self._file = open(self._filename, "w")
+            binary = self._record != None
+            if state == None:
+                self._file = open_stream(self._settings, suffix=self._suffix,
+                                         binary=binary)
+            else:
+                self._file = open_stream(self._settings, state['offset'],
+                                         self._suffix, binary)
+                self._calls = state['calls']
+            if binary and ((state == None) or (state['offset'] == None)):
+                from app.records import header
+                self._file.write(header(self._name))
 
     def write(self, data=[]):
         if self._file != None:
@@ -27,6 +52,29 @@ class Output(object):
                 for line in data:
                     self._file.write(line)
 
+    def write_record(self, text_format, values):
+        """
+        Write the values of a record, as a line in the text format or as a
+        binary record
+        """
+        if self._file != None:
+            self._calls += 1
+            if self._calls%self._nth_step == 0:
+                if self._record != None:
+                    self._file.write(self._record.pack(*values))
+                else:
+                    self._file.write(text_format%values)
+
+    def filename(self):
+        if not self._enabled:
+            return None
+        return member_filename(self._filename, self._suffix)
+
+    def state(self):
+        if self._file == None:
+            return None
+        return {'offset': self._file.checkpoint(), 'calls': self._calls}
+
     def close(self):
         if self._file != None:
             self._file.close()
@@ -0,0 +1,116 @@
+import sys
+import time
+import json
+
+
+class Progress(object):
+    """
+    Rate limited progress and throughput report. update() is cheap enough to
+    be called on every step, the report is only refreshed if the display
+    interval has passed. The counters (steps, radiation calls, photons and
+    events) are collected from the counters function at each report and
+    shown as rates. If a log file is given, the same metrics are appended
+    to it as one JSON object per line.
+    """
+    COUNTERS = ['steps', 'radiation_calls', 'photons', 'events']
+
+    def __init__(self, total, counters, show=True, interval=0.25,
+                 log_filename=None, log_interval=10.0):
+        self._total = total
+        self._counters = counters
+        self._show = show
+        self._interval = interval
+        self._log_filename = log_filename
+        self._log_interval = log_interval
+        self._log_file = None
+
+
+    def start(self, done=0.0):
+        self._start_time = time.monotonic()
+        self._start_done = done
+        self._start_counts = self._counters()
+        self._last_time = self._start_time
+        self._last_counts = self._start_counts
+        self._last_log_time = self._start_time
+        self._last_log_counts = self._start_counts
+        self._next = self._start_time
+        self._next_log = self._start_time + self._log_interval
+        if self._log_filename != None:
+            self._log_file = open(self._log_filename, "a")
+        self.update(done)
+
+
+    def update(self, done):
+        now = time.monotonic()
+        if now < self._next:
+            return
+        self._report(now, done, now >= self._next_log)
+
+
+    def finish(self, done):
+        self._report(time.monotonic(), done, True)
+        if self._show:
+            sys.stderr.write("\n")
+            sys.stderr.flush()
+        if self._log_file != None:
+            self._log_file.close()
+            self._log_file = None
+
+
+    def _report(self, now, done, log):
+        counts = self._counters()
+        elapsed = now - self._start_time
+        rates = self._rates(counts, now - self._last_time, self._last_counts)
+
+        # estimate the remaining time from the progress since the start
+        fraction = 1.0
+        if self._total > 0.0:
+            fraction = min(done / self._total, 1.0)
+        eta = -1.0
+        if done > self._start_done:
+            eta = max(elapsed * (self._total - done) / \
+                      (done - self._start_done), 0.0)
+
+        if self._show:
+            sys.stderr.write("\rStepping: %5.1f%% ETA %s | %.0f steps/s " \
+                             "%.0f calls/s %.3e photons/s %.0f events/s "%(
+                             100.0 * fraction, self._format_time(eta),
+                             rates['steps'], rates['radiation_calls'],
+                             rates['photons'], rates['events']))
+            sys.stderr.flush()
+
+        if log and (self._log_file != None):
+            log_rates = self._rates(counts, now - self._last_log_time,
+                                    self._last_log_counts)
+            metrics = {'time': time.time(), 'elapsed': elapsed,
+                       'fraction': fraction, 'eta': eta}
+            for name in self.COUNTERS:
+                metrics[name] = counts[name]
+                metrics[name + '_per_s'] = log_rates[name]
+            self._log_file.write(json.dumps(metrics) + "\n")
+            self._log_file.flush()
+            self._last_log_time = now
+            self._last_log_counts = counts
+            self._next_log = now + self._log_interval
+
+        self._last_time = now
+        self._last_counts = counts
+        self._next = now + self._interval
+
+
+    def _rates(self, counts, dt, last_counts):
+        rates = {}
+        for name in self.COUNTERS:
+            if dt > 0.0:
+                rates[name] = (counts[name] - last_counts[name]) / dt
+            else:
+                rates[name] = 0.0
+        return rates
+
+
+    def _format_time(self, seconds):
+        if seconds < 0.0:
+            return "--:--:--"
+        seconds = int(seconds)
+        return "%02i:%02i:%02i"%(seconds // 3600, (seconds // 60) % 60,
+                                 seconds % 60)
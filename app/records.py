@@ -0,0 +1,173 @@
+"""
+Fixed-width record outputs. The orbit, twiss and photon outputs can be
+written in a binary format instead of colon separated text, with one record
+of little-endian columns per written step. A record file starts with a
+16 byte header: the magic 'PSRRECS1', the uint32 length of the description
+and the uint32 size of a record. It is followed by the description, a JSON
+object with the name of the output and its columns as pairs of name and
+NumPy type, padded with spaces to a multiple of 8 bytes, such that the
+records are aligned.
+
+The readers return the records as NumPy structured arrays. Uncompressed
+files are memory-mapped, such that only the pages that are accessed are
+read, while compressed files are decompressed as a stream by
+iterate_records. The text outputs are read as well, their columns are
+given by the name of the output.
+"""
+import os
+import json
+import struct
+from app.stream import compression, open_read_stream
+
+RECORD_MAGIC = b"PSRRECS1"
+RECORD_HEADER = struct.Struct("<8sII")
+
+# the struct formats of the NumPy column types
+TYPES = {'<f8': 'd', '<i8': 'q'}
+
+# the columns of the outputs that can be written as records
+COLUMNS = {
+    'orbit_parameters': [('s', '<f8'), ('x', '<f8'), ('y', '<f8')],
+    'twiss_parameters': [('s', '<f8'), ('alpha_h', '<f8'),
+                         ('alpha_v', '<f8'), ('zeta_h', '<f8'),
+                         ('zeta_v', '<f8'), ('eta_h', '<f8'),
+                         ('eta_v', '<f8')],
+    'radiated_number_photons': [('s', '<f8'), ('photons', '<i8'),
+                                ('photons_cut', '<i8'), ('x', '<f8'),
+                                ('y', '<f8'), ('xp', '<f8'), ('yp', '<f8')]}
+
+
+def columns(name):
+    if name not in COLUMNS:
+        raise ValueError("The output '%s' has no record format"%name)
+    return COLUMNS[name]
+
+
+def record_struct(name):
+    """
+    Return the struct that packs a record of the output
+    """
+    return struct.Struct("<" + "".join([TYPES[column_type]
+                                        for column, column_type
+                                        in columns(name)]))
+
+
+def header(name):
+    """
+    Return the file header of a record file of the output
+    """
+    description = json.dumps({'output': name,
+                              'columns': columns(name)}).encode()
+    description += b" " * (-len(description) % 8)
+    return RECORD_HEADER.pack(RECORD_MAGIC, len(description),
+                              record_struct(name).size) + description
+
+
+def read_header(record_file):
+    """
+    Return the description and the size of the header of a record file, or
+    None if the file is not a record file. The file is read from its start,
+    the start of other files is only peeked at, such that they can be read
+    from the start.
+    """
+    data = record_file.peek(RECORD_HEADER.size)[:RECORD_HEADER.size]
+    if (len(data) < RECORD_HEADER.size) or \
+       (not data.startswith(RECORD_MAGIC)):
+        return None
+    magic, length, record_size = RECORD_HEADER.unpack(
+                                     record_file.read(RECORD_HEADER.size))
+    description = json.loads(record_file.read(length).decode())
+    description['record_size'] = record_size
+    return description, RECORD_HEADER.size + length
+
+
+def header_size(filename, compression_name=None):
+    """
+    Return the size of the header of a record file
+    """
+    with open_read_stream(filename, compression_name) as record_file:
+        result = read_header(record_file)
+    if result == None:
+        raise ValueError("%s is not a record file"%filename)
+    return result[1]
+
+
+def read_records(filename, name=None, compression_name=None):
+    """
+    Return the records of an output file as a structured array. The records
+    of an uncompressed record file are memory-mapped, compressed and text
+    files are read completely. The name of the output is only required
+    for text files.
+    """
+    import numpy as np
+    with open_read_stream(filename, compression_name) as record_file:
+        dtype, offset = describe(record_file, name)
+
+    if (offset == None) or (compression(filename, compression_name) != 'none'):
+        chunks = list(iterate_records(filename, name, compression_name))
+        if len(chunks) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.concatenate(chunks)
+
+    # a partial record at the end of a file that is still written is ignored
+    count = (os.path.getsize(filename) - offset) // dtype.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                     shape=(count,))
+
+
+def iterate_records(filename, name=None, compression_name=None,
+                    chunk_size=65536):
+    """
+    Yield the records of an output file as structured arrays of at most
+    chunk_size records. Compressed files are decompressed as a stream,
+    such that only one chunk is held in memory. The name of the output is
+    only required for text files.
+    """
+    import numpy as np
+    with open_read_stream(filename, compression_name) as record_file:
+        dtype, offset = describe(record_file, name)
+        if offset == None:
+            while True:
+                lines = record_file.readlines(chunk_size * 64)
+                if len(lines) == 0:
+                    break
+                yield np.loadtxt(lines, delimiter=':', dtype=dtype, ndmin=1)
+            return
+
+        rest = b""
+        while True:
+            data = record_file.read(chunk_size * dtype.itemsize - len(rest))
+            if len(data) == 0:
+                break
+            data = rest + data
+            count = len(data) // dtype.itemsize
+            rest = data[count * dtype.itemsize:]
+            if count > 0:
+                yield np.frombuffer(data, dtype=dtype, count=count)
+
+
+def describe(record_file, name=None):
+    """
+    Return the record type of an output file opened at its start and the
+    offset of the first record. For a text output the offset is None, the
+    columns are given by the name of the output.
+    """
+    import numpy as np
+    result = read_header(record_file)
+    if result != None:
+        description, offset = result
+        dtype = np.dtype([(str(column), str(column_type))
+                          for column, column_type in description['columns']])
+        if dtype.itemsize != description['record_size']:
+            raise ValueError("The record size %i of the output '%s' does " \
+                             "not match its columns"%(
+                             description['record_size'],
+                             description['output']))
+        return dtype, offset
+
+    if name == None:
+        raise ValueError("The name of the output is required to read a " \
+                         "text output")
+    return np.dtype(columns(name)), None
@@ -0,0 +1,378 @@
+"""
+Splitting of a run into shards along s and merging of the shard outputs.
+The shard command splits the s range of a configuration into shards of equal
+length and writes a configuration for each shard together with the state of
+the generator at the start of the shard (the handoff), which is computed by
+stepping through the lattice without creating photons. Each shard is an
+independent pysynrad job. The merge command concatenates the outputs of the
+shards in s-order and checks that no part of the s range is missing or
+duplicated.
+
+usage: pysynrad shard <config_file> -n count [-o directory] [-t template]
+                      [--run [-j jobs]]
+       pysynrad merge <plan_file> [-o directory]
+"""
+import os
+import sys
+import copy
+import json
+import math
+import pickle
+import shutil
+import argparse
+import subprocess
+import logging.config
+from app import settings
+from app.stream import member_filename, open_stream, read_stream, compression
+
+logger = logging.getLogger(__name__)
+
+PLAN_FILENAME = "plan.json"
+
+# outputs with one line per step or radiation call, starting with the s position
+S_OUTPUTS = ['orbit_parameters', 'twiss_parameters', 'radiated_number_photons']
+
+# outputs written every step, whose positions must not leave gaps
+STEP_OUTPUTS = ['orbit_parameters', 'twiss_parameters']
+
+# outputs that are the same for all shards and are taken from the first one
+SHARED_OUTPUTS = ['regions', 'spectrum_lut']
+
+
+def boundaries(start, stop, count):
+    """
+    Return the s positions between shards of equal length
+    """
+    return [start + (stop - start) * index / count for index in range(1, count)]
+
+
+def create(count, directory):
+    """
+    Split the run of the loaded settings into count shards, write the shard
+    configurations, the handoff states and the plan into the directory and
+    return the plan
+    """
+    from core.generator import Generator
+    conf = settings.Settings()
+    orbit = conf['generator']['orbit']
+    if count < 1:
+        raise ValueError("The number of shards must be at least one")
+    if math.fabs(orbit['stop'] - orbit['start']) / count <= \
+       math.fabs(orbit['step_size']):
+        raise ValueError("The shards must be longer than one step")
+
+    directory = os.path.abspath(directory)
+    os.makedirs(directory, exist_ok=True)
+    positions = [orbit['start']] + \
+                boundaries(orbit['start'], orbit['stop'], count) + \
+                [orbit['stop']]
+    handoffs = Generator().handoff(positions[1:-1])
+
+    members = [""]
+    if ('ensemble' in orbit) and orbit['ensemble']['enabled']:
+        members = ["_m%i"%i for i in range(len(orbit['ensemble']['offsets']))]
+
+    plan = {'conf_path': conf['application']['conf_path'],
+            'count': count,
+            'start': orbit['start'],
+            'stop': orbit['stop'],
+            'step_size': orbit['step_size'],
+            'members': members,
+            'outputs': copy.deepcopy(conf['application']['output']),
+            'shards': []}
+    for index in range(count):
+        handoff_filename = None
+        if index > 0:
+            handoff_filename = os.path.join(directory, "shard_%i.handoff"%index)
+            with open(handoff_filename, "wb") as handoff_file:
+                pickle.dump(handoffs[index-1], handoff_file,
+                            pickle.HIGHEST_PROTOCOL)
+
+        shard_conf = shard_settings(conf, index, count,
+                                    positions[index:index+2],
+                                    handoff_filename, directory)
+        conf_filename = os.path.join(directory, "shard_%i.conf"%index)
+        with open(conf_filename, "w") as conf_file:
+            json.dump(shard_conf, conf_file, indent=4)
+
+        plan['shards'].append({
+            'index': index,
+            'range': positions[index:index+2],
+            'config': conf_filename,
+            'handoff': handoff_filename,
+            'outputs': dict([(name, output['filename']) for name, output
+                             in shard_conf['application']['output'].items()])})
+        logger.info("Shard %i: s=%f to %f"%(index, positions[index],
+                                           positions[index+1]))
+
+    with open(os.path.join(directory, PLAN_FILENAME), "w") as plan_file:
+        json.dump(plan, plan_file, indent=4)
+    return plan
+
+
+def shard_settings(conf, index, count, s_range, handoff_filename, directory):
+    """
+    Return the settings of a shard. The output, checkpoint and progress log
+    files of the shard are placed in the directory and carry the shard suffix,
+    the lattice files are given with their absolute path.
+    """
+    conf = copy.deepcopy(conf)
+    application = conf['application']
+    conf_path = application.pop('conf_path')
+    suffix = "_s%i"%index
+
+    def shard_filename(filename):
+        return os.path.join(directory,
+                            member_filename(os.path.basename(filename), suffix))
+
+    for output in application['output'].values():
+        output['filename'] = shard_filename(output['filename'])
+    if 'checkpoint' in application:
+        application['checkpoint']['filename'] = \
+            shard_filename(application['checkpoint']['filename'])
+    if ('progress' in application) and ('log' in application['progress']):
+        application['progress']['log']['filename'] = \
+            shard_filename(application['progress']['log']['filename'])
+    application['shard'] = {'index': index,
+                            'count': count,
+                            'range': s_range,
+                            'handoff': handoff_filename}
+
+    conf['machine']['lattice'] = [os.path.join(conf_path, fname)
+                                  for fname in conf['machine']['lattice']]
+    conf['generator']['orbit']['start'] = s_range[0]
+    conf['generator']['orbit']['stop'] = s_range[1]
+    return conf
+
+
+def run(plan, jobs):
+    """
+    Run the shards of a plan as separate local processes, at most jobs
+    at a time
+    """
+    pysynrad = os.path.join(os.path.dirname(os.path.dirname(
+                            os.path.abspath(__file__))), 'pysynrad')
+    pending = list(plan['shards'])
+    running = []
+    failed = []
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < jobs:
+            shard = pending.pop(0)
+            running.append((shard, subprocess.Popen([sys.executable, pysynrad,
+                                                     shard['config']])))
+        shard, process = running.pop(0)
+        if process.wait() != 0:
+            failed.append(shard['index'])
+    if len(failed) > 0:
+        raise RuntimeError("The shards %s failed"%failed)
+
+
+def merge(plan, directory=""):
+    """
+    Merge the outputs of the shards of a plan into the output files of the
+    original configuration, which are placed relative to the directory.
+    Returns a list with the name, the number of shards, the number of lines
+    and the s range (if the output has one) and the size of each merged file.
+    """
+    report = []
+    for name, output in plan['outputs'].items():
+        if not output['enabled']:
+            continue
+        suffixes = plan['members']
+        if name in SHARED_OUTPUTS:
+            suffixes = [""]
+
+        for suffix in suffixes:
+            sources = [member_filename(shard['outputs'][name], suffix)
+                       for shard in plan['shards']]
+            missing = [source for source in sources
+                       if not os.path.exists(source)]
+            if len(missing) > 0:
+                raise RuntimeError("Missing shard outputs: %s"%
+                                   ", ".join(missing))
+            target = os.path.join(directory,
+                                  member_filename(output['filename'], suffix))
+            if os.path.dirname(target) != "":
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+
+            lines = None
+            s_range = None
+            binary = output.get('format', 'text') == 'binary'
+            if name in SHARED_OUTPUTS:
+                shutil.copyfile(sources[0], target)
+            elif (name == 'events') and binary:
+                from app.binary import FILE_HEADER
+                merge_binary(sources, target, output, FILE_HEADER.itemsize)
+            else:
+                if name in S_OUTPUTS:
+                    positions = [read_positions(source,
+                                                output.get('compression'),
+                                                binary)
+                                 for source in sources]
+                    check_positions(plan, name + suffix, positions,
+                                    output.get('nth_step', 1)
+                                    if name in STEP_OUTPUTS else None)
+                    lines = sum([len(shard) for shard in positions])
+                    s_range = (positions[0][0] if len(positions[0]) > 0 else None,
+                               positions[-1][-1] if len(positions[-1]) > 0 else None)
+                if binary:
+                    from app.records import header_size
+                    merge_binary(sources, target, output,
+                                 header_size(sources[0],
+                                             output.get('compression')))
+                else:
+                    concatenate(sources, target)
+            report.append((name + suffix, len(sources), lines, s_range,
+                           os.path.getsize(target)))
+
+            if (name == 'events') and output.get('index', False):
+                from app.events import merge_index, index_filename
+                merge_index([index_filename(source) for source in sources],
+                            index_filename(target),
+                            output.get('format', 'text') == 'binary')
+                report.append((name + suffix + " index", len(sources), None,
+                               None, os.path.getsize(index_filename(target))))
+    return report
+
+
+def read_positions(filename, compression_name=None, binary=False):
+    """
+    Return the s positions of the lines or records of a shard output
+    """
+    if binary:
+        from app.records import read_records
+        return read_records(filename,
+                            compression_name=compression_name)['s'].tolist()
+    text = read_stream(filename, compression_name).decode()
+    return [float(line.split(':', 1)[0]) for line in text.splitlines()]
+
+
+def check_positions(plan, name, positions, nth_step=None):
+    """
+    Check that the positions of each shard lie within the range of the shard
+    and that they are ordered along the run. If nth_step is given, the output
+    is written every nth_step steps and no distance between positions may
+    exceed nth_step steps, which detects missing parts of the s range.
+    """
+    # the positions are written with 6 decimals
+    tolerance = 1.0e-6
+    direction = 1.0 if plan['stop'] >= plan['start'] else -1.0
+    problems = []
+    distances = []
+    for shard, shard_positions in zip(plan['shards'], positions):
+        lower, upper = [direction * (s - plan['start']) for s in shard['range']]
+        outside = [s for s in shard_positions
+                   if not (lower - tolerance < direction * (s - plan['start'])
+                           <= upper + tolerance)]
+        if len(outside) > 0:
+            problems.append("shard %i has %i lines outside its range " \
+                            "s=%f to %f"%(shard['index'], len(outside),
+                                          shard['range'][0], shard['range'][1]))
+        distances.extend([direction * (s - plan['start'])
+                          for s in shard_positions])
+
+    for i in range(1, len(distances)):
+        if distances[i] < distances[i-1] - tolerance:
+            problems.append("the position %f is duplicated or out of order"%(
+                            plan['start'] + direction * distances[i]))
+            break
+
+    if nth_step != None:
+        gap = nth_step * math.fabs(plan['step_size']) + 2.0 * tolerance
+        total = direction * (plan['stop'] - plan['start'])
+        checkpoints = [0.0] + distances + [total]
+        for i in range(1, len(checkpoints)):
+            if checkpoints[i] - checkpoints[i-1] > gap:
+                problems.append("the range s=%f to %f is missing"%(
+                                plan['start'] + direction * checkpoints[i-1],
+                                plan['start'] + direction * checkpoints[i]))
+
+    if len(problems) > 0:
+        raise RuntimeError("The shards of %s do not cover the run: %s"%(
+                           name, "; ".join(problems)))
+
+
+def concatenate(sources, target):
+    """
+    Concatenate the files. Compressed files consist of complete frames,
+    whose concatenation is a valid compressed file.
+    """
+    with open(target, "wb") as target_file:
+        for source in sources:
+            with open(source, "rb") as source_file:
+                shutil.copyfileobj(source_file, target_file)
+
+
+def merge_binary(sources, target, output, header_size):
+    """
+    Concatenate binary event or record files, the file header is only kept
+    from the first file. Compressed files are decompressed to remove the
+    header.
+    """
+    name = compression(sources[0], output.get('compression'))
+    shutil.copyfile(sources[0], target)
+    for source in sources[1:]:
+        if name == 'none':
+            with open(target, "ab") as target_file, \
+                 open(source, "rb") as source_file:
+                source_file.seek(header_size)
+                shutil.copyfileobj(source_file, target_file)
+        else:
+            stream = open_stream(dict(output, filename=target),
+                                 offset=os.path.getsize(target), binary=True)
+            stream.write(read_stream(source, name)[header_size:])
+            stream.close()
+
+
+def shard_command(argv):
+    parser = argparse.ArgumentParser(prog='pysynrad shard',
+                                     description='Split a run into shards ' \
+                                                 'along s')
+    parser.add_argument('<config_file>', action='store',
+                        help='Path to configuration file')
+    parser.add_argument('-n', '--count', type=int, required=True,
+                        help='Number of shards')
+    parser.add_argument('-o', '--directory', default='shards',
+                        help='Directory of the shard configurations and outputs')
+    parser.add_argument('-t', '--template', action='store',
+                        help='A JSON string with template arguments for the conf')
+    parser.add_argument('--run', action='store_true',
+                        help='Run the shards as local processes and merge them')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Number of shards run at a time with --run')
+    args = vars(parser.parse_args(argv))
+
+    settings.read(args['<config_file>'], args['template'])
+    logging.config.dictConfig(settings.Settings()['application']['logging'])
+
+    plan = create(args['count'], args['directory'])
+    print("Wrote %i shards to %s"%(plan['count'],
+                                   os.path.abspath(args['directory'])))
+    if args['run']:
+        run(plan, args['jobs'])
+        print_report(merge(plan))
+
+
+def merge_command(argv):
+    parser = argparse.ArgumentParser(prog='pysynrad merge',
+                                     description='Merge the outputs of shards')
+    parser.add_argument('<plan_file>', action='store',
+                        help='Path to the plan written by the shard command')
+    parser.add_argument('-o', '--directory', default='',
+                        help='Directory of the merged outputs')
+    args = vars(parser.parse_args(argv))
+
+    with open(args['<plan_file>'], "r") as plan_file:
+        plan = json.load(plan_file)
+    print_report(merge(plan, args['directory']))
+
+
+def print_report(report):
+    print("%-32s %6s %10s %24s %12s"%("output", "shards", "lines",
+                                      "s range", "size [B]"))
+    for name, shards, lines, s_range, size in report:
+        range_text = "-"
+        if (s_range != None) and (None not in s_range):
+            range_text = "%f to %f"%s_range
+        print("%-32s %6i %10s %24s %12i"%(name, shards,
+              "-" if lines == None else "%i"%lines, range_text, size))
@@ -0,0 +1,341 @@
+import io
+import os
+import gzip
+import time
+import zlib
+import queue
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+# file extensions that select a compression codec if none is configured
+EXTENSIONS = {'.gz': 'gzip', '.zst': 'zstd', '.lz4': 'lz4'}
+
+
+class GzipCodec(object):
+    """
+    gzip compression. Every frame is a complete gzip member, concatenated
+    members are decompressed as one stream by all gzip readers.
+    """
+    def __init__(self, level=6):
+        self._level = level
+        self._compressor = None
+
+    def compress(self, data):
+        if self._compressor == None:
+            self._compressor = zlib.compressobj(self._level, zlib.DEFLATED,
+                                                16 + zlib.MAX_WBITS)
+        return self._compressor.compress(data)
+
+    def finish(self):
+        if self._compressor == None:
+            return b""
+        data = self._compressor.flush(zlib.Z_FINISH)
+        self._compressor = None
+        return data
+
+    def decompress(self, data):
+        return gzip.decompress(data)
+
+    def reader(self, filename):
+        return gzip.GzipFile(filename, mode="rb")
+
+
+class ZstdCodec(object):
+    """
+    zstd compression, requires the zstandard package
+    """
+    def __init__(self, level=3):
+        import zstandard
+        self._zstandard = zstandard
+        self._context = zstandard.ZstdCompressor(level=level)
+        self._compressor = None
+
+    def compress(self, data):
+        if self._compressor == None:
+            self._compressor = self._context.compressobj()
+        return self._compressor.compress(data)
+
+    def finish(self):
+        if self._compressor == None:
+            return b""
+        data = self._compressor.flush()
+        self._compressor = None
+        return data
+
+    def decompress(self, data):
+        reader = self._zstandard.ZstdDecompressor().stream_reader(
+                     io.BytesIO(data), read_across_frames=True)
+        return reader.read()
+
+    def reader(self, filename):
+        return self._zstandard.ZstdDecompressor().stream_reader(
+                   open(filename, "rb"), read_across_frames=True, closefd=True)
+
+
+class Lz4Codec(object):
+    """
+    lz4 frame compression, requires the lz4 package
+    """
+    def __init__(self, level=0):
+        import lz4.frame
+        self._lz4 = lz4.frame
+        self._factory = lambda: lz4.frame.LZ4FrameCompressor(
+                                    compression_level=level)
+        self._compressor = None
+
+    def compress(self, data):
+        prefix = b""
+        if self._compressor == None:
+            self._compressor = self._factory()
+            prefix = self._compressor.begin()
+        return prefix + self._compressor.compress(data)
+
+    def finish(self):
+        if self._compressor == None:
+            return b""
+        data = self._compressor.flush()
+        self._compressor = None
+        return data
+
+    def decompress(self, data):
+        result = []
+        while len(data) > 0:
+            decompressor = self._lz4.LZ4FrameDecompressor()
+            result.append(decompressor.decompress(data))
+            data = decompressor.unused_data
+        return b"".join(result)
+
+    def reader(self, filename):
+        return self._lz4.LZ4FrameFile(filename, mode="rb")
+
+
+class NullCodec(object):
+    """
+    No compression
+    """
+    def compress(self, data):
+        return data
+
+    def finish(self):
+        return b""
+
+    def decompress(self, data):
+        return data
+
+    def reader(self, filename):
+        return open(filename, "rb")
+
+
+CODECS = {'none': NullCodec, 'gzip': GzipCodec,
+          'zstd': ZstdCodec, 'lz4': Lz4Codec}
+
+
+def compression(filename, name=None):
+    """
+    Return the name of the compression codec. An explicitly configured
+    name has precedence over the file extension, a warning is logged if the
+    extension selects another codec.
+    """
+    extension = EXTENSIONS.get(os.path.splitext(filename)[1], 'none')
+    if name != None:
+        if name not in CODECS:
+            raise ValueError("Unknown compression '%s' for %s"%(name, filename))
+        if (extension != 'none') and (extension != name):
+            logger.warning("The compression '%s' configured for %s does not " \
+                           "match its extension, which selects '%s'"%(
+                           name, filename, extension))
+        return name
+    return extension
+
+
+class Stream(object):
+    """
+    Buffered output file. The written text is collected into buffers of
+    buffer_size characters. Filled buffers are encoded, compressed and written
+    either directly or, if background is enabled, by a writer thread that is
+    fed through a bounded queue of queue_size buffers. A full queue blocks the
+    caller (backpressure), the time spent blocking is reported as stall time.
+    If an offset is given, an existing file is truncated to the offset and
+    continued, which is used to resume from a checkpoint. A binary stream is
+    written with bytes instead of text.
+    """
+    def __init__(self, filename, compression_name=None, background=False,
+                 buffer_size=1048576, queue_size=8, offset=None, binary=False):
+        self._filename = filename
+        self._binary = binary
+        self._codec = CODECS[compression(filename, compression_name)]()
+        self._buffer_size = buffer_size
+        self._buffer = []
+        self._buffer_length = 0
+        self._buffers = 0
+        self._stall = 0.0
+        self._error = None
+        if offset == None:
+            self._file = open(filename, "wb")
+        else:
+            self._file = open(filename, "r+b")
+            self._file.truncate(offset)
+            self._file.seek(offset)
+
+        self._queue = None
+        self._thread = None
+        if background:
+            self._queue = queue.Queue(maxsize=queue_size)
+            self._thread = threading.Thread(target=self._run,
+                                            name="writer:%s"%filename)
+            self._thread.daemon = True
+            self._thread.start()
+
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffer_length += len(data)
+        if self._buffer_length >= self._buffer_size:
+            self._dispatch()
+
+
+    def flush(self):
+        """
+        Write all buffered data and complete the current compression frame.
+        Returns when the data has reached the file.
+        """
+        self._dispatch()
+        self._submit(None)
+        if self._queue != None:
+            self._queue.join()
+        self._check()
+
+
+    def checkpoint(self):
+        """
+        Flush the stream and return the file offset at which it can be
+        continued. Compressed streams start a new frame after a checkpoint.
+        """
+        self.flush()
+        return self._file.tell()
+
+
+    def close(self):
+        if self._file == None:
+            return
+        try:
+            self.flush()
+        finally:
+            if self._thread != None:
+                self._queue.put(False)
+                self._thread.join()
+            self._file.close()
+            self._file = None
+        logger.info("%s: %i buffers written, writer stall %.3f s"%(
+                    self._filename, self._buffers, self._stall))
+
+
+    def statistics(self):
+        return {'buffers': self._buffers, 'stall': self._stall}
+
+
+    def _dispatch(self):
+        if self._buffer_length == 0:
+            return
+        buffer = self._buffer
+        self._buffer = []
+        self._buffer_length = 0
+        self._buffers += 1
+        self._submit(buffer)
+
+
+    def _submit(self, buffer):
+        """
+        A buffer is a list of strings or bytes, None completes the
+        compression frame
+        """
+        self._check()
+        if self._queue == None:
+            self._process(buffer)
+        else:
+            start = time.perf_counter()
+            self._queue.put(buffer)
+            self._stall += time.perf_counter() - start
+
+
+    def _process(self, buffer):
+        if buffer == None:
+            self._file.write(self._codec.finish())
+            self._file.flush()
+        elif self._binary:
+            self._file.write(self._codec.compress(b"".join(buffer)))
+        else:
+            self._file.write(self._codec.compress("".join(buffer).encode()))
+
+
+    def _run(self):
+        """
+        The writer thread. After an error the queue is still drained, such
+        that the main thread never blocks on a full queue.
+        """
+        while True:
+            buffer = self._queue.get()
+            if buffer is False:
+                self._queue.task_done()
+                break
+            if self._error == None:
+                try:
+                    self._process(buffer)
+                except Exception as e:
+                    self._error = e
+            self._queue.task_done()
+
+
+    def _check(self):
+        if self._error != None:
+            raise IOError("Writing %s failed: %s"%(self._filename, self._error))
+
+
+def member_filename(filename, suffix):
+    """
+    Insert the suffix of an ensemble member in front of the extensions,
+    such that 'events.evt.gz' becomes 'events_m1.evt.gz'
+    """
+    if suffix == "":
+        return filename
+    path, name = os.path.split(filename)
+    parts = name.split('.', 1)
+    parts[0] += suffix
+    return os.path.join(path, '.'.join(parts))
+
+
+def open_stream(settings, offset=None, suffix="", binary=False):
+    """
+    Open the output stream described by the settings of an output,
+    the suffix is added to the filename of an ensemble member
+    """
+    return Stream(member_filename(settings['filename'], suffix),
+                  compression_name=settings.get('compression'),
+                  background=settings.get('background', False),
+                  buffer_size=settings.get('buffer_size', 1048576),
+                  queue_size=settings.get('queue_size', 8),
+                  offset=offset,
+                  binary=binary)
+
+
+def read_stream(filename, compression_name=None):
+    """
+    Read and decompress a complete file written by a stream
+    """
+    codec = CODECS[compression(filename, compression_name)]()
+    with open(filename, "rb") as stream_file:
+        return codec.decompress(stream_file.read())
+
+
+def open_read_stream(filename, compression_name=None):
+    """
+    Open a file written by a stream for buffered reading, compressed files
+    are decompressed while they are read
+    """
+    codec = CODECS[compression(filename, compression_name)]()
+    if isinstance(codec, NullCodec):
+        return codec.reader(filename)
+    return io.BufferedReader(codec.reader(filename))
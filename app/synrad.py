@@ -1,19 +1,43 @@
-
 import os
+import sys
+import time
 import argparse
+import importlib
 import logging.config
 from app import settings
-from core.generator import Generator
+
+# the commands with their own arguments, the module and function of each
+COMMANDS = {'shard': ('app.shard', 'shard_command'),
+            'merge': ('app.shard', 'merge_command'),
+            'daemon': ('app.daemon', 'daemon_command'),
+            'submit': ('app.client', 'submit_command')}
 
 
 def main():
+    # the commands have their own arguments
+    if (len(sys.argv) > 1) and (sys.argv[1] in COMMANDS):
+        module, function = COMMANDS[sys.argv[1]]
+        getattr(importlib.import_module(module), function)(sys.argv[2:])
+        return
+
     # parse the command line arguments
     parser = argparse.ArgumentParser(prog='pysynrad',
-                                     description='Synchrotron radiation generator')
+                                     description='Synchrotron radiation generator',
+                                     epilog='Use "pysynrad shard" and ' \
+                                            '"pysynrad merge" to split a run ' \
+                                            'into shards along s and to merge ' \
+                                            'their outputs, "pysynrad daemon" ' \
+                                            'and "pysynrad submit" to run ' \
+                                            'jobs on a resident daemon')
     parser.add_argument('<config_file>', action='store',
                         help='Path to configuration file')
     parser.add_argument('-t', '--template', action='store',
                         help='A JSON string with template arguments for the conf')
+    parser.add_argument('-r', '--resume', action='store_true',
+                        help='Resume the run from its last checkpoint')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='Validate the configuration and lattice, report ' \
+                             'the step and grid counts and estimate the runtime')
 
     args = vars(parser.parse_args())
 
@@ -23,8 +47,48 @@ def main():
     # set the global logging settings and level
     logging.config.dictConfig(settings.Settings()['application']['logging'])
 
+    # the generator is imported after the arguments have been parsed,
+    # such that the help and argument errors don't pay for its imports
+    import_start = time.perf_counter()
+    from core.generator import Generator
+    import_time = time.perf_counter() - import_start
+
+    if args['dry_run']:
+        gen = Generator()
+        report = gen.dry_run()
+        report['import_time'] = import_time
+        print_report(args['<config_file>'], report)
+        return
+
     # create a generator, initialise it and run the simulation
     gen = Generator()
-    gen.initialize()
+    gen.initialize(resume=args['resume'])
     gen.run()
     gen.terminate()
+
+
+def print_report(conf_path, report):
+    """
+    Print the result of a dry run
+    """
+    call_time = "not sampled (full events)"
+    if report['sampled_calls'] > 0:
+        call_time = "%.4f s (%i sampled calls)"%(report['call_time'],
+                                                 report['sampled_calls'])
+    lines = [("lattice layers", "%i"%report['layers']),
+             ("ensemble members", "%i"%report['members']),
+             ("steps", "%i"%report['steps']),
+             ("steps in magnets", "%i"%report['magnet_steps']),
+             ("radiation calls", "%i"%report['radiation_calls']),
+             ("grid cells per call", "%i"%report['grid_cells']),
+             ("grid cells total", "%i"%(report['grid_cells'] * \
+                                        report['radiation_calls'])),
+             ("stepping time", "%.3f s"%report['stepping_time']),
+             ("time per radiation call", call_time),
+             ("estimated runtime", "%.1f s"%report['estimated_runtime']),
+             ("not estimated", ", ".join(report['excluded'])),
+             ("generator import time", "%.3f s"%report['import_time']),
+             ("scipy imported", "%s"%('scipy' in sys.modules))]
+    print("Dry run of %s"%os.path.abspath(conf_path))
+    for name, value in lines:
+        print("  %-24s: %s"%(name, value))
@@ -0,0 +1,142 @@
+"""
+Compare the throughput and memory of the photon stage for the scalar engine
+and the vector engine in float64 and float32 precision. Each case runs the
+generator on the given configuration with only the photon outputs enabled,
+measures the run time, the peak memory of a single radiation call and the
+size of the event file, and for binary events the largest deviation of the
+event values from the float64 vector engine.
+
+usage: python -m bench.photons [<config_file>] [-s stop] [-f text|binary]
+                               [--full-events]
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app import settings
+from app.output import Output
+from app.hepevt import Hepevt
+
+CASES = [('scalar', 'float64'), ('vector', 'float64'), ('vector', 'float32')]
+
+
+def configure(args, engine, precision, directory):
+    """Read the configuration and restrict it to the photon stage"""
+    settings.read(args.config_file, None)
+    conf = settings.Settings()
+    conf['application'].pop('checkpoint', None)
+    conf['application'].pop('progress', None)
+    conf['application']['progress_bar'] = False
+    for name, output in conf['application']['output'].items():
+        output['enabled'] = name in ['radiated_number_photons', 'events']
+        output['filename'] = os.path.join(directory,
+                                          os.path.basename(output['filename']))
+    conf['application']['output']['events']['format'] = args.format
+    photons = conf['generator']['photons']
+    photons['engine'] = engine
+    photons['precision'] = precision
+    if args.full_events:
+        photons['full_events'] = True
+    if args.stop != None:
+        conf['generator']['orbit']['stop'] = args.stop
+
+
+def call_memory(gen):
+    """Peak memory of one radiation call on the last step of the run"""
+    conf = settings.Settings()['generator']
+    dl = conf['photons']['nth_step'] * conf['orbit']['step_size']
+    output = Output('radiated_number_photons')
+    hepevt = Hepevt()
+    tracemalloc.start()
+    gen.radiate(dl, output, hepevt)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def deviations(reference, candidate):
+    """Largest relative deviation of the binary event values"""
+    import numpy as np
+    from app.binary import read_events
+    values = []
+    for filename in [reference, candidate]:
+        rows = []
+        for vertex, momenta, num_photons, critical_e in read_events(filename):
+            rows.append(list(vertex) + list(momenta[0]) + \
+                        [critical_e if critical_e != None else 0.0])
+        values.append(np.array(rows))
+    if values[0].shape != values[1].shape:
+        return None
+    scale = np.where(values[0] != 0.0, np.fabs(values[0]), 1.0)
+    return np.max(np.fabs(values[0] - values[1]) / scale)
+
+
+def run_case(args, engine, precision):
+    directory = tempfile.mkdtemp(prefix='bench_photons_')
+    configure(args, engine, precision, directory)
+    from core.generator import Generator
+    gen = Generator()
+    gen.initialize()
+    start = time.perf_counter()
+    gen.run()
+    run_time = time.perf_counter() - start
+    statistics = gen.statistics()
+    gen.terminate()
+    memory = call_memory(gen)
+    events = settings.Settings()['application']['output']['events']['filename']
+    return {'directory': directory, 'events': events, 'time': run_time,
+            'statistics': statistics, 'memory': memory,
+            'size': os.path.getsize(events)}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench.photons')
+    parser.add_argument('config_file', nargs='?',
+                        default=os.path.join(ROOT, 'data', 'SuperKEKB_LER.conf'))
+    parser.add_argument('-s', '--stop', type=float, default=None,
+                        help='Override the stop position of the orbit')
+    parser.add_argument('-f', '--format', choices=['text', 'binary'],
+                        default='binary')
+    parser.add_argument('--full-events', action='store_true')
+    args = parser.parse_args()
+
+    results = {}
+    try:
+        for engine, precision in CASES:
+            results[(engine, precision)] = run_case(args, engine, precision)
+
+        print("%-16s %9s %10s %12s %10s %12s %10s"%("case", "time [s]",
+              "calls/s", "photons/s", "events", "file [MB]", "call [MB]"))
+        for engine, precision in CASES:
+            result = results[(engine, precision)]
+            statistics = result['statistics']
+            print("%-16s %9.2f %10.1f %12.3e %10i %12.2f %10.2f"%(
+                  "%s %s"%(engine, precision), result['time'],
+                  statistics['radiation_calls'] / result['time'],
+                  statistics['photons'] / result['time'],
+                  statistics['events'], result['size'] / 1.0e6,
+                  result['memory'] / 1.0e6))
+
+        if args.format == 'binary':
+            reference = results[('vector', 'float64')]['events']
+            deviation = deviations(reference,
+                                   results[('vector', 'float32')]['events'])
+            if deviation == None:
+                print("float32: the events differ from float64 in number")
+            else:
+                print("float32: max relative deviation of vertex, direction " \
+                      "and critical energy %.2e"%deviation)
+    finally:
+        for result in results.values():
+            shutil.rmtree(result['directory'], ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
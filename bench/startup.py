@@ -0,0 +1,58 @@
+"""
+Measure the start-up cost of pysynrad: the import time of the main modules
+and the wall time of short command line invocations, each in a fresh
+interpreter.
+
+usage: python -m bench.startup [<config_file>] [-r repeats]
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PYSYNRAD = os.path.join(ROOT, 'pysynrad')
+
+
+def measure(command, repeats):
+    """Run the command repeatedly and return the wall times in seconds"""
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=ROOT, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench.startup')
+    parser.add_argument('config_file', nargs='?',
+                        default=os.path.join(ROOT, 'data', 'SuperKEKB_LER.conf'))
+    parser.add_argument('-r', '--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    cases = [("interpreter", [sys.executable, '-c', 'pass']),
+             ("import app.synrad", [sys.executable, '-c', 'import app.synrad']),
+             ("import core.generator",
+              [sys.executable, '-c', 'import core.generator']),
+             ("import core.spectrum",
+              [sys.executable, '-c', 'import core.spectrum']),
+             ("pysynrad --help", [sys.executable, PYSYNRAD, '--help'])]
+    if os.path.exists(args.config_file):
+        cases.append(("pysynrad --dry-run", [sys.executable, PYSYNRAD,
+                                             args.config_file, '--dry-run']))
+
+    print("%-24s %10s %10s"%("case", "mean [s]", "min [s]"))
+    for name, command in cases:
+        try:
+            times = measure(command, args.repeats)
+        except subprocess.CalledProcessError:
+            print("%-24s %10s %10s"%(name, "failed", ""))
+            continue
+        print("%-24s %10.3f %10.3f"%(name, sum(times) / len(times), min(times)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,510 @@
+"""
+Differential validation of the candidate engines against the scalar
+reference. The reference (euler orbit, scalar float64 photons, uniform
+spectrum) and each candidate run on the same synthetic lattices with full
+events. The orbit and twiss tracks, the photon totals of each radiation
+call, the event vertices and photon directions are compared value by value.
+The candidates draw the photon energies from the same random streams as the
+reference, which is why their energies are tested against an independent
+sample instead, a second reference run with another spectrum seed, with a
+two-sample Kolmogorov-Smirnov test.
+The table shows the speedup of each candidate next to its deviations.
+
+    orbit      max |dx|, |dy| of the orbit track [m]
+    twiss      max deviation of each twiss column, relative to its range
+    photons    max deviation of the photon totals, relative to the total
+    vertex     max distance of the event vertices [m]
+    direction  max angle between the photon directions [rad]
+    ks         p-value of the photon energies against the independent sample,
+               passes if above the tolerance
+
+Vertices and directions are only compared if the candidate writes the same
+events with the same number of photons, otherwise they are shown as n/a.
+
+The exact orbit engine is compared against a converged reference, an euler
+run with a hundredth of the step size. Its tracks are interpolated at the
+positions of the candidate and the photons are compared by their total, as
+the radiation calls of the two runs differ. The euler steps share one
+curvature between the layers of a lattice (model/step.py), which is why the
+euler run only converges to the exact solution on the lattices with a
+single layer and the exact engine is not validated on 'mixed'.
+The time of the shards candidate is the stepping pass of the handoff, the
+longest shard and the merge, which is the wall time of a run with one
+process per shard.
+
+usage: python -m bench.validate [<config_file>] [-c candidate ...]
+                                [-l lattice ...] [-t name=value ...] [-k]
+"""
+import os
+import sys
+import copy
+import json
+import math
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+from app import settings
+from app.stream import member_filename, read_stream
+
+LATTICES = ['bends', 'quadrupoles', 'mixed']
+
+TOLERANCES = {'orbit': 1.0e-12,
+              'twiss': 1.0e-9,
+              'photons': 1.0e-9,
+              'vertex': 1.0e-9,
+              'direction': 1.0e-6,
+              'ks': 0.01}
+
+CHECKS = ['orbit', 'twiss', 'photons', 'vertex', 'direction', 'ks']
+
+
+def configure_vector(conf):
+    conf['generator']['photons']['engine'] = 'vector'
+
+
+def configure_float32(conf):
+    conf['generator']['photons']['engine'] = 'vector'
+    conf['generator']['photons']['precision'] = 'float32'
+    conf['application']['output']['events']['format'] = 'binary'
+
+
+def configure_adaptive(conf):
+    conf['generator']['photons']['spectrum']['layout'] = 'adaptive'
+
+
+def configure_ensemble(conf):
+    orbit = conf['generator']['orbit']
+    orbit['ensemble'] = {'enabled': True, 'offsets': [orbit['offset']]}
+
+
+def configure_exact(conf):
+    conf['generator']['orbit']['engine'] = 'exact'
+
+
+def configure_converged(conf):
+    """The euler reference with 100 steps per step of the candidate"""
+    conf['generator']['orbit']['step_size'] /= 100.0
+    conf['generator']['photons']['nth_step'] *= 100
+
+
+# the candidate engines, the tolerances of a candidate replace the defaults,
+# a candidate with a reference is compared against the reference configured
+# by it and is only run on its lattices
+CANDIDATES = {
+    'vector': {'configure': configure_vector},
+    'float32': {'configure': configure_float32,
+                'tolerance': {'photons': 1.0e-3, 'vertex': 1.0e-6}},
+    'adaptive': {'configure': configure_adaptive},
+    'ensemble': {'configure': configure_ensemble, 'suffix': '_m0'},
+    'shards': {'shards': 3},
+    'exact': {'configure': configure_exact,
+              'reference': configure_converged,
+              'lattices': ['bends', 'quadrupoles'],
+              'tolerance': {'orbit': 1.0e-6, 'twiss': 1.0e-3,
+                            'photons': 1.0e-2}}}
+
+DEFAULT_CANDIDATES = ['vector', 'float32', 'adaptive', 'ensemble', 'shards']
+
+
+def synthetic_lattice(kind, directory, seed):
+    """
+    Write the layers of a synthetic lattice between s=-2.9 and -0.3 and
+    return their filenames. 'bends' only has dipoles, 'quadrupoles' adds
+    displaced quadrupoles and 'mixed' adds rolled magnets and a second layer
+    with skew fields.
+    """
+    rng = random.Random("%s-%i"%(kind, seed))
+
+    def bend(rng):
+        return ('BND', rng.choice([-1.0, 1.0]) * rng.uniform(2.0e-4, 1.5e-3),
+                0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+
+    def quadrupole(rng):
+        return ('QUA', rng.uniform(-3.0e-4, 3.0e-4),
+                rng.choice([-1.0, 1.0]) * rng.uniform(1.0e-2, 5.0e-2),
+                0.0, 0.0, 0.0, rng.uniform(-1.0e-4, 1.0e-4),
+                rng.uniform(-1.0e-5, 1.0e-5))
+
+    def rolled(rng):
+        values = list(quadrupole(rng))
+        values[5] = rng.uniform(-2.0e-3, 2.0e-3)
+        return tuple(values)
+
+    def skew(rng):
+        return ('SKW', 0.0, 0.0, rng.uniform(-2.0e-4, 2.0e-4),
+                rng.uniform(-1.0e-4, 1.0e-4), 0.0, 0.0, 0.0)
+
+    kinds = {'bends': [[bend]],
+             'quadrupoles': [[bend, quadrupole]],
+             'mixed': [[bend, quadrupole, rolled], [skew]]}
+    if kind not in kinds:
+        raise ValueError("Unknown synthetic lattice '%s'"%kind)
+
+    filenames = []
+    for index, magnets in enumerate(kinds[kind]):
+        lines = []
+        position = -2.9
+        while position < -0.3:
+            values = rng.choice(magnets)(rng)
+            for i in range(rng.randint(1, 4)):
+                lines.append("%s %.9f %.9f %e %e %e %e %e %e %e\n"%(
+                             (values[0], position, 0.1) + values[1:]))
+                position = round(position + 0.1, 9)
+            position = round(position + 0.1 * rng.randint(1, 3), 9)
+        filename = os.path.join(directory, "%s_%i.lattice"%(kind, index))
+        with open(filename, "w") as lattice_file:
+            lattice_file.writelines(lines)
+        filenames.append(filename)
+    return filenames
+
+
+def base_settings(config_file, lattice):
+    """
+    The settings of the reference run on a synthetic lattice, the machine
+    and twiss parameters are taken from the configuration file
+    """
+    settings.read(config_file, None)
+    conf = copy.deepcopy(dict(settings.Settings()))
+    conf['application'].pop('conf_path')
+    conf['application'].pop('checkpoint', None)
+    conf['application']['progress'] = {'enabled': False}
+    conf['machine']['lattice'] = lattice
+
+    orbit = conf['generator']['orbit']
+    orbit.update({'start': 0.0, 'stop': -3.0, 'step_size': -0.001,
+                  'engine': 'euler',
+                  'offset': {'position': 1.0e-4, 'angle': 0.0}})
+    orbit.pop('ensemble', None)
+
+    photons = conf['generator']['photons']
+    # the short time keeps the number of photons of the full events
+    # at a few ten thousands
+    photons.update({'enabled': True, 'full_events': True, 'nth_step': 10,
+                    'engine': 'scalar', 'precision': 'float64',
+                    'time': 2.0e-14,
+                    'steps': {'horizontal': 20, 'vertical': 20}})
+    photons['region']['enabled'] = False
+    photons.pop('compaction', None)
+    photons['spectrum'].update({'resolution': 10000, 'layout': 'uniform'})
+
+    for name, output in conf['application']['output'].items():
+        output['enabled'] = name in ['orbit_parameters', 'twiss_parameters',
+                                     'radiated_number_photons', 'events']
+        output['nth_step'] = 1
+        output['compression'] = 'none'
+        output['background'] = False
+    conf['application']['output']['events']['format'] = 'text'
+    return conf
+
+
+def run_generator(conf, directory):
+    """
+    Run the generator on the settings, the outputs are written into the
+    directory. Returns the wall time of the run.
+    """
+    from core.generator import Generator
+    conf = copy.deepcopy(conf)
+    for output in conf['application']['output'].values():
+        output['filename'] = os.path.join(directory,
+                                          os.path.basename(output['filename']))
+    conf_filename = os.path.join(directory, "run.conf")
+    with open(conf_filename, "w") as conf_file:
+        json.dump(conf, conf_file, indent=4)
+
+    settings.read(conf_filename, None)
+    start = time.perf_counter()
+    gen = Generator()
+    gen.initialize()
+    gen.run()
+    gen.terminate()
+    return time.perf_counter() - start
+
+
+def run_shards(conf, directory, count):
+    """
+    Split the run into shards, run them one after the other and merge
+    their outputs into the directory. Returns the wall time of a run with
+    one process per shard.
+    """
+    from app import shard
+    conf = copy.deepcopy(conf)
+    for output in conf['application']['output'].values():
+        output['filename'] = os.path.join(directory,
+                                          os.path.basename(output['filename']))
+    conf_filename = os.path.join(directory, "run.conf")
+    with open(conf_filename, "w") as conf_file:
+        json.dump(conf, conf_file, indent=4)
+
+    settings.read(conf_filename, None)
+    start = time.perf_counter()
+    plan = shard.create(count, os.path.join(directory, "shards"))
+    serial_time = time.perf_counter() - start
+
+    shard_times = []
+    for part in plan['shards']:
+        with open(part['config'], "r") as conf_file:
+            shard_conf = json.load(conf_file)
+        shard_directory = os.path.dirname(part['config'])
+        shard_times.append(run_generator(shard_conf, shard_directory))
+
+    start = time.perf_counter()
+    shard.merge(plan)
+    serial_time += time.perf_counter() - start
+    return serial_time + max(shard_times)
+
+
+def read_track(filename):
+    """Return the columns of an orbit, twiss or photon output"""
+    rows = [[float(value) for value in line.split(':')]
+            for line in read_stream(filename).decode().splitlines()]
+    if len(rows) == 0:
+        return np.zeros((0, 7))
+    return np.array(rows)
+
+
+def read_events(filename, binary):
+    """
+    Return the vertices, the number of photons of each event and the
+    momenta of all photons of an event file
+    """
+    vertices = []
+    counts = []
+    momenta = []
+    if binary:
+        from app import binary as binary_events
+        for vertex, event_momenta, num_photons, critical_e in \
+            binary_events.read_events(filename):
+            vertices.append(vertex)
+            counts.append(len(event_momenta))
+            momenta.extend(event_momenta.tolist())
+    else:
+        lines = read_stream(filename).decode().splitlines()
+        i = 0
+        while i < len(lines):
+            tokens = lines[i].split()
+            count = int(tokens[0])
+            vertices.append([float(value) for value in tokens[1:4]])
+            counts.append(count)
+            momenta.extend([[float(value) for value in line.split()]
+                            for line in lines[i+1:i+1+count]])
+            i += 1 + count
+    return (np.array(vertices).reshape(-1, 3), np.array(counts, dtype=np.int64),
+            np.array(momenta).reshape(-1, 3))
+
+
+def compare(reference, candidate, sample, converged=False):
+    """
+    Compare the outputs of the reference and a candidate run, the outputs
+    are given as dictionaries with the filenames and the event format. The
+    photon energies are tested against the independent sample of energies.
+    The tracks of a converged reference are interpolated at the positions
+    of the candidate and only the photon totals of the runs are compared.
+    Returns the deviation of each check, None if a check is not applicable.
+    """
+    from scipy import stats
+    result = {}
+
+    def track_deviation(name, columns, relative):
+        a = read_track(reference[name])
+        b = read_track(candidate[name])
+        if converged:
+            # the positions of the candidate within the reference track
+            a = a[np.argsort(a[:, 0])]
+            b = b[(b[:, 0] >= a[0, 0]) & (b[:, 0] <= a[-1, 0])]
+            a = np.column_stack([np.interp(b[:, 0], a[:, 0], a[:, column])
+                                 for column in range(a.shape[1])])
+        if (a.shape != b.shape) or np.any(np.fabs(a[:, 0] - b[:, 0]) > 1.0e-6):
+            return math.inf
+        deviation = 0.0
+        for column in columns:
+            scale = 1.0
+            if relative:
+                scale = max(np.max(np.fabs(a[:, column]), initial=0.0),
+                            1.0e-300)
+            deviation = max(deviation,
+                            np.max(np.fabs(a[:, column] - b[:, column]),
+                                   initial=0.0) / scale)
+        return deviation
+
+    result['orbit'] = track_deviation('orbit_parameters', [1, 2], False)
+    result['twiss'] = track_deviation('twiss_parameters', range(1, 7), True)
+    if converged:
+        a = read_track(reference['radiated_number_photons'])[:, 1].sum()
+        b = read_track(candidate['radiated_number_photons'])[:, 1].sum()
+        result['photons'] = math.fabs(a - b) / max(a, 1.0)
+    else:
+        result['photons'] = track_deviation('radiated_number_photons', [1],
+                                            True)
+
+    ref_vertices, ref_counts, ref_momenta = read_events(reference['events'],
+                                                        reference['binary'])
+    vertices, counts, momenta = read_events(candidate['events'],
+                                            candidate['binary'])
+    result['vertex'] = None
+    result['direction'] = None
+    if (not converged) and (ref_counts.shape == counts.shape) and \
+       np.all(ref_counts == counts):
+        result['vertex'] = np.max(np.linalg.norm(ref_vertices - vertices,
+                                                 axis=1), initial=0.0)
+        # the angle from the chord of the unit directions is accurate
+        # for small angles, unlike the arc cosine of the dot product
+        chord = np.linalg.norm(
+            ref_momenta / np.linalg.norm(ref_momenta, axis=1).reshape(-1, 1) -
+            momenta / np.linalg.norm(momenta, axis=1).reshape(-1, 1), axis=1)
+        result['direction'] = np.max(2.0 * np.arcsin(np.minimum(0.5 * chord,
+                                                                1.0)),
+                                     initial=0.0)
+
+    result['ks'] = stats.ks_2samp(sample,
+                                  np.linalg.norm(momenta, axis=1)).pvalue
+    return result
+
+
+def outputs(conf, directory, suffix=""):
+    """The filenames of the compared outputs of a run in the directory"""
+    files = {'binary': conf['application']['output']['events']['format'] == \
+                       'binary'}
+    for name in ['orbit_parameters', 'twiss_parameters',
+                 'radiated_number_photons', 'events']:
+        filename = conf['application']['output'][name]['filename']
+        files[name] = member_filename(os.path.join(directory,
+                                      os.path.basename(filename)), suffix)
+    return files
+
+
+def passed(name, value, tolerance):
+    if value == None:
+        return True
+    if name == 'ks':
+        return value >= tolerance
+    return value <= tolerance
+
+
+def parse_tolerances(values):
+    tolerances = {}
+    for value in values:
+        name, number = value.split('=', 1)
+        if name not in TOLERANCES:
+            raise ValueError("Unknown tolerance '%s'"%name)
+        tolerances[name] = float(number)
+    return tolerances
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench.validate')
+    parser.add_argument('config_file', nargs='?',
+                        default=os.path.join(ROOT, 'data', 'SuperKEKB_LER.conf'),
+                        help='Configuration with the machine and twiss ' \
+                             'parameters')
+    parser.add_argument('-c', '--candidate', action='append',
+                        choices=sorted(CANDIDATES.keys()),
+                        help='Candidate engine, all but exact by default')
+    parser.add_argument('-l', '--lattice', action='append', choices=LATTICES,
+                        help='Synthetic lattice, all by default')
+    parser.add_argument('-t', '--tolerance', action='append', default=[],
+                        help='Tolerance as name=value, replaces the ' \
+                             'tolerance of all candidates')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-k', '--keep', action='store_true',
+                        help='Keep the directory with the outputs')
+    args = parser.parse_args()
+
+    candidates = args.candidate or DEFAULT_CANDIDATES
+    lattices = args.lattice or LATTICES
+    overrides = parse_tolerances(args.tolerance)
+    directory = tempfile.mkdtemp(prefix='bench_validate_')
+
+    rows = []
+    failures = 0
+    try:
+        for lattice in lattices:
+            lattice_directory = os.path.join(directory, lattice)
+            os.makedirs(lattice_directory)
+            conf = base_settings(args.config_file,
+                                 synthetic_lattice(lattice, lattice_directory,
+                                                   args.seed))
+
+            reference_directory = os.path.join(lattice_directory, 'reference')
+            os.makedirs(reference_directory)
+            reference_time = run_generator(conf, reference_directory)
+            reference = outputs(conf, reference_directory)
+
+            # the independent sample of photon energies
+            sample_conf = copy.deepcopy(conf)
+            sample_conf['generator']['photons']['spectrum']['seed'] += 1
+            sample_directory = os.path.join(lattice_directory, 'sample')
+            os.makedirs(sample_directory)
+            run_generator(sample_conf, sample_directory)
+            sample_momenta = read_events(
+                                 outputs(sample_conf, sample_directory)['events'],
+                                 False)[2]
+            sample = np.linalg.norm(sample_momenta, axis=1)
+
+            for name in candidates:
+                candidate = CANDIDATES[name]
+                if lattice not in candidate.get('lattices', LATTICES):
+                    continue
+                candidate_conf = copy.deepcopy(conf)
+                if 'configure' in candidate:
+                    candidate['configure'](candidate_conf)
+                candidate_directory = os.path.join(lattice_directory, name)
+                os.makedirs(candidate_directory)
+                if 'shards' in candidate:
+                    candidate_time = run_shards(candidate_conf,
+                                                candidate_directory,
+                                                candidate['shards'])
+                else:
+                    candidate_time = run_generator(candidate_conf,
+                                                   candidate_directory)
+
+                tolerances = dict(TOLERANCES)
+                tolerances.update(candidate.get('tolerance', {}))
+                tolerances.update(overrides)
+                candidate_reference = reference
+                if 'reference' in candidate:
+                    converged_conf = copy.deepcopy(conf)
+                    candidate['reference'](converged_conf)
+                    converged_directory = os.path.join(lattice_directory,
+                                                       'reference_' + name)
+                    os.makedirs(converged_directory)
+                    run_generator(converged_conf, converged_directory)
+                    candidate_reference = outputs(converged_conf,
+                                                  converged_directory)
+                deviations = compare(candidate_reference,
+                                     outputs(candidate_conf, candidate_directory,
+                                             candidate.get('suffix', "")),
+                                     sample, 'reference' in candidate)
+                ok = all([passed(check, deviations[check], tolerances[check])
+                          for check in CHECKS])
+                if not ok:
+                    failures += 1
+                rows.append((lattice, name, reference_time, candidate_time,
+                             deviations, ok))
+    finally:
+        if args.keep:
+            print("Outputs kept in %s"%directory)
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    print("%-12s %-9s %8s %8s %8s %9s %9s %9s %9s %9s %9s %6s"%(
+          "lattice", "candidate", "ref [s]", "cand [s]", "speedup",
+          "orbit", "twiss", "photons", "vertex", "direction", "ks", "result"))
+    for lattice, name, reference_time, candidate_time, deviations, ok in rows:
+        values = ["n/a" if deviations[check] == None else
+                  "%9.2e"%deviations[check] for check in CHECKS]
+        print("%-12s %-9s %8.2f %8.2f %8.2f %9s %9s %9s %9s %9s %9s %6s"%(
+              (lattice, name, reference_time, candidate_time,
+               reference_time / candidate_time) + tuple(values) + \
+              ("pass" if ok else "FAIL",)))
+    sys.exit(1 if failures > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
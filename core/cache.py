@@ -0,0 +1,87 @@
+import os
+import logging
+import collections
+from core.lattice import Lattice
+
+logger = logging.getLogger(__name__)
+
+
+class LRU(object):
+    """
+    A dictionary of at most size entries, which evicts the least recently
+    used entry when it is full
+    """
+    def __init__(self, size):
+        self._size = size
+        self._items = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+
+    def get(self, key, create):
+        """
+        Return the entry of the key, a missing entry is created by calling
+        create and stored
+        """
+        if key in self._items:
+            self._items.move_to_end(key)
+            self._hits += 1
+            return self._items[key]
+
+        self._misses += 1
+        value = create()
+        self._items[key] = value
+        if len(self._items) > self._size:
+            self._items.popitem(last=False)
+            self._evictions += 1
+        return value
+
+
+    def statistics(self):
+        return {'entries': len(self._items),
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions}
+
+
+
+class Cache(object):
+    """
+    Keeps loaded lattices and spectra resident between runs of the generator
+    in the same process. A lattice is identified by the path, the modification
+    time and the size of its files, such that an edited lattice file is
+    loaded again. A spectrum is identified by its settings. A spectrum
+    reseeds its random numbers at every radiation call, which makes it safe
+    to share between runs, but not between runs in different threads.
+    """
+    def __init__(self, lattices=4, spectra=4):
+        self._lattices = LRU(lattices)
+        self._spectra = LRU(spectra)
+
+
+    def lattice(self, filenames, window=None):
+        def load():
+            logger.info("Loading lattice %s"%", ".join(filenames))
+            lattice = Lattice()
+            lattice.load(filenames, window)
+            return lattice
+        key = tuple([(os.path.abspath(filename), os.path.getmtime(filename),
+                      os.path.getsize(filename)) for filename in filenames])
+        return self._lattices.get((key, window), load)
+
+
+    def spectrum(self, settings):
+        def create():
+            from core.spectrum import create_spectrum
+            logger.info("Creating spectrum with resolution %i"%
+                        settings['resolution'])
+            return create_spectrum(settings)
+        key = (settings['resolution'], settings['cutoff'], settings['seed'],
+               settings['interpolation'], settings.get('layout', 'uniform'))
+        return self._spectra.get(key, create)
+
+
+    def statistics(self):
+        return {'lattices': self._lattices.statistics(),
+                'spectra': self._spectra.statistics()}
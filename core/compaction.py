@@ -0,0 +1,137 @@
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class Compactor(object):
+    """
+    Merges the photon sources of a radiation call whose vertex, direction
+    and critical energy fall into the same tolerance bin into one event.
+    The bins have the width of the vertex tolerance [m] in each coordinate,
+    of the direction tolerance in each component of the unit direction and
+    of the relative critical energy tolerance in the logarithm of the
+    critical energy. The merged event carries the summed number of photons
+    and the photon weighted mean of the vertex, direction and critical energy.
+    """
+    def __init__(self, vertex, direction, critical_energy):
+        self._tolerance = np.array([vertex, vertex, vertex,
+                                    direction, direction, direction,
+                                    critical_energy])
+        self._sources = []
+        self._source_count = 0
+        self._event_count = 0
+        self._max_vertex = 0.0
+        self._max_direction = 0.0
+        self._max_critical_energy = 0.0
+
+
+    def add(self, x, y, z, px, py, pz, num_photons, critical_e):
+        """
+        Add a source with the vertex x,y,z in metres and the unit direction
+        px,py,pz
+        """
+        self._sources.append((x, y, z, px, py, pz, critical_e, num_photons))
+
+
+    def flush(self, hepevt):
+        """
+        Merge the sources added since the last flush and write the events
+        in the order of their first source
+        """
+        if len(self._sources) == 0:
+            return
+        sources = np.array(self._sources)
+        self._sources = []
+
+        # bin the sources, the critical energy is binned logarithmically
+        coordinates = sources[:, :7].copy()
+        coordinates[:, 6] = np.log(coordinates[:, 6])
+        keys = np.floor(coordinates / self._tolerance).astype(np.int64)
+        _, first, inverse = np.unique(keys, axis=0, return_index=True,
+                                      return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        # renumber the bins in the order of their first source
+        order = np.argsort(first)
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        group = rank[inverse]
+
+        # photon weighted means
+        weights = sources[:, 7]
+        num_photons = np.bincount(group, weights=weights)
+        means = np.empty((len(order), 7))
+        for i in range(7):
+            means[:, i] = np.bincount(group, weights=weights * sources[:, i]) / \
+                          num_photons
+        directions = means[:, 3:6] / \
+                     np.linalg.norm(means[:, 3:6], axis=1).reshape(-1, 1)
+
+        # deviation of each source from its event
+        vertex_dev = np.linalg.norm(sources[:, 0:3] - means[group, 0:3], axis=1)
+        chord = np.linalg.norm(sources[:, 3:6] - directions[group], axis=1)
+        direction_dev = 2.0 * np.arcsin(np.minimum(0.5 * chord, 1.0))
+        energy_dev = np.fabs(sources[:, 6] - means[group, 6]) / sources[:, 6]
+        self._max_vertex = max(self._max_vertex, vertex_dev.max())
+        self._max_direction = max(self._max_direction, direction_dev.max())
+        self._max_critical_energy = max(self._max_critical_energy,
+                                        energy_dev.max())
+
+        hepevt.write_events(means[:, 0:3], directions,
+                            np.arange(len(order) + 1),
+                            num_photons=num_photons.round().astype(np.int64),
+                            critical_e=means[:, 6])
+        self._source_count += len(sources)
+        self._event_count += len(order)
+
+
+    def statistics(self):
+        ratio = 1.0
+        if self._event_count > 0:
+            ratio = self._source_count / self._event_count
+        return {'sources': self._source_count,
+                'events': self._event_count,
+                'ratio': ratio,
+                'max_vertex_deviation': self._max_vertex,
+                'max_direction_deviation': self._max_direction,
+                'max_critical_energy_deviation': self._max_critical_energy}
+
+
+    def report(self):
+        statistics = self.statistics()
+        logger.info("Compaction merged %i sources into %i events " \
+                    "(ratio %.2f), max deviation: vertex %e m, direction " \
+                    "%e rad, critical energy %e (relative)"%(
+                    statistics['sources'], statistics['events'],
+                    statistics['ratio'], statistics['max_vertex_deviation'],
+                    statistics['max_direction_deviation'],
+                    statistics['max_critical_energy_deviation']))
+
+
+    def state(self):
+        return {'source_count': self._source_count,
+                'event_count': self._event_count,
+                'max_vertex': self._max_vertex,
+                'max_direction': self._max_direction,
+                'max_critical_energy': self._max_critical_energy}
+
+
+    def merge(self, state):
+        """
+        Add the statistics of another compactor
+        """
+        self._source_count += state['source_count']
+        self._event_count += state['event_count']
+        self._max_vertex = max(self._max_vertex, state['max_vertex'])
+        self._max_direction = max(self._max_direction, state['max_direction'])
+        self._max_critical_energy = max(self._max_critical_energy,
+                                        state['max_critical_energy'])
+
+
+    def restore(self, state):
+        self._source_count = state['source_count']
+        self._event_count = state['event_count']
+        self._max_vertex = state['max_vertex']
+        self._max_direction = state['max_direction']
+        self._max_critical_energy = state['max_critical_energy']
@@ -0,0 +1,27 @@
+import numpy as np
+from core.orbit import Orbit
+from model.ensemble import EnsembleStep, EnsembleBeam
+
+
+class EnsembleOrbit(Orbit):
+    """
+    Steps the actual orbits of an ensemble with different initial offsets at
+    once. The ideal orbit, the lattice lookups and the region boundary handling
+    are shared, Orbit.step_actual_orbit is carried out on the NumPy arrays of
+    the ensemble step. Twiss.evolve works on the arrays of the ensemble beam
+    without changes.
+    """
+    _sin = staticmethod(np.sin)
+    _cos = staticmethod(np.cos)
+
+    def create_ensemble(self, offsets, twiss):
+        """
+        Create the ensemble step and beam for the given list of offsets
+        """
+        steps = [self.create_step(offset) for offset in offsets]
+        beams = [twiss.create_beam() for offset in offsets]
+        return EnsembleStep(self._lattice, steps), EnsembleBeam(beams)
+
+
+    def _zeros(self, step):
+        return np.zeros(step.size())
@@ -1,113 +1,621 @@
 import os
+import copy
 import math
+import time
+import pickle
 import logging.config
-from progressbar import ProgressBar, Bar, Percentage, ETA
 from app.settings import Settings
 from app.output import Output
+from app.progress import Progress
 from app.hepevt import Hepevt
-from core.lattice import Lattice
+from core.lattice import Lattice, window
 from core.orbit import Orbit
 from core.twiss import Twiss
+from core.transport import Transport
 from core.photons import Photons
+from model.member import Member
 
 logger = logging.getLogger(__name__)
 
 
 class Generator():
     """
-    The main Synchrotron Radiation generator.
+    The main Synchrotron Radiation generator. If a cache is given, the
+    lattice and the spectrum are taken from it instead of being loaded
+    for every run.
     """
-    def __init__(self):
+    def __init__(self, cache=None):
+        self._cache = cache
         self._lattice = Lattice()
         self._orbit = Orbit()
         self._twiss = Twiss()
-        self._photons = Photons()
+        self._transport = Transport()
+        self._members = []
+        self._pipeline = None
 
 
-    def initialize(self):
-        # get settings
-        self._start = Settings()['generator']['orbit']['start']
-        self._stop = Settings()['generator']['orbit']['stop']
-        self._show_progress = Settings()['application']['progress_bar']
+    def initialize(self, resume=False):
+        self._setup()
 
-        # load the lattice
-        self._lattice.load([os.path.join(Settings()['application']['conf_path'],
-                            fname) for fname in Settings()['machine']['lattice']])
+        # the members of an ensemble share the spectrum
+        spectrum = None
+        if self._cache != None:
+            spectrum = self._cache.spectrum(
+                Settings()['generator']['photons']['spectrum'])
+        for member in self._members:
+            member.photons.initialize_spectrum(spectrum)
+            spectrum = member.photons.spectrum()
 
-        # initialise the sub-systems
-        self._orbit.initialize(self._lattice)
-        self._twiss.initialize(self._lattice)
-        self._photons.initialize(self._lattice)
-        
-        # initialise step and beam
-        self._step = self._orbit.create_step()
-        self._beam = self._twiss.create_beam()
+        # read the run settings
+        self._read_progress_settings()
+        self._checkpoint_enabled = False
+        if 'checkpoint' in Settings()['application']:
+            settings = Settings()['application']['checkpoint']
+            self._checkpoint_enabled = settings['enabled']
+            self._checkpoint_filename = settings['filename']
+            self._checkpoint_distance = settings.get('distance', 0.0)
+            self._checkpoint_time = settings.get('time', 0.0)
+        self._snapshots = None
+        if ('incremental' in Settings()['application']) and \
+           Settings()['application']['incremental']['enabled']:
+            from core.incremental import Snapshots
+            settings = Settings()['application']['incremental']
+            self._snapshots = Snapshots(settings['filename'],
+                                        settings.get('distance', 0.0))
+
+        # restore the state of an interrupted run or, for a shard,
+        # the state handed off at the start of the shard
+        self._resumed = False
+        self._lattice_changed = False
+        checkpoint = None
+        if resume:
+            checkpoint = self._load_checkpoint()
+            if (checkpoint != None) and (self._snapshots != None):
+                self._snapshots.restore(checkpoint['snapshots'])
+        if (checkpoint == None) and (self._handoff_filename != None):
+            checkpoint = self._load_handoff()
+        if (checkpoint == None) and (self._snapshots != None):
+            # after a lattice edit the run restarts from the last snapshot
+            # before the change, the regions are written again
+            checkpoint = self._snapshots.restart(self._checkpoint_settings(),
+                                                 self._lattice.fingerprint(),
+                                                 math.copysign(1.0,
+                                                               self._stop -
+                                                               self._start))
+            if checkpoint != None:
+                checkpoint['outputs']['regions'] = None
+                self._lattice_changed = True
+        if checkpoint != None:
+            self._restore(checkpoint)
+            self._resumed = True
+
+        # the photon pipeline forks its workers before the output threads
+        # are started
+        self._pipeline = None
+        if ('pipeline' in Settings()['application']) and \
+           Settings()['application']['pipeline']['enabled']:
+            from core.pipeline import Pipeline
+            settings = Settings()['application']['pipeline']
+            workers = settings.get('workers', 0)
+            if workers <= 0:
+                workers = os.cpu_count()
+            self._pipeline = Pipeline(workers, settings.get('slots', 64),
+                                      self._lattice,
+                                      self._members[0].photons.spectrum())
 
-        # output
+        # output, each member writes its own orbit, twiss and photon files
         self._output_lattice = Output('regions')
-        self._output_orbit = Output('orbit_parameters')
-        self._output_twiss = Output('twiss_parameters')
-        self._output_num_photons = Output('radiated_number_photons')
         self._output_spectrum = Output('spectrum_lut')
-        self._output_lattice.open()
-        self._output_orbit.open()
-        self._output_twiss.open()
-        self._output_num_photons.open()
-        self._output_spectrum.open()
-
-        # hepevt output
-        self._hepevt = Hepevt()
-        self._hepevt.open()
+        for member in self._members:
+            member.outputs = {
+                'orbit_parameters': Output('orbit_parameters', member.suffix),
+                'twiss_parameters': Output('twiss_parameters', member.suffix),
+                'radiated_number_photons': Output('radiated_number_photons',
+                                                  member.suffix),
+                'events': Hepevt(member.suffix)}
 
+        for name, output in self._outputs().items():
+            if checkpoint != None:
+                output.open(checkpoint['outputs'][name])
+            else:
+                output.open()
 
 
     def run(self):
-        # write lattice and spectrum
-        self._lattice.write(self._output_lattice)
-        self._photons.write_spectrum(self._output_spectrum)
+        # write lattice and spectrum, a resumed run has written them already
+        if (not self._resumed) or self._lattice_changed:
+            self._lattice.write(self._output_lattice)
+        if not self._resumed:
+            self._members[0].photons.write_spectrum(self._output_spectrum)
+
+        # checkpoint intervals
+        self._last_checkpoint_s = self._step.s0ip
+        self._last_checkpoint_time = time.time()
+
+        # progress report
+        self._step_count = 0
+        progress = None
+        if self._show_progress or (self._progress_log != None):
+            progress = Progress(math.fabs(self._stop - self._start),
+                                self.statistics,
+                                show=self._show_progress,
+                                interval=self._progress_interval,
+                                log_filename=self._progress_log,
+                                log_interval=self._progress_log_interval)
+            progress.start(math.fabs(self._step.s0ip - self._start))
 
-        # progress bar
-        if self._show_progress:
-            progress_ds = 0.0
-            progress = ProgressBar(widgets=['Stepping: ', Percentage(),
-                                            ' ', Bar(), ' ', ETA()],
-                                   maxval=math.fabs(self._stop - self._start)).start()
+        if self._pipeline != None:
+            self._pipeline.start(self._members)
 
         # first ideal orbit step
         self._orbit.step_ideal_orbit(self._step)
+        if self._snapshots != None:
+            self._snapshot_regions = self._region_extents()
 
         # step through the lattice until the stop point is reached
         while self._orbit.valid(self._step):
 
             # step the actual orbit and evolve the twiss parameters
-            self._orbit.step_actual_orbit(self._step)
-            self._twiss.evolve(self._step, self._beam)
+            self._advance()
 
-            # integrate over the beam profile and create the photons
-            self._photons.create(self._step, self._beam,
-                                 self._output_num_photons,
-                                 self._hepevt)
+            for index in range(len(self._members)):
+                member = self._member(index)
 
-            # write orbit and twiss parameters to file
-            self._step.write(self._output_orbit)
-            self._beam.write(self._step, self._output_twiss)
+                # integrate over the beam profile and create the photons,
+                # the pipeline integrates in its worker processes
+                if self._pipeline != None:
+                    if member.photons.accumulate(member.step):
+                        self._pipeline.submit(index, member.photons,
+                                              member.step, member.beam)
+                else:
+                    member.photons.create(member.step, member.beam,
+                                          member.outputs['radiated_number_photons'],
+                                          member.outputs['events'])
 
-            # update progress bar
-            if self._show_progress:
-                progress_ds += math.fabs(self._step.ds)
-                progress.update(progress_ds)
+                # write orbit and twiss parameters to file
+                member.step.write(member.outputs['orbit_parameters'])
+                member.beam.write(member.step, member.outputs['twiss_parameters'])
+
+            # update the progress report
+            self._step_count += 1
+            if progress != None:
+                progress.update(math.fabs(self._step.s0ip - self._start))
+
+            # write a checkpoint if one of the intervals has passed
+            if self._checkpoint_enabled and self._checkpoint_due():
+                self._write_checkpoint()
 
             # next ideal orbit step
+            if self._snapshots != None:
+                self._step_ideal_orbit_with_snapshot()
+            else:
+                self._orbit.step_ideal_orbit(self._step)
+
+        if self._pipeline != None:
+            self._pipeline.drain()
+        if progress != None:
+            progress.finish(math.fabs(self._step.s0ip - self._start))
+
+
+    def dry_run(self):
+        """
+        Step the orbit and twiss parameters through the lattice without
+        creating photons, count the steps and radiation calls and estimate
+        the runtime of the full run. The photon integration time is taken
+        from a sample of radiation calls (the 1st, 2nd, 4th, 8th, ...), which
+        are integrated without writing. The spectrum is not created, such that
+        neither NumPy nor SciPy are needed, and with full events no calls are
+        sampled. The parts of the run that the estimate leaves out are listed
+        in the report.
+        """
+        self._setup()
+        if self._handoff_filename != None:
+            self._restore(self._load_handoff())
+        null_output = Output('radiated_number_photons')
+        null_hepevt = Hepevt()
+        sample = not Settings()['generator']['photons']['full_events']
+
+        steps = 0
+        magnet_steps = 0
+        radiation_calls = 0
+        sampled_calls = 0
+        sampled_time = 0.0
+        start_time = time.perf_counter()
+
+        self._orbit.step_ideal_orbit(self._step)
+        while self._orbit.valid(self._step):
+            self._advance()
+            steps += 1
+            if not self._step.in_vacuum:
+                magnet_steps += 1
+
+            for index in range(len(self._members)):
+                member = self._member(index)
+                if not member.photons.accumulate(member.step):
+                    continue
+                radiation_calls += 1
+                # sample the calls with a power of two index
+                if sample and ((radiation_calls & (radiation_calls-1)) == 0):
+                    call_start = time.perf_counter()
+                    member.photons.radiate(member.step, member.beam,
+                                           null_output, null_hepevt)
+                    sampled_time += time.perf_counter() - call_start
+                    sampled_calls += 1
+                else:
+                    member.photons.skip()
             self._orbit.step_ideal_orbit(self._step)
 
-        if self._show_progress:
-            progress.finish()
+        stepping_time = time.perf_counter() - start_time - sampled_time
+        call_time = 0.0
+        if sampled_calls > 0:
+            call_time = sampled_time / sampled_calls
+
+        # the parts of the run that are not part of the estimate
+        excluded = ['spectrum build']
+        if not sample:
+            excluded.append('photon integration and energy sampling')
+        return {'layers': self._lattice.count(),
+                'members': len(self._members),
+                'steps': steps,
+                'magnet_steps': magnet_steps,
+                'radiation_calls': radiation_calls,
+                'grid_cells': self._members[0].photons.grid_size(),
+                'stepping_time': stepping_time,
+                'sampled_calls': sampled_calls,
+                'call_time': call_time,
+                'estimated_runtime': stepping_time + \
+                                     radiation_calls * call_time,
+                'excluded': excluded}
+
+
+    def handoff(self, boundaries):
+        """
+        Step the orbit and twiss parameters through the lattice without
+        creating photons and return the state of the generator after the last
+        step before each boundary, in the order of the boundaries along the
+        run. A shard that starts from such a state continues the run exactly
+        as if it had not been split.
+        """
+        self._setup()
+        handoffs = []
+        steps = 0
+
+        self._orbit.step_ideal_orbit(self._step)
+        while self._orbit.valid(self._step) and \
+              (len(handoffs) < len(boundaries)):
+            self._advance()
+            steps += 1
+            for index in range(len(self._members)):
+                member = self._member(index)
+                if member.photons.accumulate(member.step):
+                    member.photons.skip()
+
+            # the ideal orbit step decides whether this was the last step
+            # before a boundary, the state is taken before the ideal step
+            ideal = self._ideal_state()
+            self._orbit.step_ideal_orbit(self._step)
+            while (len(handoffs) < len(boundaries)) and \
+                  not self._orbit.valid(self._step, boundaries[len(handoffs)]):
+                # the state is copied, as the arrays of an ensemble beam
+                # are updated in place by the following steps
+                following = self._ideal_state()
+                self._set_ideal_state(ideal)
+                handoffs.append(copy.deepcopy(
+                    {'step': self._step.state(self._lattice),
+                     'beam': self._beam.state(),
+                     'photons': [member.photons.state()
+                                 for member in self._members],
+                     'steps': steps}))
+                self._set_ideal_state(following)
+
+        if len(handoffs) < len(boundaries):
+            raise ValueError("The boundary s=%f is not passed by the " \
+                             "run"%boundaries[len(handoffs)])
+        return handoffs
 
 
     def terminate(self):
-        self._output_lattice.close()
-        self._output_orbit.close()
-        self._output_twiss.close()
-        self._output_num_photons.close()
-        self._output_spectrum.close()
-        self._hepevt.close()
+        if self._pipeline != None:
+            self._pipeline.close()
+        for member in self._members:
+            member.photons.terminate()
+        for output in self._outputs().values():
+            output.close()
+
+        # the snapshots of the complete run are kept for the next run
+        if self._snapshots != None:
+            self._snapshots.save(self._checkpoint_settings(),
+                                 self._lattice.fingerprint())
+
+        # the run is complete, the checkpoint is not needed anymore
+        if self._checkpoint_enabled and \
+           os.path.exists(self._checkpoint_filename):
+            os.remove(self._checkpoint_filename)
+
+
+    def _setup(self):
+        # get settings
+        settings = Settings()['generator']['orbit']
+        self._start = settings['start']
+        self._stop = settings['stop']
+        self._ensemble = ('ensemble' in settings) and \
+                         settings['ensemble']['enabled']
+        if self._ensemble:
+            # the ensemble module needs NumPy, which is why it is only
+            # imported for ensemble runs
+            from core.ensemble import EnsembleOrbit
+            self._orbit = EnsembleOrbit()
+
+        # load the lattice, or only the window around the run
+        filenames = [os.path.join(Settings()['application']['conf_path'], fname)
+                     for fname in Settings()['machine']['lattice']]
+        lattice_window = window(Settings())
+        if self._cache != None:
+            self._lattice = self._cache.lattice(filenames, lattice_window)
+        else:
+            self._lattice.load(filenames, lattice_window)
+
+        # initialise the sub-systems
+        self._orbit.initialize(self._lattice)
+        self._twiss.initialize(self._lattice)
+        self._transport.initialize(self._lattice)
+        self._exact = False
+        if 'engine' in settings:
+            engine = settings['engine']
+            if engine not in ['euler', 'exact']:
+                raise ValueError("Unknown orbit engine '%s'"%engine)
+            self._exact = (engine == 'exact')
+
+        # a shard of a split run starts from a handed off state
+        self._handoff_filename = None
+        if 'shard' in Settings()['application']:
+            self._handoff_filename = Settings()['application']['shard']['handoff']
+
+        # initialise step, beam and the members of the run
+        if self._ensemble:
+            if self._exact:
+                raise ValueError("The exact orbit engine does not support " \
+                                 "ensemble runs")
+            offsets = settings['ensemble']['offsets']
+            self._step, self._beam = self._orbit.create_ensemble(offsets,
+                                                                 self._twiss)
+            self._members = [Member(self._orbit.create_step(offsets[i]),
+                                    self._twiss.create_beam(), Photons(),
+                                    "_m%i"%i) for i in range(len(offsets))]
+            for i in range(len(offsets)):
+                logger.info("Ensemble member %i: position offset %e, " \
+                            "angle offset %e"%(i, offsets[i]['position'],
+                                               offsets[i]['angle']))
+        else:
+            self._step = self._orbit.create_step()
+            self._beam = self._twiss.create_beam()
+            self._members = [Member(self._step, self._beam, Photons())]
+        for member in self._members:
+            member.photons.initialize(self._lattice)
+
+
+    def _advance(self):
+        """
+        Step the actual orbit and the twiss parameters, either with first
+        order steps or with the exact transfer maps of the lattice slices
+        """
+        if self._exact:
+            self._transport.step(self._step, self._beam)
+        else:
+            self._orbit.step_actual_orbit(self._step)
+            self._twiss.evolve(self._step, self._beam)
+
+
+    def _step_ideal_orbit_with_snapshot(self):
+        """
+        Take the ideal orbit step, the snapshot of a step that enters
+        another region is taken before the step
+        """
+        ideal = self._ideal_state()
+        self._orbit.step_ideal_orbit(self._step)
+        regions = self._region_extents()
+        if (regions != self._snapshot_regions) and \
+           self._snapshots.due(ideal[0]):
+            following = self._ideal_state()
+            self._set_ideal_state(ideal)
+            self._snapshots.add(self._step.s0ip, self._state())
+            self._set_ideal_state(following)
+        self._snapshot_regions = regions
+
+
+    def _region_extents(self):
+        # the regions are compared by their extent, as the vacuum outside
+        # of a layer is a new region at every call
+        return [(region.left(), region.right())
+                for region in self._lattice.get(self._step.s0ip)]
+
+
+    def _ideal_state(self):
+        return (self._step.s0ip, self._step.ds, self._step.on_boundary,
+                self._step.in_vacuum)
+
+
+    def _set_ideal_state(self, state):
+        self._step.s0ip, self._step.ds, self._step.on_boundary, \
+            self._step.in_vacuum = state
+
+
+    def _member(self, index):
+        """
+        Return a member, its step and beam are filled from the ensemble
+        """
+        member = self._members[index]
+        if self._ensemble:
+            self._step.member(index, member.step)
+            self._beam.member(index, member.beam)
+        return member
+
+
+    def radiate(self, dl, output, hepevt):
+        """
+        Integrate over the beam of the first member at the current step for
+        the given path length, outside of the sequence of radiation calls of
+        the run. Used to profile a single radiation call.
+        """
+        member = self._member(0)
+        member.photons.integrate(0, dl, member.step, member.beam, output,
+                                 hepevt)
+
+
+    def statistics(self):
+        """
+        Return the number of steps, radiation calls, photons and events
+        of the current run, summed over all members
+        """
+        statistics = {'steps': self._step_count,
+                      'radiation_calls': 0,
+                      'photons': 0,
+                      'events': 0}
+        for member in self._members:
+            statistics['events'] += member.outputs['events'].count()
+            for name, value in member.photons.statistics().items():
+                statistics[name] += value
+        return statistics
+
+
+    def output_files(self):
+        """
+        Return the names and the filenames of the enabled outputs
+        """
+        return dict([(name, output.filename()) for name, output
+                     in self._outputs().items() if output.filename() != None])
+
+
+    def _read_progress_settings(self):
+        # the progress section replaces the old progress_bar switch
+        self._show_progress = False
+        self._progress_interval = 0.25
+        self._progress_log = None
+        self._progress_log_interval = 10.0
+        if 'progress' in Settings()['application']:
+            settings = Settings()['application']['progress']
+            self._show_progress = settings['enabled']
+            self._progress_interval = settings.get('interval', 0.25)
+            if ('log' in settings) and settings['log']['enabled']:
+                self._progress_log = settings['log']['filename']
+                self._progress_log_interval = settings['log'].get('interval',
+                                                                  10.0)
+        elif 'progress_bar' in Settings()['application']:
+            self._show_progress = Settings()['application']['progress_bar']
+
+
+    def _outputs(self):
+        outputs = {'regions': self._output_lattice,
+                   'spectrum_lut': self._output_spectrum}
+        for member in self._members:
+            for name, output in member.outputs.items():
+                outputs[name + member.suffix] = output
+        return outputs
+
+
+    def _checkpoint_due(self):
+        if (self._checkpoint_distance > 0.0) and \
+           (math.fabs(self._step.s0ip - self._last_checkpoint_s) >= \
+            self._checkpoint_distance):
+            return True
+        if (self._checkpoint_time > 0.0) and \
+           (time.time() - self._last_checkpoint_time >= self._checkpoint_time):
+            return True
+        return False
+
+
+    def _write_checkpoint(self):
+        """
+        Store the state of the generator after the current step. The outputs
+        are flushed and their offsets stored, such that a resumed run
+        continues the files exactly where the checkpoint was taken.
+        """
+        checkpoint = self._state()
+        checkpoint['settings'] = self._checkpoint_settings()
+        if self._snapshots != None:
+            checkpoint['snapshots'] = self._snapshots.entries()
+
+        # write to a temporary file first, such that an interruption
+        # never leaves a broken checkpoint behind
+        tmp_filename = self._checkpoint_filename + ".tmp"
+        with open(tmp_filename, "wb") as checkpoint_file:
+            pickle.dump(checkpoint, checkpoint_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, self._checkpoint_filename)
+
+        self._last_checkpoint_s = self._step.s0ip
+        self._last_checkpoint_time = time.time()
+        logger.debug("Checkpoint written at s=%f"%self._step.s0ip)
+
+
+    def _state(self):
+        """
+        Return the state of the generator after the current step, the
+        outputs are flushed and their offsets stored. The radiation calls
+        in the photon pipeline are written first.
+        """
+        if self._pipeline != None:
+            self._pipeline.drain()
+        return {'step': self._step.state(self._lattice),
+                'beam': self._beam.state(),
+                'photons': [member.photons.state()
+                            for member in self._members],
+                'outputs': dict([(name, output.state()) for name, output
+                                 in self._outputs().items()])}
+
+
+    def _restore(self, checkpoint):
+        self._step.restore(checkpoint['step'], self._lattice)
+        self._beam.restore(checkpoint['beam'])
+        for member, state in zip(self._members, checkpoint['photons']):
+            member.photons.restore(state)
+
+
+    def _load_handoff(self):
+        """
+        Load the state handed off at the start of a shard. The outputs of
+        the shard start new files, the counters of the outputs written every
+        n-th call continue from the handoff.
+        """
+        with open(self._handoff_filename, "rb") as handoff_file:
+            handoff = pickle.load(handoff_file)
+        outputs = {'regions': {'offset': None, 'calls': 0},
+                   'spectrum_lut': {'offset': None, 'calls': 0}}
+        for member, state in zip(self._members, handoff['photons']):
+            outputs['orbit_parameters' + member.suffix] = \
+                {'offset': None, 'calls': handoff['steps']}
+            outputs['twiss_parameters' + member.suffix] = \
+                {'offset': None, 'calls': handoff['steps']}
+            outputs['radiated_number_photons' + member.suffix] = \
+                {'offset': None, 'calls': state['radiation_count']}
+            outputs['events' + member.suffix] = {'offset': None, 'evt_count': 0}
+        handoff['outputs'] = outputs
+        logger.info("Starting shard %i of %i at s=%f"%(
+                    Settings()['application']['shard']['index'],
+                    Settings()['application']['shard']['count'],
+                    handoff['step']['s0ip']))
+        return handoff
+
+
+    def _load_checkpoint(self):
+        if not self._checkpoint_enabled:
+            raise RuntimeError("Resuming requires application.checkpoint " +\
+                               "to be enabled")
+        if not os.path.exists(self._checkpoint_filename):
+            logger.warning("No checkpoint %s found, starting from the " \
+                           "beginning"%self._checkpoint_filename)
+            return None
+
+        with open(self._checkpoint_filename, "rb") as checkpoint_file:
+            checkpoint = pickle.load(checkpoint_file)
+        if checkpoint['settings'] != self._checkpoint_settings():
+            raise RuntimeError("The checkpoint %s was written with different " \
+                               "settings"%self._checkpoint_filename)
+        logger.info("Resuming from checkpoint at s=%f"%checkpoint['step']['s0ip'])
+        return checkpoint
+
+
+    def _checkpoint_settings(self):
+        # settings that have to be identical for a run to be resumed
+        return {'machine': Settings()['machine'],
+                'generator': Settings()['generator'],
+                'output': Settings()['application']['output']}
@@ -0,0 +1,121 @@
+import os
+import copy
+import math
+import pickle
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def first_difference(old, new, direction):
+    """
+    Return the position of the first region along the run, in the given
+    direction of the steps, that differs between the old and the new lattice
+    fingerprint. Returns None if the lattices are identical and an infinite
+    position before the start if the number of layers changed.
+    """
+    if len(old) != len(new):
+        return -direction * math.inf
+    positions = []
+    for old_layer, new_layer in zip(old, new):
+        for left, right, digest in set(old_layer) ^ set(new_layer):
+            positions.append(right if direction < 0.0 else left)
+    if len(positions) == 0:
+        return None
+    if direction < 0.0:
+        return max(positions)
+    return min(positions)
+
+
+class Snapshots(object):
+    """
+    State snapshots of a run for the incremental recomputation after lattice
+    edits. A snapshot is taken before each step that enters another region,
+    at least distance apart, and has the form of a checkpoint:
+    the state of the step, the beam and the photons and the offsets of the
+    outputs. The snapshots are stored with the lattice fingerprint at the end
+    of a run. The next run with the same settings compares the fingerprints,
+    restarts from the last snapshot before the first changed region and
+    continues the outputs from its offsets, such that the orbit, twiss and
+    photon output upstream of the change is reused unchanged.
+    """
+    def __init__(self, filename, distance=0.0):
+        self._filename = filename
+        self._distance = distance
+        self._entries = []
+
+
+    def due(self, s):
+        return (len(self._entries) == 0) or \
+               (math.fabs(s - self._entries[-1]['s0ip']) >= self._distance)
+
+
+    def add(self, s, state):
+        # the state is copied, as the arrays of an ensemble are
+        # updated in place by the following steps
+        self._entries.append({'s0ip': s, 'state': copy.deepcopy(state)})
+
+
+    def entries(self):
+        return self._entries
+
+
+    def restore(self, entries):
+        self._entries = entries
+
+
+    def restart(self, settings, fingerprint, direction):
+        """
+        Return the state to restart from for the given settings and lattice
+        fingerprint, or None if the run has to start from the beginning.
+        The snapshots after the returned one are discarded.
+        """
+        if not os.path.exists(self._filename):
+            return None
+        with open(self._filename, "rb") as snapshot_file:
+            stored = pickle.load(snapshot_file)
+        if stored['settings'] != settings:
+            logger.info("The settings changed since the snapshots in %s " \
+                        "were taken, starting from the beginning"%self._filename)
+            return None
+
+        position = first_difference(stored['fingerprint'], fingerprint,
+                                    direction)
+        entries = stored['snapshots']
+        if position != None:
+            # the step on the boundary of the changed region already
+            # uses its parameters, the tolerance excludes it
+            entries = [entry for entry in entries
+                       if direction * (position - entry['s0ip']) > 1.0e-9]
+        if len(entries) == 0:
+            logger.info("The lattice changed at s=%f before the first " \
+                        "snapshot, starting from the beginning"%position)
+            return None
+
+        # the curvatures refer to regions by their left border, the regions
+        # upstream of the first difference are the same in both lattices
+        self._entries = entries
+        if position == None:
+            logger.info("The lattice is unchanged, restarting from the " \
+                        "last snapshot at s=%f"%entries[-1]['s0ip'])
+        else:
+            logger.info("The lattice changed at s=%f, restarting from the " \
+                        "snapshot at s=%f (%i of %i snapshots kept)"%(
+                        position, entries[-1]['s0ip'], len(entries),
+                        len(stored['snapshots'])))
+        return copy.deepcopy(entries[-1]['state'])
+
+
+    def save(self, settings, fingerprint):
+        """
+        Store the snapshots of a complete run
+        """
+        stored = {'settings': settings,
+                  'fingerprint': fingerprint,
+                  'snapshots': self._entries}
+        tmp_filename = self._filename + ".tmp"
+        with open(tmp_filename, "wb") as snapshot_file:
+            pickle.dump(stored, snapshot_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, self._filename)
+        logger.debug("%i snapshots written to %s"%(len(self._entries),
+                                                  self._filename))
@@ -2,6 +2,26 @@
 from model.layer import Layer
 
 
+def window(settings):
+    """
+    Return the s range of the lattice that is loaded for the run of the
+    settings and the margin by which it is extended, or None if the
+    whole lattice is loaded. The range is the range of the orbit plus the
+    margin on both sides, unless it is configured.
+    """
+    machine = settings['machine']
+    if ('window' not in machine) or not machine['window']['enabled']:
+        return None
+    margin = machine['window'].get('margin', 1.0)
+    if machine['window'].get('range') != None:
+        left, right = sorted(machine['window']['range'])
+    else:
+        orbit = settings['generator']['orbit']
+        left = min(orbit['start'], orbit['stop']) - margin
+        right = max(orbit['start'], orbit['stop']) + margin
+    return (left, right, margin)
+
+
 class Lattice(object):
     """
     The magnetic field lattice. Consists of a list of layers.
@@ -10,11 +30,19 @@ class Lattice(object):
         self._layers = []
 
 
-    def load(self, filenames):
+    def load(self, filenames, window=None):
+        """
+        Load the lattice files. The window is the s range and the margin
+        returned by window(), only the regions of the window are loaded
+        and further regions on demand.
+        """
         self._layers = []
         for filename in filenames:
             new_layer = Layer()
-            new_layer.load(filename)
+            if window == None:
+                new_layer.load(filename)
+            else:
+                new_layer.load(filename, window[0:2], window[2])
             self._layers.append(new_layer)
 
 
@@ -22,10 +50,50 @@ class Lattice(object):
         return [lay.get(s) for lay in self._layers]
 
 
+    def next_edge(self, s, direction):
+        """
+        Return the closest slice border of all layers after s in
+        the given direction or None if there is none
+        """
+        result = None
+        for layer in self._layers:
+            edge = layer.next_edge(s, direction)
+            if (edge != None) and \
+               ((result == None) or ((edge - result) * direction < 0.0)):
+                result = edge
+        return result
+
+
+    def locate(self, region):
+        """
+        Return the location of a region as (layer index, left border of
+        the region) or None if the region is not part of the lattice
+        """
+        for i in range(len(self._layers)):
+            left = self._layers[i].locate(region)
+            if left != None:
+                return (i, left)
+        return None
+
+
+    def region(self, location):
+        if location == None:
+            return None
+        return self._layers[location[0]].region(location[1])
+
+
     def count(self):
         return len(self._layers)
 
 
+    def fingerprint(self):
+        """
+        Return the fingerprints of the regions of each layer, which identify
+        the regions of the lattice by their extent and parameters
+        """
+        return [layer.fingerprint() for layer in self._layers]
+
+
     def write(self, output):
         for layer in self._layers:
             layer.write(output)
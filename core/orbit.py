@@ -6,6 +6,10 @@ class Orbit():
     """
     The orbit
     """
+    # the functions applied to the orbit values of a step
+    _sin = staticmethod(math.sin)
+    _cos = staticmethod(math.cos)
+
     def __init__(self):
         pass
 
@@ -18,28 +22,37 @@ class Orbit():
         self._nominal_ds = settings['step_size']
 
 
-    def create_step(self):
+    def create_step(self, offset=None):
+        """
+        Create the first step, the offset overrides the position and angle
+        offset of the settings
+        """
         settings = Settings()['generator']['orbit']
+        if offset == None:
+            offset = settings['offset']
         return Step(self._lattice,
                     s0ip=settings['start'],
                     ds=settings['step_size'],
                     s0ip_prime=math.pi,
-                    x=settings['offset']['position'],
+                    x=offset['position'],
                     y=0.0,
                     dl=settings['step_size'],
-                    xp=-settings['offset']['angle'],
+                    xp=-offset['angle'],
                     yp=0.0,
-                    xip=settings['offset']['position'],
+                    xip=offset['position'],
                     yip=0.0,
                     z_ip=-1.0 * settings['start'],
-                    xip_prime=math.pi + settings['offset']['angle'],
+                    xip_prime=math.pi + offset['angle'],
                     yip_prime=0.0)
 
 
-    def valid(self, step):
-        # true if this step is valid and not the last step
-        return (step.ds < 0.0 and step.s0ip >= self._stop) or \
-               (step.ds > 0.0 and step.s0ip <= self._stop)
+    def valid(self, step, stop=None):
+        # true if this step is valid and not the last step,
+        # the stop position defaults to the one of the settings
+        if stop == None:
+            stop = self._stop
+        return (step.ds < 0.0 and step.s0ip >= stop) or \
+               (step.ds > 0.0 and step.s0ip <= stop)
 
 
     def step_ideal_orbit(self, step):
@@ -82,8 +95,8 @@ class Orbit():
 
     def step_actual_orbit(self, step):
         # update the curvature
-        step.gh = 0.0
-        step.gv = 0.0
+        step.gh = self._zeros(step)
+        step.gv = self._zeros(step)
 
         regions = self._lattice.get(step.s0ip)
         for iRegion in range(len(regions)):
@@ -115,31 +128,37 @@ class Orbit():
                               (region.sk1(idx) * mag_x)
                 else:
                     # evolve curvature
-                    curv.gh += step.dl * ((region.k1(idx) * step.xp) - \
-                                          (region.sk1(idx) * step.yp))
-                    curv.gv += step.dl * ((region.k1(idx) * step.yp) + \
-                                          (region.sk1(idx) * step.xp))
+                    curv.gh = curv.gh + step.dl * ((region.k1(idx) * step.xp) - \
+                                                   (region.sk1(idx) * step.yp))
+                    curv.gv = curv.gv + step.dl * ((region.k1(idx) * step.yp) + \
+                                                   (region.sk1(idx) * step.xp))
                     step.s0ip_prime -= step.ds * region.k0(idx) * region.length(idx)
     
-                step.gh += curv.gh
-                step.gv += curv.gv
+                step.gh = step.gh + curv.gh
+                step.gv = step.gv + curv.gv
 
         
         # calculate actual step length
         if step.in_vacuum:
-            step.dl = step.ds / math.cos(step.xp)
+            step.dl = step.ds / self._cos(step.xp)
         else:
             step.dl = step.ds * (1.0 + (step.gh * step.x))
 
-        # calculate the deviation from the ideal orbit
-        step.xip += step.dl * math.sin(step.xip_prime)
-        step.yip += step.dl * step.yip_prime
-        step.zip += step.dl * math.cos(step.xip_prime)
-        step.x += step.dl * step.xp
-        step.y += step.dl * step.yip_prime
-        step.xip_prime += step.gh * step.dl
-        step.yip_prime += step.gv * step.dl
+        # calculate the deviation from the ideal orbit, the values are
+        # replaced instead of updated in place, as the arrays of an
+        # ensemble step may be shared
+        step.xip = step.xip + step.dl * self._sin(step.xip_prime)
+        step.yip = step.yip + step.dl * step.yip_prime
+        step.zip = step.zip + step.dl * self._cos(step.xip_prime)
+        step.x = step.x + step.dl * step.xp
+        step.y = step.y + step.dl * step.yip_prime
+        step.xip_prime = step.xip_prime + step.gh * step.dl
+        step.yip_prime = step.yip_prime + step.gv * step.dl
 
         if not step.in_vacuum:
             step.xp = step.s0ip_prime - step.xip_prime
             step.yp = step.yip_prime
+
+
+    def _zeros(self, step):
+        return 0.0
@@ -2,11 +2,22 @@
 import math
 from app.settings import Settings
 from app.hepevt import Hepevt
-from core.spectrum import Spectrum
 
 class Photons():
     """
     Integrate over the beam and create the photons
+
+    The 'scalar' engine loops over the cells of the beam grid. The 'vector'
+    engine evaluates the whole grid with NumPy arrays in the configured
+    precision, the orbit and twiss parameters of the step and the local
+    curvature stay in float64. In float64 it creates the same events as the
+    scalar engine, apart from rounding differences in the last bit. In float32
+    every written vertex, momentum and critical energy deviates from the
+    float64 value by less than 1e-6 relative, which is about one unit in the
+    seventh significant digit written by %.6e. The number of photons of a
+    cell deviates by less than 1e-6 relative plus one from the truncation
+    to an integer, which can also move a cell across the threshold of
+    one photon.
     """
     def __init__(self):
         pass
@@ -22,6 +33,8 @@ class Photons():
         self._energy_cutoff = settings['energy_cutoff']
         self._sigma_h = settings['sigma']['horizontal']
         self._sigma_v = settings['sigma']['vertical']
+        self._steps_h = settings['steps']['horizontal']
+        self._steps_v = settings['steps']['vertical']
         self._stepsize_h = 2.0 * self._sigma_h / settings['steps']['horizontal']
         self._stepsize_v = 2.0 * self._sigma_v / settings['steps']['vertical']
         self._crossing_angle = Settings()['machine']['crossing_angle']
@@ -38,16 +51,34 @@ class Photons():
         self._target_zone_radius = settings['target_zone']['radius']
         self._target_zone_boundary = settings['target_zone']['boundary']
 
-        # create synchrotron radiation power spectrum PDF
-        self._spectrum = Spectrum()
-        self._spectrum.initialize(settings['spectrum']['resolution'],
-                                  settings['spectrum']['cutoff'],
-                                  settings['spectrum']['seed'],
-                                  settings['spectrum']['interpolation'])
+        self._engine = settings.get('engine', 'scalar')
+        self._precision = settings.get('precision', 'float64')
+        if self._engine not in ['scalar', 'vector']:
+            raise ValueError("Unknown photon engine '%s'"%self._engine)
+        if self._precision not in ['float64', 'float32']:
+            raise ValueError("Unknown photon precision '%s'"%self._precision)
+        if (self._engine == 'scalar') and (self._precision != 'float64'):
+            raise ValueError("The %s precision requires the vector photon " \
+                             "engine"%self._precision)
+
+        # merging of neighbouring photon sources into one event
+        self._compactor = None
+        if ('compaction' in settings) and settings['compaction']['enabled']:
+            if self._full_events:
+                raise ValueError("The compaction of photon sources is not " \
+                                 "supported for full events")
+            from core.compaction import Compactor
+            tolerance = settings['compaction']['tolerance']
+            self._compactor = Compactor(tolerance['vertex'],
+                                        tolerance['direction'],
+                                        tolerance['critical_energy'])
 
         # internal parameters
+        self._spectrum = None
         self._lattice = lattice
         self._call_count = 0
+        self._radiation_count = 0
+        self._photon_count = 0
         self._dl = 0.0
 
         # internal constants and pre-calculated factors
@@ -63,9 +94,36 @@ class Photons():
                               self._hbar * (self._gamma**3)
 
 
+    def initialize_spectrum(self, spectrum=None):
+        """
+        Create the synchrotron radiation power spectrum PDF. The spectrum
+        module pulls in NumPy and SciPy, which is why it is only imported
+        when the spectrum is needed. The members of an ensemble share
+        the spectrum of the first member.
+        """
+        if spectrum != None:
+            self._spectrum = spectrum
+            return
+        from core.spectrum import create_spectrum
+        self._spectrum = create_spectrum(
+            Settings()['generator']['photons']['spectrum'])
+
+
+    def spectrum(self):
+        return self._spectrum
+
+
     def create(self, step, beam, output, hepevt):
+        if self.accumulate(step):
+            self.radiate(step, beam, output, hepevt)
+
+
+    def accumulate(self, step):
+        """
+        Accumulate the step and return True if photons have to be radiated
+        """
         if not self._enabled:
-            return
+            return False
 
         # accumulate steps only inside magnets and, if enabled,
         # inside the region
@@ -79,45 +137,126 @@ class Photons():
         # radiate photons if the n-th step is reached,
         # the current step is on a magnet to vacuum boundary,
         # or the region is enabled and the step leaves the region
-        if (self._call_count >= self._nth_step) or \
-           (self._call_count > 0 and step.on_boundary) or \
-           (self._region_enabled and self._call_count > 0 and step.ds < 0.0 and \
-            step.s0ip <= self._region_left) or \
-           (self._region_enabled and self._call_count > 0 and step.ds > 0.0 and \
-            step.s0ip >= self._region_right):
-            self._integrate_beam(math.fabs(self._dl),
-                                 step, beam,
-                                 output, hepevt)
-            self._dl = 0.0
-            self._call_count = 0
+        return (self._call_count >= self._nth_step) or \
+               (self._call_count > 0 and step.on_boundary) or \
+               (self._region_enabled and self._call_count > 0 and \
+                step.ds < 0.0 and step.s0ip <= self._region_left) or \
+               (self._region_enabled and self._call_count > 0 and \
+                step.ds > 0.0 and step.s0ip >= self._region_right)
+
+
+    def radiate(self, step, beam, output, hepevt):
+        """
+        Integrate over the beam for the accumulated steps
+        """
+        call, dl = self.next_call()
+        hepevt.mark(step.s0ip, call)
+        self.integrate(call, dl, step, beam, output, hepevt)
+
+
+    def skip(self):
+        """
+        Discard the accumulated steps without radiating
+        """
+        self.next_call()
+
+
+    def next_call(self):
+        """
+        Return the number and the path length of the next radiation call
+        and reset the accumulated steps
+        """
+        call = self._radiation_count
+        dl = math.fabs(self._dl)
+        self._radiation_count += 1
+        self._dl = 0.0
+        self._call_count = 0
+        return call, dl
+
+
+    def integrate(self, call, dl, step, beam, output, hepevt):
+        """
+        Integrate over the beam for the radiation call with the given number
+        and path length. The spectrum is reseeded with the number of the
+        call, such that the result does not depend on where it is computed.
+        """
+        if self._spectrum != None:
+            self._spectrum.seek(call)
+        if self._engine == 'vector':
+            self._integrate_beam_vector(dl, step, beam, output, hepevt)
+        else:
+            self._integrate_beam(dl, step, beam, output, hepevt)
+
+
+    def add_statistics(self, photons, compaction=None):
+        """
+        Add the statistics of a radiation call integrated elsewhere
+        """
+        self._photon_count += photons
+        if compaction != None:
+            self._compactor.merge(compaction)
+
+
+    def grid_size(self):
+        """
+        Return the number of beam profile cells evaluated per radiation call
+        """
+        return self._steps_h * self._steps_v
 
 
     def write_spectrum(self, output):
         self._spectrum.write(output)
 
 
-    def _intersect_target_zone(self, vertex, direction):
+    def statistics(self):
+        return {'radiation_calls': self._radiation_count,
+                'photons': self._photon_count}
+
+
+    def terminate(self):
+        if self._compactor != None:
+            self._compactor.report()
+
+
+    def state(self):
+        state = {'dl': self._dl,
+                 'call_count': self._call_count,
+                 'radiation_count': self._radiation_count}
+        if self._compactor != None:
+            state['compaction'] = self._compactor.state()
+        return state
+
+
+    def restore(self, state):
+        self._dl = state['dl']
+        self._call_count = state['call_count']
+        self._radiation_count = state['radiation_count']
+        if self._compactor != None:
+            self._compactor.restore(state['compaction'])
+
+
+    def _intersect_target_zone(self, vx, vy, vz, px, py, pz):
         """
         Target zone is an z-axis aligned cylinder with an inner and an outer
         radius and a lower and upper boundary. This code intersects a line with
         the cylinder, not a ray! That's ok for the SyncRad Generator, as this
         shouldn't introduce too many false intersections as long as the generation
         is done in a way such that the photons travel towards the IP.
+        The vertices and directions are given as arrays.
         """
+        import numpy as np
 
         # calculate slopes
-        if math.fabs(direction[2]) > 0.0000000001:
-            slope_xz = direction[0] / direction[2]
-            slope_yz = direction[1] / direction[2]
-        else:
-            slope_xz = 0.0
-            slope_yz = 0.0
+        steep = np.fabs(pz) > 0.0000000001
+        safe_pz = np.where(steep, pz, 1.0)
+        slope_xz = np.where(steep, px / safe_pz, 0.0)
+        slope_yz = np.where(steep, py / safe_pz, 0.0)
 
         # calculate the distance from the z-axis (radius) that the ray has at the
         # lower and upper z-boundary of the cylinder.
         def calc_radius2(boundary):
-            x_b = slope_xz*(boundary-vertex[2]) + vertex[0]
-            y_b = slope_yz*(boundary-vertex[2]) + vertex[1]
+            x_b = slope_xz*(boundary-vz) + vx
+            y_b = slope_yz*(boundary-vz) + vy
             return x_b**2 + y_b**2
 
         r_low = calc_radius2(self._target_zone_boundary[0])
@@ -126,16 +265,19 @@ class Photons():
         # since it is a z-axis aligned cylinder, the radius can simply be compared
         # to the cylinder radii, in order to check for the intersection of the ray.
         radius2 = [self._target_zone_radius[0]**2, self._target_zone_radius[1]**2]
-        return ((r_low < radius2[1]) and (r_up  > radius2[0])) or \
-               ((r_up  < radius2[1]) and (r_low > radius2[0]))
+        return ((r_low < radius2[1]) & (r_up  > radius2[0])) | \
+               ((r_up  < radius2[1]) & (r_low > radius2[0]))
 
 
     def _integrate_beam(self, dl, step, beam, output, hepevt):
         """
         integrate over the beam profile
         """
+        import numpy as np
         total_number_photons = 0
-        total_number_photons_cut = 0
+        cells = []
+        cell_photons = []
+        cell_crit_e = []
 
         k1s = []
         for region in self._lattice.get(step.s0ip):
@@ -204,35 +346,169 @@ class Photons():
                     pz = (cx_c*pz_temp) - (cx_s*px_temp)
                     norm = 1.0/math.sqrt(px**2 + py**2 + pz**2)
 
-                    # if the target zone feature is on, only write events if
-                    # the photons will hit the zone.
-                    if (not self._target_zone_enabled) or \
-                       (self._target_zone_enabled and \
-                        self._intersect_target_zone([vx, vy, vz], [px, py, pz])):
-
-                        # if full event writing is turned on, get the energies
-                        # for all radiated photons and write them into the
-                        # event file
-                        if self._full_events:
-                            energies = self._spectrum.random(crit_e, num_photons,
-                                                             self._energy_cutoff)
-                            if len(energies) > 0:
-                                evt = hepevt.event(vx, vy, vz)
-                                for e in energies:
-                                    evt.add(px*e*norm, py*e*norm, pz*e*norm)
-                                evt.commit()
-                            total_number_photons_cut += len(energies)
-                        else:
-                            evt = hepevt.event(vx, vy, vz,
-                                               num_photons=num_photons,
-                                               critical_e=crit_e)
-                            evt.add(px*norm, py*norm, pz*norm)
-                            evt.commit()
+                    # the events of the cells are written after the loop
+                    cells.append((vx, vy, vz, px, py, pz, norm))
+                    cell_photons.append(num_photons)
+                    cell_crit_e.append(crit_e)
 
                 ys += ystep
             xs += xstep
-        output.write(["%f:%i:%i:%e:%e:%e:%e\n"%(step.s0ip,
-                                       total_number_photons,
-                                       total_number_photons_cut,
-                                       step.x, step.y,
-                                       step.xp, step.yp)])
+
+        vx, vy, vz, px, py, pz, norm = np.array(cells,
+                                                dtype=np.float64).reshape(-1, 7).T
+        self._emit(vx, vy, vz, px, py, pz, norm,
+                   np.array(cell_photons, dtype=np.int64),
+                   np.array(cell_crit_e, dtype=np.float64),
+                   total_number_photons, step, output, hepevt)
+
+
+    def _grid(self, start, stepsize, stop):
+        """
+        Return the cell centres, summed up like in the scalar loop
+        """
+        centres = []
+        value = start
+        while value <= stop:
+            centres.append(value)
+            value += stepsize
+        return centres
+
+
+    def _integrate_beam_vector(self, dl, step, beam, output, hepevt):
+        """
+        integrate over the beam profile, all cells at once
+        """
+        import numpy as np
+        dtype = np.dtype(self._precision)
+
+        k1s = []
+        for region in self._lattice.get(step.s0ip):
+            idx = region.index(step.s0ip)
+            k1s.append([region.k1(idx), region.sk1(idx)])
+
+        hsize, vsize, ch, cv = beam.size()
+        prob_norm_1 = 1.0 / (2.506628 * hsize * vsize)
+        prob_norm_2 = 1.0 / (2.0*math.pi * hsize * vsize)
+        weight_factor = self._stepsize_h * self._stepsize_v * hsize * vsize
+        xstep = self._stepsize_h * hsize
+        ystep = self._stepsize_v * vsize
+
+        cx_s = math.sin(self._crossing_angle)
+        cx_c = math.cos(self._crossing_angle)
+
+        # the grid, the horizontal position changes along the first axis
+        xs = np.array(self._grid(-1.0 * self._sigma_h * hsize + 0.5*xstep, xstep,
+                                 self._sigma_h * hsize), dtype=dtype)
+        ys = np.array(self._grid(-1.0 * self._sigma_v * vsize + 0.5*ystep, ystep,
+                                 self._sigma_v * vsize), dtype=dtype)
+        xs = xs.reshape(-1, 1)
+        ys = ys.reshape(1, -1)
+        shape = (xs.shape[0], ys.shape[1])
+
+        # calculate local radius, the curvature of the orbit and the focusing
+        # of the quadrupoles can cancel, which is why it is summed in float64
+        local_gh = np.full(shape, step.gh)
+        local_gv = np.full(shape, step.gv)
+        for k1 in k1s:
+            local_gh = local_gh + ((k1[0] * xs.astype(np.float64)) - \
+                                   (k1[1] * ys.astype(np.float64)))
+            local_gv = local_gv + ((k1[0] * ys.astype(np.float64)) + \
+                                   (k1[1] * xs.astype(np.float64)))
+        rho_inv = np.sqrt(local_gh**2 + local_gv**2).astype(dtype)
+
+        # beam profile. Either Talman tails or Gaussian
+        nsigh = xs / hsize
+        nsigv = ys / vsize
+        gauss = prob_norm_2 * np.exp(-0.5*(nsigh**2 + nsigv**2))
+        if beam.emitv / beam.emith < 0.2:
+            talman = prob_norm_1 * np.exp(-0.5*nsigh**2) * \
+                                   np.exp(-7.4 -1.2*np.fabs(nsigv))
+            prob = np.where(np.fabs(nsigv) > 5.0, talman, gauss)
+        else:
+            prob = gauss
+        weight = prob * weight_factor
+
+        # calculate number of radiated photons
+        num_photons = (self._num_photon_factor * rho_inv * weight * dl).astype(
+                          np.int64)
+        total_number_photons = int(num_photons.sum())
+
+        # the cells radiating photons, in the order of the scalar loop
+        radiating = num_photons > 0
+        xs = np.broadcast_to(xs, shape)[radiating]
+        ys = np.broadcast_to(ys, shape)[radiating]
+        num_photons = num_photons[radiating]
+
+        # calculate critical energy
+        crit_e = self._crit_e_factor * rho_inv[radiating]
+
+        # calculate vertex
+        vx = (cx_c*(step.xip+xs)) + (cx_s*step.zip)
+        vy = step.yip+ys
+        vz = (cx_c*step.zip) - (cx_s*(step.xip+xs))
+
+        # calculate momentum
+        px_temp = -step.zip * ((math.pi - step.xip_prime) + (ch * xs))
+        py_temp = -step.zip * (step.yip_prime + (cv * ys))
+        pz_temp = -step.zip
+
+        # rotate momentum into Geant4 space
+        px = (cx_c*px_temp) + (cx_s*pz_temp)
+        py = py_temp
+        pz = (cx_c*pz_temp) - (cx_s*px_temp)
+        norm = 1.0/np.sqrt(px**2 + py**2 + pz**2)
+
+        self._emit(vx, vy, vz, px, py, pz, norm, num_photons, crit_e,
+                   total_number_photons, step, output, hepevt)
+
+
+    def _emit(self, vx, vy, vz, px, py, pz, norm, num_photons, crit_e,
+              total_number_photons, step, output, hepevt):
+        """
+        Write the events of the radiating cells of both engines, given as
+        arrays in the order of the scalar loop, and the record of the call
+        """
+        import numpy as np
+        total_number_photons_cut = 0
+
+        # if the target zone feature is on, only write events if
+        # the photons will hit the zone.
+        if self._target_zone_enabled:
+            hit = self._intersect_target_zone(vx, vy, vz, px, py, pz)
+            vx, vy, vz = vx[hit], vy[hit], vz[hit]
+            px, py, pz, norm = px[hit], py[hit], pz[hit], norm[hit]
+            num_photons = num_photons[hit]
+            crit_e = crit_e[hit]
+
+        if self._full_events:
+            # sample the energies cell by cell, such that every cell
+            # draws the same random numbers as in the scalar loop
+            for i in range(len(num_photons)):
+                energies = self._spectrum.random(float(crit_e[i]),
+                                                 int(num_photons[i]),
+                                                 self._energy_cutoff)
+                if len(energies) > 0:
+                    momenta = energies.astype(vx.dtype).reshape(-1, 1) * \
+                              np.array([px[i], py[i], pz[i]]) * norm[i]
+                    hepevt.write_event(vx[i], vy[i], vz[i], momenta)
+                total_number_photons_cut += len(energies)
+        else:
+            directions = np.column_stack((px*norm, py*norm, pz*norm))
+            if self._compactor != None:
+                for i in range(len(num_photons)):
+                    self._compactor.add(vx[i], vy[i], vz[i],
+                                        directions[i, 0], directions[i, 1],
+                                        directions[i, 2],
+                                        num_photons[i], crit_e[i])
+                self._compactor.flush(hepevt)
+            else:
+                hepevt.write_events(np.column_stack((vx, vy, vz)), directions,
+                                    np.arange(len(num_photons) + 1),
+                                    num_photons=num_photons,
+                                    critical_e=crit_e)
+
+        self._photon_count += total_number_photons
+        output.write_record("%f:%i:%i:%e:%e:%e:%e\n",
+                            (step.s0ip, total_number_photons,
+                             total_number_photons_cut,
+                             step.x, step.y, step.xp, step.yp))
@@ -0,0 +1,350 @@
+"""
+Concurrent photon pipeline. The orbit and twiss stepping stays serial in the
+main process, while the radiation calls are integrated by a pool of worker
+processes. For each radiation call the stepping loop writes a record with
+the orbit, the beam size and the accumulated path length into a slot of a
+ring buffer in shared memory and passes the slot number to the workers. A
+worker integrates over the beam, samples the photon energies and formats
+the events in the format of the event file. A writer thread in the main
+process collects the results and writes them in the order of the radiation
+calls, such that the outputs are the same as those of a serial run. A slot
+is released when its result has been written, which bounds the number of
+radiation calls in flight by the number of slots; a full ring buffer
+blocks the stepping loop.
+"""
+import time
+import queue
+import logging
+import threading
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from app.settings import Settings
+from app.hepevt import Hepevt
+from core.photons import Photons
+
+logger = logging.getLogger(__name__)
+
+# the fields of a radiation call record in the ring buffer
+RECORD_FIELDS = ['member', 'call', 'dl', 's0ip', 'gh', 'gv',
+                 'x', 'y', 'xp', 'yp', 'xip', 'yip', 'zip',
+                 'xip_prime', 'yip_prime', 'hsize', 'vsize', 'ch', 'cv',
+                 'emith', 'emitv']
+
+
+class RadiationPoint(object):
+    """
+    The step and beam of a radiation call read from a record, it has the
+    attributes of the step and the beam used by the photon integration
+    """
+    def __init__(self, record):
+        for name, value in zip(RECORD_FIELDS, record.tolist()):
+            setattr(self, name, value)
+
+    def size(self):
+        return self.hsize, self.vsize, self.ch, self.cv
+
+
+
+class Capture(object):
+    """
+    Collects the text or bytes written by a Hepevt or, with records enabled,
+    the records written by an Output
+    """
+    def __init__(self, records=False):
+        self._records = records
+        self._parts = []
+
+    def write(self, data):
+        if self._records:
+            self._parts.extend(data)
+        else:
+            self._parts.append(data)
+
+    def write_record(self, text_format, values):
+        self._parts.append((text_format, values))
+
+    def take(self):
+        parts = self._parts
+        self._parts = []
+        if self._records or (len(parts) == 0):
+            return parts
+        if isinstance(parts[0], bytes):
+            return b"".join(parts)
+        return "".join(parts)
+
+
+
+def compaction_difference(before, after):
+    """
+    Return the compaction statistics of a radiation call from the
+    statistics before and after the call
+    """
+    if after == None:
+        return None
+    difference = dict(after)
+    difference['source_count'] -= before['source_count']
+    difference['event_count'] -= before['event_count']
+    return difference
+
+
+def work(tasks, results, memory_name, slots, conf, lattice, spectrum):
+    """
+    The loop of a worker process
+    """
+    Settings().clear()
+    Settings().update(conf)
+    memory = shared_memory.SharedMemory(name=memory_name)
+    records = np.ndarray((slots, len(RECORD_FIELDS)), dtype=np.float64,
+                         buffer=memory.buf)
+    photons = Photons()
+    photons.initialize(lattice)
+    photons.initialize_spectrum(spectrum)
+    events = Capture()
+    hepevt = Hepevt()
+    hepevt.capture(events)
+    try:
+        while True:
+            task = tasks.get()
+            if task == None:
+                break
+            sequence, slot = task
+            start = time.perf_counter()
+            try:
+                point = RadiationPoint(records[slot])
+                output = Capture(records=True)
+                before = photons.state()
+                photon_count = photons.statistics()['photons']
+                event_count = hepevt.count()
+                photons.integrate(int(point.call), point.dl, point, point,
+                                  output, hepevt)
+                after = photons.state()
+                results.put({'sequence': sequence,
+                             'slot': slot,
+                             'member': int(point.member),
+                             'call': int(point.call),
+                             's0ip': point.s0ip,
+                             'events': events.take(),
+                             'event_count': hepevt.count() - event_count,
+                             'radiated': output.take(),
+                             'photons': photons.statistics()['photons'] -
+                                        photon_count,
+                             'compaction': compaction_difference(
+                                               before.get('compaction'),
+                                               after.get('compaction')),
+                             'busy': time.perf_counter() - start})
+            except Exception:
+                results.put({'sequence': sequence,
+                             'error': traceback.format_exc()})
+    finally:
+        del records
+        memory.close()
+
+
+
+class Pipeline(object):
+    """
+    The ring buffer, the worker processes and the ordered writer. The
+    workers are started when the pipeline is created, which should happen
+    before any output threads are started. The writer is started with the
+    members whose outputs receive the results.
+    """
+    def __init__(self, workers, slots, lattice, spectrum):
+        self._slots = slots
+        self._memory = shared_memory.SharedMemory(
+                           create=True, size=slots * len(RECORD_FIELDS) * 8)
+        self._records = np.ndarray((slots, len(RECORD_FIELDS)),
+                                   dtype=np.float64, buffer=self._memory.buf)
+        self._tasks = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        self._free = queue.Queue()
+        for slot in range(slots):
+            self._free.put(slot)
+
+        self._workers = []
+        for index in range(workers):
+            worker = multiprocessing.Process(
+                         target=work, name="photons:%i"%index,
+                         args=(self._tasks, self._results, self._memory.name,
+                               slots, dict(Settings()), lattice, spectrum))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+        self._members = None
+        self._writer = None
+        self._condition = threading.Condition()
+        self._submitted = 0
+        self._written = 0
+        self._error = None
+
+        # statistics
+        self._depth_sum = 0
+        self._depth_max = 0
+        self._reorder_max = 0
+        self._stall = 0.0
+        self._drain = 0.0
+        self._writer_wait = 0.0
+        self._busy = 0.0
+        self._start_time = time.perf_counter()
+
+
+    def start(self, members):
+        self._members = members
+        self._writer = threading.Thread(target=self._write_results,
+                                        name="pipeline writer")
+        self._writer.daemon = True
+        self._writer.start()
+        self._start_time = time.perf_counter()
+
+
+    def submit(self, index, photons, step, beam):
+        """
+        Pass the radiation call of the accumulated steps of a member to the
+        workers. Blocks while all slots of the ring buffer are in flight.
+        """
+        call, dl = photons.next_call()
+        start = time.perf_counter()
+        while True:
+            try:
+                slot = self._free.get(timeout=1.0)
+                break
+            except queue.Empty:
+                self._check()
+        self._stall += time.perf_counter() - start
+
+        hsize, vsize, ch, cv = beam.size()
+        self._records[slot] = (index, call, dl, step.s0ip, step.gh, step.gv,
+                               step.x, step.y, step.xp, step.yp,
+                               step.xip, step.yip, step.zip,
+                               step.xip_prime, step.yip_prime,
+                               hsize, vsize, ch, cv, beam.emith, beam.emitv)
+        depth = self._slots - self._free.qsize()
+        self._depth_sum += depth
+        self._depth_max = max(self._depth_max, depth)
+        self._tasks.put((self._submitted, slot))
+        self._submitted += 1
+
+
+    def drain(self):
+        """
+        Wait until the results of all submitted radiation calls are written
+        """
+        start = time.perf_counter()
+        with self._condition:
+            while self._written < self._submitted:
+                self._check()
+                self._condition.wait(1.0)
+        self._check()
+        self._drain += time.perf_counter() - start
+
+
+    def close(self):
+        try:
+            if self._writer != None:
+                self.drain()
+        finally:
+            for worker in self._workers:
+                self._tasks.put(None)
+            self._results.put(None)
+            if self._writer != None:
+                self._writer.join()
+            for worker in self._workers:
+                worker.join(5.0)
+                if worker.is_alive():
+                    worker.terminate()
+            self._records = None
+            self._memory.close()
+            self._memory.unlink()
+        self.report()
+
+
+    def statistics(self):
+        elapsed = time.perf_counter() - self._start_time
+        return {'calls': self._submitted,
+                'workers': len(self._workers),
+                'slots': self._slots,
+                'mean_depth': self._depth_sum / max(self._submitted, 1),
+                'max_depth': self._depth_max,
+                'max_reorder': self._reorder_max,
+                'stepping_stall': self._stall,
+                'drain': self._drain,
+                'writer_wait': self._writer_wait,
+                'utilization': self._busy / max(elapsed *
+                                                len(self._workers), 1.0e-9)}
+
+
+    def report(self):
+        statistics = self.statistics()
+        logger.info("Photon pipeline: %i radiation calls by %i workers, " \
+                    "queue depth mean %.1f max %i of %i slots, reordered " \
+                    "max %i, stepping stall %.3f s, drain %.3f s, writer " \
+                    "wait %.3f s, worker utilization %.0f%%"%(
+                    statistics['calls'], statistics['workers'],
+                    statistics['mean_depth'], statistics['max_depth'],
+                    statistics['slots'], statistics['max_reorder'],
+                    statistics['stepping_stall'], statistics['drain'],
+                    statistics['writer_wait'],
+                    100.0 * statistics['utilization']))
+
+
+    def _check(self):
+        if self._error != None:
+            raise RuntimeError("The photon pipeline failed:\n%s"%self._error)
+        for worker in self._workers:
+            if not worker.is_alive():
+                raise RuntimeError("The photon worker %s exited with code " \
+                                   "%s"%(worker.name, worker.exitcode))
+
+
+    def _write_results(self):
+        """
+        The writer thread, the results are written in the order of
+        submission. After an error the results are still collected, such
+        that the slots are released.
+        """
+        pending = {}
+        sequence = 0
+        while True:
+            start = time.perf_counter()
+            result = self._results.get()
+            self._writer_wait += time.perf_counter() - start
+            if result == None:
+                break
+            if 'error' in result:
+                self._fail(result['error'])
+                continue
+            pending[result['sequence']] = result
+            self._reorder_max = max(self._reorder_max, len(pending) - 1)
+            while sequence in pending:
+                result = pending.pop(sequence)
+                sequence += 1
+                if self._error == None:
+                    try:
+                        self._write(result)
+                    except Exception:
+                        self._fail(traceback.format_exc())
+                self._busy += result['busy']
+                self._free.put(result['slot'])
+                with self._condition:
+                    self._written += 1
+                    self._condition.notify_all()
+
+
+    def _write(self, result):
+        member = self._members[result['member']]
+        hepevt = member.outputs['events']
+        hepevt.mark(result['s0ip'], result['call'])
+        if result['event_count'] > 0:
+            hepevt.write_encoded(result['events'], result['event_count'])
+        for text_format, values in result['radiated']:
+            member.outputs['radiated_number_photons'].write_record(text_format,
+                                                                   values)
+        member.photons.add_statistics(result['photons'], result['compaction'])
+
+
+    def _fail(self, error):
+        with self._condition:
+            self._error = error
+            self._condition.notify_all()
@@ -1,18 +1,44 @@
 import math
-import random
 import bisect
+import heapq
 import numpy as np
 import scipy as sp
 from scipy import integrate
 from scipy.stats import rv_discrete
 
 
+def create_spectrum(settings):
+    """
+    Create the spectrum described by the spectrum settings of the photons
+    """
+    spectrum = Spectrum()
+    spectrum.initialize(settings['resolution'],
+                        settings['cutoff'],
+                        settings['seed'],
+                        settings['interpolation'],
+                        settings.get('layout', 'uniform'))
+    return spectrum
+
+
 class Spectrum():
     """
     This class provides the normalised spectrum for synchrotron radiation in
     units of omage/omega_c. It also offers a method to produce random numbers
     according to the spectrum PDF.
 
+    The random numbers are taken from a counter based generator (Philox), keyed
+    by the seed. Each radiation call selects its own independent stream with
+    seek(), such that the energies of a call only depend on the seed and the
+    index of the call and not on the calls before.
+
+    The inverse CDF is stored in one of two layouts. The 'uniform' layout
+    tabulates the inverse CDF of the spectrum, discretised on a uniform energy
+    grid, at uniformly spaced probabilities. The 'adaptive' layout places its
+    knots where the inverse CDF curves sharply, the tails in particular, and
+    interpolates linearly between them. A bucket table maps a probability to
+    its knot interval, such that a few thousand knots give the accuracy of a
+    uniform table with a hundred thousand entries.
+
     Formulas are taken from:
     G. J. Roy, A new method for the simulation of synchrotron radiation
                in particle tracking codes, Nucl. Inst. Meth. A298 (1990) 128-133
@@ -26,24 +52,33 @@ class Spectrum():
         self._spectrum_norm = (9.0*math.sqrt(3.0)) / (8.0 * math.pi)
 
 
-    def initialize(self, resolution, cutoff, seed=1817, interpolate=False):
+    def initialize(self, resolution, cutoff, seed=1817, interpolate=False,
+                   layout='uniform'):
         """
         Initialise the spectrum by creating the normalised SR spectrum (PDF)
-        and a discrete random distribution from which the random numbers
-        will be generated
+        and the lookup table from which the random numbers will be generated.
+        For the adaptive layout the resolution is the number of knots,
+        which are always interpolated.
         """
-        np.random.seed(seed)
+        self._seed = seed
+        self.seek(0)
         self._resolution = resolution
         self._interpolate = interpolate
-        self._x = np.linspace(0.0, cutoff, resolution)
-        self._pdf = self._spectrum(self._x)
-        self._pdf /= self._pdf.sum()
-        self._disc_dist = rv_discrete(name='spectrum',
-                                      values=(self._x, self._pdf))
+        self._layout = layout
+        if layout == 'uniform':
+            self._x = np.linspace(0.0, cutoff, resolution)
+            self._pdf = self._spectrum(self._x)
+            self._pdf /= self._pdf.sum()
+            self._disc_dist = rv_discrete(name='spectrum',
+                                          values=(self._x, self._pdf))
 
-        # create the lookup table
-        self._lut_x = np.linspace(0.0, 1.0, resolution)
-        self._lut_y = self._disc_dist.ppf(self._lut_x)
+            # create the lookup table
+            self._lut_x = np.linspace(0.0, 1.0, resolution)
+            self._lut_y = self._disc_dist.ppf(self._lut_x)
+        elif layout == 'adaptive':
+            self._create_adaptive_lut(resolution, cutoff)
+        else:
+            raise ValueError("Unknown spectrum layout '%s'"%layout)
 
 
     def pdf(self):
@@ -51,44 +86,80 @@ class Spectrum():
         return (self._x, self._pdf)
 
 
+    def seek(self, index):
+        """
+        Select the random number stream of the radiation call with the given
+        index. The generator is created on the first use of the stream.
+        """
+        self._stream_index = index
+        self._rng = None
+
+
     def random(self, critical_e, number=1, cutoff_e=0.0):
         """
-        Generate a list of random energy values according to the spectrum PDF
+        Generate an array of random energy values according to the spectrum PDF.
+        Only photons above the energy cutoff are sampled: the number of
+        surviving photons is drawn from the binomial distribution with the
+        above-cutoff fraction of the LUT CDF, and their energies are sampled
+        from the truncated inverse CDF. This has the same statistics as
+        drawing all photons and discarding those below the cutoff.
         """
-        result = []
         cut = self._cutoff_value(critical_e, cutoff_e)
-        rnd_values = np.random.random(number)
+        generator = self._generator()
+        kept = generator.binomial(number, 1.0 - cut)
+        rnd_values = cut + ((1.0 - cut) * generator.random(kept))
+        if self._layout == 'adaptive':
+            return critical_e * self._inverse_cdf(rnd_values)
 
+        # find left and right bin
+        left = np.minimum((rnd_values * self._resolution).astype(np.int64),
+                          self._resolution - 1)
         if not self._interpolate:
-            for rnd in rnd_values:
-                if rnd < cut:
-                    continue
-                result.append(critical_e * \
-                              self._lut_y[int(rnd * self._resolution)])
-        else:
-            for rnd in rnd_values:
-                if rnd < cut:
-                    continue
-
-                # find left and right bin
-                left = int(rnd * self._resolution)
-                right = left+1
-                if right >= len(self._lut_x):
-                    right = left
-                    left = right-1
+            return critical_e * self._lut_y[left]
 
-                # perform linear interpolation
-                result.append(critical_e * \
-                              np.interp(rnd,
-                                        [self._lut_x[left], self._lut_x[right]],
-                                        [self._lut_y[left], self._lut_y[right]]))
+        right = left + 1
+        last = right >= len(self._lut_x)
+        right[last] = left[last]
+        left[last] = right[last] - 1
 
-        return result
+        # perform linear interpolation, clamped to the bin like np.interp
+        x_left = self._lut_x[left]
+        x_right = self._lut_x[right]
+        y_left = self._lut_y[left]
+        y_right = self._lut_y[right]
+        slope = (y_right - y_left) / (x_right - x_left)
+        values = (slope * (rnd_values - x_left)) + y_left
+        values = np.where(rnd_values <= x_left, y_left, values)
+        values = np.where(rnd_values >= x_right, y_right, values)
+        return critical_e * values
 
 
     def write(self, output):
-        output.write([str(self._resolution)+"\n"])
-        output.write(["%f\n"%y for y in self._lut_y])
+        """
+        The uniform layout writes the number of entries followed by the
+        energies. The adaptive layout writes the number of knots and the word
+        'adaptive', followed by the probability and energy of each knot.
+        """
+        if self._layout == 'adaptive':
+            output.write(["%i adaptive\n"%len(self._knots_u)])
+            output.write(["%e %e\n"%(u, x) for u, x in zip(self._knots_u,
+                                                          self._knots_x)])
+        else:
+            output.write([str(self._resolution)+"\n"])
+            output.write(["%f\n"%y for y in self._lut_y])
+
+
+    def _generator(self):
+        """
+        The stream index is placed in the third word of the 256 bit Philox
+        counter, every stream has 2**128 blocks before it would overlap
+        the next one.
+        """
+        if self._rng == None:
+            self._rng = np.random.Generator(np.random.Philox(
+                            key=self._seed,
+                            counter=[0, 0, self._stream_index, 0]))
+        return self._rng
 
 
     def _k53_integral(self, x):
@@ -102,8 +173,101 @@ class Spectrum():
         return self._spectrum_norm * x * v_k53_integral(x)
 
 
+    def _cdf(self, cutoff, points=20000, x_min=1.0e-9):
+        """
+        Calculate the spectrum and its CDF on a logarithmic grid. The integrals
+        are evaluated with the trapezoidal rule in log(x), the spectrum rises
+        with x^(1/3) below x_min.
+        """
+        x = np.geomspace(x_min, cutoff, points)
+        dlog = np.diff(np.log(x))
+
+        # integral over K_5/3 from x to infinity
+        k53 = self._k53(x) * x
+        steps = 0.5 * (k53[1:] + k53[:-1]) * dlog
+        k53_integral = self._k53_integral(cutoff) + \
+                       np.append(np.cumsum(steps[::-1])[::-1], 0.0)
+        pdf = self._spectrum_norm * x * k53_integral
+
+        # cumulative distribution, normalised over [0, cutoff]
+        steps = 0.5 * (pdf[1:] * x[1:] + pdf[:-1] * x[:-1]) * dlog
+        below = 0.75 * x[0] * pdf[0]
+        cdf = np.append(below, below + np.cumsum(steps))
+        norm = cdf[-1]
+        return (np.append(0.0, x), np.append(0.0, pdf / norm),
+                np.append(0.0, cdf / norm))
+
+
+    def _create_adaptive_lut(self, knots, cutoff):
+        """
+        Place the knots of the inverse CDF greedily: the interval with the
+        largest error, measured as its probability times the relative
+        deviation of the linear interpolation, is split in the middle until
+        the number of knots is reached
+        """
+        self._x, self._pdf, cdf = self._cdf(cutoff)
+
+        def interval(u_left, x_left, u_right, x_right):
+            if u_right <= u_left:
+                return (0.0, u_left, x_left, u_right, x_right)
+            probe = u_left + (u_right - u_left) * np.array([0.25, 0.5, 0.75])
+            exact = np.interp(probe, cdf, self._x)
+            linear = x_left + (x_right - x_left) * (probe - u_left) / \
+                              (u_right - u_left)
+            error = np.max(np.fabs(linear - exact) / exact)
+            return (-(u_right - u_left) * error, u_left, x_left, u_right, x_right)
+
+        # start with one knot per decade
+        x_start = np.append(0.0, np.geomspace(self._x[1], cutoff,
+                                              int(np.log10(cutoff / self._x[1])) + 1))
+        u_start = np.interp(x_start, self._x, cdf)
+        heap = [interval(u_start[i], x_start[i], u_start[i+1], x_start[i+1])
+                for i in range(len(x_start) - 1)]
+        heapq.heapify(heap)
+        while len(heap) < knots - 1:
+            error, u_left, x_left, u_right, x_right = heapq.heappop(heap)
+            u_mid = 0.5 * (u_left + u_right)
+            x_mid = float(np.interp(u_mid, cdf, self._x))
+            heapq.heappush(heap, interval(u_left, x_left, u_mid, x_mid))
+            heapq.heappush(heap, interval(u_mid, x_mid, u_right, x_right))
+
+        heap.sort(key=lambda item: item[1])
+        self._knots_u = np.array([item[1] for item in heap] + [heap[-1][3]])
+        self._knots_x = np.array([item[2] for item in heap] + [heap[-1][4]])
+        self._slopes = np.diff(self._knots_x) / np.diff(self._knots_u)
+
+        # the bucket table holds the knot interval of each bucket, or -1 if
+        # a knot lies inside the bucket
+        buckets = 4 * knots
+        first = np.searchsorted(self._knots_u, np.arange(buckets) / buckets,
+                                side='right') - 1
+        last = np.searchsorted(self._knots_u, np.arange(1, buckets+1) / buckets,
+                               side='left') - 1
+        self._buckets = np.where(first == last, first, -1).astype(np.int32)
+
+
+    def _inverse_cdf(self, rnd_values):
+        """
+        Look up the knot intervals in the bucket table and interpolate,
+        only values in buckets containing a knot are searched
+        """
+        buckets = len(self._buckets)
+        index = self._buckets[np.minimum((rnd_values * buckets).astype(np.int64),
+                                         buckets - 1)].astype(np.int64)
+        search = index < 0
+        if search.any():
+            index[search] = np.minimum(np.searchsorted(self._knots_u,
+                                                       rnd_values[search],
+                                                       side='right') - 1,
+                                       len(self._slopes) - 1)
+        return self._knots_x[index] + \
+               (self._slopes[index] * (rnd_values - self._knots_u[index]))
+
+
     def _cutoff_value(self, critical_e, cutoff_e):
         search_value = cutoff_e / critical_e
+        if self._layout == 'adaptive':
+            return float(np.interp(search_value, self._knots_x, self._knots_u))
         i = bisect.bisect_right(self._lut_y, search_value)
         if i > 0:
             return self._lut_x[i-1]
@@ -0,0 +1,236 @@
+import math
+
+
+def focusing(kappa, length):
+    """
+    Return the coefficients C, S, F of the solution of w'' = kappa*w + c
+    after the given length:
+        w  = C*w0 + S*w0' + F*c
+        w' = kappa*S*w0 + C*w0' + S*c
+    """
+    if kappa > 0.0:
+        root = math.sqrt(kappa)
+        phase = root * length
+        return (math.cosh(phase), math.sinh(phase) / root,
+                2.0 * (math.sinh(0.5 * phase) / root)**2)
+    elif kappa < 0.0:
+        root = math.sqrt(-kappa)
+        phase = root * length
+        return (math.cos(phase), math.sin(phase) / root,
+                2.0 * (math.sin(0.5 * phase) / root)**2)
+    return (1.0, length, 0.5 * length**2)
+
+
+def transport_1d(kappa, c, length, w, wp):
+    """Transport w and w' through w'' = kappa*w + c"""
+    C, S, F = focusing(kappa, length)
+    return (C*w + S*wp + F*c, kappa*S*w + C*wp + S*c)
+
+
+class Transport():
+    """
+    Exact linear transport of the orbit and the twiss parameters through
+    the hard edge lattice. It replaces the first order steps of
+    Orbit.step_actual_orbit and Twiss.evolve.
+
+    Within a slice of constant lattice parameters the orbit deviation
+    u = (x, y) obeys u'' = A*u + b. The symmetric matrix A and the vector b
+    follow from k0, k1, sk0, sk1, the offsets and the roll of all layers,
+    such that the equation is solved exactly in the eigenbasis of A.
+    The beam envelopes and the dispersion obey Hill's equation with the
+    focusing of the slice and are transported with their transfer matrices.
+    A step is split at every slice edge of the lattice, which means that the
+    step size is only limited by the density of the radiation points and not
+    by the stability of the integration. The global coordinates and the path
+    length along the actual orbit are integrated with Simpson's rule.
+    """
+    def __init__(self):
+        pass
+
+
+    def initialize(self, lattice):
+        self._lattice = lattice
+        self._min_length = 1.0e-12
+
+
+    def step(self, step, beam):
+        """
+        Transport step and beam from s0ip-ds to s0ip, the ideal orbit has
+        already been stepped.
+        """
+        s = step.s0ip - step.ds
+        s_end = step.s0ip
+        direction = 1.0 if step.ds > 0.0 else -1.0
+
+        step.dl = 0.0
+        step.gh = 0.0
+        step.gv = 0.0
+        while (s_end - s) * direction > self._min_length:
+            edge = self._lattice.next_edge(s, direction)
+            if (edge == None) or \
+               ((s_end - edge) * direction < self._min_length):
+                edge = s_end
+            if (edge - s) * direction > self._min_length:
+                step.dl += self._transport(step, beam, s, edge)
+            s = edge
+
+        # the photons are created without curvature in the vacuum
+        if step.in_vacuum:
+            step.gh = 0.0
+            step.gv = 0.0
+
+
+    def _transport(self, step, beam, s_start, s_stop):
+        """
+        Transport through a piece of constant lattice parameters and
+        return its path length
+        """
+        length = s_stop - s_start
+        mid = 0.5 * (s_start + s_stop)
+        magnets = [region for region in self._lattice.get(mid)
+                   if not region.is_vacuum()]
+        if len(magnets) == 0:
+            return self._drift(step, beam, length)
+        return self._magnet(step, beam, magnets, mid, length)
+
+
+    def _drift(self, step, beam, length):
+        # same relations as the vacuum case of Orbit.step_actual_orbit,
+        # the angles stay constant in the drift
+        dl = length / math.cos(step.xp)
+        step.xip += dl * math.sin(step.xip_prime)
+        step.yip += dl * step.yip_prime
+        step.zip += dl * math.cos(step.xip_prime)
+        step.x += dl * step.xp
+        step.y += dl * step.yip_prime
+        step.gh = 0.0
+        step.gv = 0.0
+        self._twiss(beam, 0.0, 0.0, 0.0, 0.0, dl)
+        return dl
+
+
+    def _magnet(self, step, beam, magnets, mid, length):
+        # collect the linear equation u'' = A*u + b, A = [[a, b],[b, d]]
+        params = []
+        a = 0.0
+        b = 0.0
+        d = 0.0
+        bx = 0.0
+        by = 0.0
+        rate = 0.0
+        k1_sum = 0.0
+        for region in magnets:
+            idx = region.index(mid)
+            k0 = region.k0(idx)
+            k1 = region.k1(idx)
+            sk0 = region.sk0(idx)
+            sk1 = region.sk1(idx)
+            dx = region.offset_horz(idx)
+            dy = region.offset_vert(idx)
+            m_s = math.sin(-region.angle(idx))
+            m_c = math.cos(-region.angle(idx))
+            params.append((k0, k1, sk0, sk1, dx, dy, m_s, m_c))
+
+            # x'' = rate - gh and y'' = gv, with the curvatures of
+            # Orbit.step_actual_orbit in the displaced and rotated magnet frame
+            m00 = -(k1 * m_c) + (sk1 * m_s)
+            m01 = (k1 * m_s) + (sk1 * m_c)
+            m11 = (k1 * m_c) - (sk1 * m_s)
+            a += m00
+            b += m01
+            d += m11
+            bx += -k0 - (k0 * region.length(idx)) - (m00 * dx) - (m01 * dy)
+            by += sk0 - (m01 * dx) - (m11 * dy)
+            rate -= k0 * region.length(idx)
+            k1_sum += k1
+
+        # eigenbasis of A
+        phi = 0.5 * math.atan2(2.0 * b, a - d)
+        e_c = math.cos(phi)
+        e_s = math.sin(phi)
+        kappa1 = (e_c**2 * a) + (2.0 * e_c * e_s * b) + (e_s**2 * d)
+        kappa2 = (e_s**2 * a) - (2.0 * e_c * e_s * b) + (e_c**2 * d)
+        c1 = (e_c * bx) + (e_s * by)
+        c2 = -(e_s * bx) + (e_c * by)
+        w1 = (e_c * step.x) + (e_s * step.y)
+        w2 = -(e_s * step.x) + (e_c * step.y)
+        w1p = (e_c * step.xp) + (e_s * step.yp)
+        w2p = -(e_s * step.xp) + (e_c * step.yp)
+
+        def orbit(l):
+            v1, v1p = transport_1d(kappa1, c1, l, w1, w1p)
+            v2, v2p = transport_1d(kappa2, c2, l, w2, w2p)
+            return ((e_c * v1) - (e_s * v2), (e_s * v1) + (e_c * v2),
+                    (e_c * v1p) - (e_s * v2p), (e_s * v1p) + (e_c * v2p))
+
+        def curvature(x, y):
+            gh = 0.0
+            gv = 0.0
+            for k0, k1, sk0, sk1, dx, dy, m_s, m_c in params:
+                mag_x = (m_c * (x - dx)) - (m_s * (y - dy))
+                mag_y = (m_s * (x - dx)) + (m_c * (y - dy))
+                gh += k0 + (k1 * mag_x) - (sk1 * mag_y)
+                gv += sk0 + (k1 * mag_y) + (sk1 * mag_x)
+            return gh, gv
+
+        # path length, global position and curvature at the start,
+        # the middle and the end of the piece
+        s0ip_prime = step.s0ip_prime
+        points = [(0.0, step.x, step.y, step.xp, step.yp),
+                  (0.5 * length,) + orbit(0.5 * length),
+                  (length,) + orbit(length)]
+        sums = [0.0, 0.0, 0.0, 0.0]
+        curvatures = []
+        for weight, (l, x, y, xp, yp) in zip([1.0, 4.0, 1.0], points):
+            gh, gv = curvature(x, y)
+            curvatures.append((gh, gv))
+            g = 1.0 + (gh * x)
+            xip_prime = s0ip_prime + (rate * l) - xp
+            sums[0] += weight * g
+            sums[1] += weight * g * math.sin(xip_prime)
+            sums[2] += weight * g * yp
+            sums[3] += weight * g * math.cos(xip_prime)
+        dl = sums[0] * length / 6.0
+        step.xip += sums[1] * length / 6.0
+        step.yip += sums[2] * length / 6.0
+        step.zip += sums[3] * length / 6.0
+
+        # orbit at the end of the piece
+        l, step.x, step.y, step.xp, step.yp = points[2]
+        step.s0ip_prime += rate * length
+        step.xip_prime = step.s0ip_prime - step.xp
+        step.yip_prime = step.yp
+        step.gh, step.gv = curvatures[2]
+
+        # twiss parameters with the focusing in the middle of the piece
+        gh, gv = curvatures[1]
+        self._twiss(beam, -(k1_sum + gh**2), gh, k1_sum - gv**2, -gv, dl)
+        return dl
+
+
+    def _twiss(self, beam, kappah, forceh, kappav, forcev, length):
+        """
+        Transport zeta and eta through zeta'' = kappa*zeta + 1/zeta^3 and
+        eta'' = kappa*eta + force, zeta being the square root of beta
+        """
+        beam.zetah, beam.zetahp, beam.etah, beam.etahp = \
+            self._twiss_plane(kappah, forceh, length, beam.zetah, beam.zetahp,
+                              beam.etah, beam.etahp)
+        beam.zetav, beam.zetavp, beam.etav, beam.etavp = \
+            self._twiss_plane(kappav, forcev, length, beam.zetav, beam.zetavp,
+                              beam.etav, beam.etavp)
+
+
+    def _twiss_plane(self, kappa, force, length, zeta, zetap, eta, etap):
+        C, S, F = focusing(kappa, length)
+        Cp = kappa * S
+        beta = zeta**2
+        alpha = -zeta * zetap
+        gamma = (1.0 + alpha**2) / beta
+        beta_new = (C**2 * beta) - (2.0 * C * S * alpha) + (S**2 * gamma)
+        alpha_new = -(C * Cp * beta) + (((C * C) + (S * Cp)) * alpha) - \
+                    (S * C * gamma)
+        zeta_new = math.sqrt(beta_new)
+        return (zeta_new, -alpha_new / zeta_new,
+                (C * eta) + (S * etap) + (F * force),
+                (Cp * eta) + (C * etap) + (S * force))
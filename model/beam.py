@@ -34,9 +34,17 @@ class Beam(object):
         return hsize, vsize, ch, cv
 
 
+    def state(self):
+        return dict(self.__dict__)
+
+
+    def restore(self, state):
+        self.__dict__.update(state)
+
+
     def write(self, step, output):
-        output.write(["%f:%e:%e:%e:%e:%e:%e\n"%(step.s0ip,
-                                                self.zetahp*self.zetah,
-                                                self.zetavp*self.zetav,
-                                                self.zetah, self.zetav,
-                                                self.etah, self.etav)])
+        output.write_record("%f:%e:%e:%e:%e:%e:%e\n", (step.s0ip,
+                                                       self.zetahp*self.zetah,
+                                                       self.zetavp*self.zetav,
+                                                       self.zetah, self.zetav,
+                                                       self.etah, self.etav))
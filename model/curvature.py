@@ -1,5 +1,4 @@
 
-
 class Curvature(object):
 
     def __init__(self):
@@ -7,3 +6,18 @@ class Curvature(object):
         self.index = -1
         self.gh = 0.0
         self.gv = 0.0
+
+
+    def state(self, lattice):
+        # the region is stored by its location in the lattice
+        return {'region': lattice.locate(self.region),
+                'index': self.index,
+                'gh': self.gh,
+                'gv': self.gv}
+
+
+    def restore(self, state, lattice):
+        self.region = lattice.region(state['region'])
+        self.index = state['index']
+        self.gh = state['gh']
+        self.gv = state['gv']
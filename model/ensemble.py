@@ -0,0 +1,64 @@
+import numpy as np
+from model.step import Step
+from model.beam import Beam
+
+
+class EnsembleStep(Step):
+    """
+    A step of an ensemble of orbits. The ideal orbit and the status are
+    shared by all members, the actual orbit of each member is stored
+    in NumPy arrays.
+    """
+    MEMBER = ['x', 'y', 'dl', 'xp', 'yp', 'xip', 'yip', 'zip',
+              'xip_prime', 'yip_prime', 'gh', 'gv']
+
+    def __init__(self, lattice, steps):
+        Step.__init__(self, lattice)
+        for name, value in steps[0].__dict__.items():
+            if (name not in self.MEMBER) and (name != 'curvatures'):
+                setattr(self, name, value)
+        for name in self.MEMBER:
+            setattr(self, name, np.array([getattr(step, name) for step in steps],
+                                         dtype=np.float64))
+
+
+    def size(self):
+        return len(self.x)
+
+
+    def member(self, index, step):
+        """
+        Copy the orbit of a member into a single step
+        """
+        step.s0ip = self.s0ip
+        step.ds = self.ds
+        step.s0ip_prime = self.s0ip_prime
+        step.in_vacuum = self.in_vacuum
+        step.on_boundary = self.on_boundary
+        for name in self.MEMBER:
+            setattr(step, name, float(getattr(self, name)[index]))
+
+
+
+class EnsembleBeam(Beam):
+    """
+    The twiss parameters of an ensemble of orbits stored in NumPy arrays,
+    the emittance and the energy spread are shared by all members.
+    """
+    MEMBER = ['alphah', 'alphav', 'zetah', 'zetav', 'zetahp', 'zetavp',
+              'etah', 'etav', 'etahp', 'etavp']
+
+    def __init__(self, beams):
+        Beam.__init__(self, emith=beams[0].emith, emitv=beams[0].emitv,
+                      delta_e=beams[0].delta_e, zetah=1.0, zetav=1.0)
+        for name in self.MEMBER:
+            setattr(self, name, np.array([getattr(beam, name) for beam in beams],
+                                         dtype=np.float64))
+
+
+    def member(self, index, beam):
+        """
+        Copy the twiss parameters of a member into a single beam
+        """
+        for name in self.MEMBER:
+            setattr(beam, name, float(getattr(self, name)[index]))
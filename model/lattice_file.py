@@ -0,0 +1,143 @@
+import os
+import math
+
+
+def starts_region(previous, tokens):
+    """
+    Return True if the slice of the tokens starts a new region after the
+    previous slice, i.e. if there is a gap between the two slices
+    """
+    prev_s = float(previous[1])
+    prev_l = float(previous[2])
+    return (prev_l > 0.0) and \
+           (math.fabs(prev_s + prev_l - float(tokens[1])) > 0.000000000001)
+
+
+
+class LatticeFile(object):
+    """
+    Random access to the slices of a lattice file, whose lines are sorted
+    in ascending order of s. The lines of an s window are found by bisection
+    over the byte offsets of the file, such that only the lines of the
+    window are read. A window is extended to complete regions and includes
+    the regions on both sides of it, such that the vacuum regions at its
+    borders are complete as well.
+    """
+    def __init__(self, filename):
+        self._filename = filename
+        self._size = os.path.getsize(filename)
+        with open(filename, "rb") as lattice_file:
+            first = self._line_at(lattice_file, 0)
+            last = self._line_before(lattice_file, self._size)
+        if first == None:
+            raise ValueError("The lattice file %s is empty"%filename)
+        self._left = float(first[2][1])
+        self._right = float(last[2][1]) + float(last[2][2])
+
+
+    def left(self):
+        return self._left
+
+    def right(self):
+        return self._right
+
+
+    def window(self, smin, smax):
+        """
+        Return the byte range of the lines of the regions overlapping
+        smin to smax and of the regions next to them
+        """
+        with open(self._filename, "rb") as lattice_file:
+            # bisection for the first slice ending after smin
+            lo = 0
+            hi = self._size
+            while lo < hi:
+                mid = (lo + hi) // 2
+                line = self._line_at(lattice_file, mid)
+                if (line == None) or \
+                   (float(line[2][1]) + float(line[2][2]) > smin):
+                    hi = mid
+                else:
+                    lo = line[1]
+
+            line = self._line_at(lattice_file, lo)
+            if line == None:
+                line = self._line_before(lattice_file, self._size)
+            elif float(line[2][1]) >= smin:
+                # the region before the window bounds the vacuum before it
+                line = self._line_before(lattice_file, line[0]) or line
+
+            # the window starts with the first slice of a region
+            while True:
+                previous = self._line_before(lattice_file, line[0])
+                if (previous == None) or starts_region(previous[2], line[2]):
+                    break
+                line = previous
+            start = line[0]
+
+            # the window ends with the region that contains the
+            # first slice at or after smax
+            stop = start
+            passed = False
+            previous = None
+            lattice_file.seek(start)
+            for raw_line in lattice_file:
+                tokens = raw_line.split()
+                if len(tokens) == 0:
+                    break
+                if passed and starts_region(previous, tokens):
+                    break
+                stop += len(raw_line)
+                if float(tokens[1]) >= smax:
+                    passed = True
+                previous = tokens
+        return start, stop
+
+
+    def lines(self, start, stop):
+        """
+        Return the tokens of the lines in the byte range
+        """
+        with open(self._filename, "rb") as lattice_file:
+            lattice_file.seek(start)
+            text = lattice_file.read(stop - start).decode()
+        return [line.split() for line in text.splitlines()]
+
+
+    def _line_at(self, lattice_file, offset):
+        """
+        Return the start, the end and the tokens of the first line
+        starting at or after the offset, or None at the end of the file
+        """
+        if offset == 0:
+            lattice_file.seek(0)
+        else:
+            lattice_file.seek(offset - 1)
+            lattice_file.readline()
+        start = lattice_file.tell()
+        tokens = lattice_file.readline().split()
+        if len(tokens) == 0:
+            return None
+        return start, lattice_file.tell(), tokens
+
+
+    def _line_before(self, lattice_file, start):
+        """
+        Return the start, the end and the tokens of the line ending at the
+        start of another line, or None at the beginning of the file
+        """
+        if start == 0:
+            return None
+        # the newline ending the line before start is skipped
+        begin = start - 1
+        while begin > 0:
+            size = min(4096, begin)
+            lattice_file.seek(begin - size)
+            block = lattice_file.read(size)
+            index = block.rfind(b"\n")
+            begin -= size
+            if index >= 0:
+                begin += index + 1
+                break
+        lattice_file.seek(begin)
+        return begin, start, lattice_file.readline().split()
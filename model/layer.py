@@ -1,28 +1,101 @@
 import math
 import bisect
+import logging
 from model.region import Region
+from model.lattice_file import LatticeFile
+
+logger = logging.getLogger(__name__)
 
 
 class Layer(object):
     """
     A layer consists of multiple, non-overlapping regions. Between magnet
     regions there is always a vacuum region. The regions are ordered
-    in ascending order of s.
+    in ascending order of s. A region is identified by its left border.
+
+    If a window is given, only the regions of the window are built from
+    the lattice file (see LatticeFile). Regions outside of the window are
+    loaded on demand, the window is then extended by the margin.
     """
     def __init__(self):
         self._s = []  # left border of regions
         self._regions = []  # list of regions in ascending order of s
+        self._edges = []  # all slice borders in ascending order of s
+        self._source = None  # lattice file of a windowed layer
+        self._margin = 0.0
 
 
-    def load(self, filename):
+    def load(self, filename, window=None, margin=0.0):
         self._filename = filename
-        lattice_file = open(filename, "r")
+        if window == None:
+            with open(filename, "r") as lattice_file:
+                self._build(line.split() for line in lattice_file)
+            return
+
+        self._source = LatticeFile(filename)
+        self._margin = margin
+        self._load(window[0], window[1])
+
+
+    def _load(self, smin, smax):
+        """
+        Build the regions of the window of a windowed layer, the regions
+        that were already built are kept
+        """
+        start, stop = self._source.window(smin, smax)
+        built = dict([(region.left(), region) for region in self._regions])
+        self._s = []
+        self._regions = []
+        self._edges = []
+        self._build(self._source.lines(start, stop))
+        self._regions = [built.get(region.left(), region)
+                         for region in self._regions]
+        logger.debug("%s: %i regions built for s=%f to %f"%(
+                     self._filename, len(self._regions),
+                     self._regions[0].left(), self._regions[-1].right()))
+
+
+    def _load_around(self, s):
+        """
+        Extend the window of a windowed layer to s and return True,
+        returns False if s lies outside of the lattice file
+        """
+        if (self._source == None) or \
+           (s < self._source.left()) or (s > self._source.right()):
+            return False
+        self._load(min(s - self._margin, self._regions[0].left()),
+                   max(s + self._margin, self._regions[-1].right()))
+        return True
+
+
+    def _load_further(self, direction):
+        """
+        Extend the window of a windowed layer by the next regions in the
+        direction, returns False if the window reaches the end of the file
+        """
+        if self._source == None:
+            return False
+        left = self._regions[0].left()
+        right = self._regions[-1].right()
+        if direction < 0.0:
+            if left <= self._source.left():
+                return False
+            self._load(max(left - self._margin, self._source.left()), right)
+        else:
+            if right >= self._source.right():
+                return False
+            self._load(left, min(right + self._margin, self._source.right()))
+        return True
+
 
+    def _build(self, lines):
+        """
+        Build the regions from the tokens of the lines
+        """
         current_region = Region()
         prev_s = 0.0
         prev_l = 0.0
-        for line in lattice_file:
-            tokens = line.split()
+        for tokens in lines:
             s = float(tokens[1])
             l = float(tokens[2])
 
@@ -56,12 +129,14 @@ class Layer(object):
                                float(tokens[7])    # angle
                                )
 
+            self._edges.append(s)
+            self._edges.append(s + l)
             prev_s = s
             prev_l = l
         # store last region
         self._s.append(current_region.left())
         self._regions.append(current_region)
-        lattice_file.close()
+        self._edges = sorted(set(self._edges))
 
 
     def get(self, s):
@@ -69,10 +144,65 @@ class Layer(object):
         # return vacuum region
         if (s < self._regions[0].left()) or \
            (s > self._regions[len(self._regions)-1].right()):
-           return Region()
+           if not self._load_around(s):
+               return Region()
         return self._regions[bisect.bisect_left(self._s, s)-1]
 
 
+    def next_edge(self, s, direction):
+        """
+        Return the next slice border after s in the given direction
+        or None if there is none
+        """
+        if (self._source != None) and \
+           ((s < self._s[0]) or (s > self._regions[-1].right())):
+            self._load_around(s)
+        edge = self._next_edge(s, direction)
+        while (edge == None) and self._load_further(direction):
+            edge = self._next_edge(s, direction)
+        return edge
+
+
+    def _next_edge(self, s, direction):
+        if direction < 0.0:
+            idx = bisect.bisect_left(self._edges, s) - 1
+            if idx >= 0:
+                return self._edges[idx]
+        else:
+            idx = bisect.bisect_right(self._edges, s)
+            if idx < len(self._edges):
+                return self._edges[idx]
+        return None
+
+
+    def locate(self, region):
+        """
+        Return the left border of the region, which identifies it within
+        this layer, or None if it is not part of the layer
+        """
+        if region == None:
+            return None
+        idx = bisect.bisect_left(self._s, region.left())
+        if (idx < len(self._regions)) and (self._regions[idx] is region):
+            return region.left()
+        return None
+
+
+    def region(self, left):
+        """
+        Return the region with the left border
+        """
+        idx = bisect.bisect_left(self._s, left)
+        if ((idx == len(self._s)) or (self._s[idx] != left)) and \
+           self._load_around(left):
+            idx = bisect.bisect_left(self._s, left)
+        return self._regions[idx]
+
+
+    def fingerprint(self):
+        return [region.fingerprint() for region in self._regions]
+
+
     def write(self, output):
         output_text = ["[%s]\n"%self._filename]
         for region in self._regions:
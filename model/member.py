@@ -0,0 +1,14 @@
+
+class Member(object):
+    """
+    A single orbit of the run with its own photons and outputs. The step and
+    beam of a member are filled from the ensemble before its photons are
+    created. A run without ensemble consists of one member, whose step and
+    beam are the ones being stepped.
+    """
+    def __init__(self, step, beam, photons, suffix=""):
+        self.step = step
+        self.beam = beam
+        self.photons = photons
+        self.suffix = suffix
+        self.outputs = {}
@@ -1,5 +1,6 @@
 import math
 import bisect
+import hashlib
 
 
 class Region(object):
@@ -45,6 +46,13 @@ class Region(object):
     def count(self):
         return len(self._params)
 
+    def fingerprint(self):
+        """
+        Return the extent of the region and a digest of its parameters
+        """
+        digest = hashlib.sha1(repr((self._s, self._params)).encode())
+        return (self._smin, self._smax, digest.hexdigest())
+
     def k0(self, index):
         return self._return_param(index, 0, 0.0)
 
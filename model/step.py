@@ -1,3 +1,4 @@
+import copy
 from model.curvature import Curvature
 
 
@@ -37,5 +38,31 @@ class Step(object):
         self.curvatures = [Curvature()]*lattice.count()
 
 
+    def state(self, lattice):
+        """
+        Return the step as a dictionary. Curvature objects shared
+        between layers stay shared after restoring the state.
+        """
+        state = copy.copy(self.__dict__)
+        unique = []
+        for curv in self.curvatures:
+            if curv not in unique:
+                unique.append(curv)
+        state['curvatures'] = [unique.index(curv) for curv in self.curvatures]
+        state['curvature_states'] = [curv.state(lattice) for curv in unique]
+        return state
+
+
+    def restore(self, state, lattice):
+        state = copy.copy(state)
+        unique = []
+        for curv_state in state.pop('curvature_states'):
+            curv = Curvature()
+            curv.restore(curv_state, lattice)
+            unique.append(curv)
+        self.__dict__.update(state)
+        self.curvatures = [unique[i] for i in state['curvatures']]
+
+
     def write(self, output):
-        output.write(["%f:%e:%e\n"%(self.s0ip, self.x, self.y)])
+        output.write_record("%f:%e:%e\n", (self.s0ip, self.x, self.y))